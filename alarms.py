@@ -0,0 +1,436 @@
+"""
+This module contains the alarm engine, which replaces the sched queue that
+used to live in the app module. Alarms are saved in an SQLite database so
+they survive a restart, and are indexed in memory by a binary min-heap
+ordered by fire time, so adding or cancelling an alarm by its id is
+O(log n). A dispatcher thread sleeps until exactly the next alarm is due,
+so alarms go off on time whether or not anyone is looking at the website.
+Alarms that went off or were cancelled are kept in a finished table for a
+day, so a client that repeats a request with the same alarm id gets the
+same alarm back instead of a new one. An alarm with a repeat rule in its
+payload stays in the store when it goes off and is moved to its next time.
+Several processes can share one database, and each one picks up the
+changes made by the others when it calls sync.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from typing import NamedTuple
+
+from recurrence import next_fire
+
+log = logging.getLogger(__name__)
+
+PENDING = 'pending'
+FIRED = 'fired'
+CANCELLED = 'cancelled'
+FINISHED_SECONDS = 86400
+# How long the ids of finished alarms are remembered.
+MAX_WAIT_SECONDS = 3600
+# The longest the dispatcher sleeps before it looks at the next alarm again.
+
+
+class Alarm(NamedTuple):
+    """
+    A single alarm. The payload is a json friendly dictionary that is handed
+    back to the callback when the alarm goes off.
+    """
+    alarm_id: str
+    fire_at: float
+    label: str
+    payload: dict
+
+
+class AlarmHeap:
+    """
+    A binary min-heap of alarms ordered by fire time, which also keeps the
+    position of every alarm id in the heap so that any alarm can be removed
+    in O(log n), not just the earliest one.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._pos = {}
+        self._counter = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __contains__(self, alarm_id):
+        return alarm_id in self._pos
+
+    def get(self, alarm_id: str) -> Alarm:
+        """
+        Returns the alarm with the given id, or None.
+        """
+        index = self._pos.get(alarm_id)
+        return None if index is None else self._heap[index][2]
+
+    def peek(self) -> Alarm:
+        """
+        Returns the earliest alarm without removing it, or None.
+        """
+        return self._heap[0][2] if self._heap else None
+
+    def push(self, alarm: Alarm):
+        """
+        Adds an alarm. Alarms with the same fire time keep their order.
+        """
+        self._counter += 1
+        self._heap.append((alarm.fire_at, self._counter, alarm))
+        self._pos[alarm.alarm_id] = len(self._heap) - 1
+        self._sift_up(len(self._heap) - 1)
+
+    def pop(self) -> Alarm:
+        """
+        Removes and returns the earliest alarm.
+        """
+        return self.remove(self._heap[0][2].alarm_id)
+
+    def remove(self, alarm_id: str) -> Alarm:
+        """
+        Removes and returns the alarm with the given id, or None if there
+        is no such alarm.
+        """
+        index = self._pos.pop(alarm_id, None)
+        if index is None:
+            return None
+        removed = self._heap[index][2]
+        last = self._heap.pop()
+        if index < len(self._heap):
+            self._heap[index] = last
+            self._pos[last[2].alarm_id] = index
+            self._sift_up(index)
+            self._sift_down(self._pos[last[2].alarm_id])
+        return removed
+
+    def items(self) -> list:
+        """
+        Returns every alarm sorted by fire time.
+        """
+        return [entry[2] for entry in sorted(self._heap)]
+
+    def _swap(self, i, j):
+        heap = self._heap
+        heap[i], heap[j] = heap[j], heap[i]
+        self._pos[heap[i][2].alarm_id] = i
+        self._pos[heap[j][2].alarm_id] = j
+
+    def _sift_up(self, index):
+        while index > 0:
+            parent = (index - 1) // 2
+            if self._heap[index][:2] >= self._heap[parent][:2]:
+                break
+            self._swap(index, parent)
+            index = parent
+
+    def _sift_down(self, index):
+        size = len(self._heap)
+        while True:
+            smallest = index
+            for child in (2 * index + 1, 2 * index + 2):
+                if child < size and \
+                        self._heap[child][:2] < self._heap[smallest][:2]:
+                    smallest = child
+            if smallest == index:
+                return
+            self._swap(index, smallest)
+            index = smallest
+
+
+class AlarmEngine:
+    """
+    Owns the alarm database, the heap index and the dispatcher thread. The
+    on_fire callback is called with each Alarm when it is due, on the
+    dispatcher thread, after the alarm has been removed from the store.
+    Alarms that fell due while the app was not running go off as soon as
+    the dispatcher starts. The on_sync callback is called by sync with the
+    alarms another process added and the ones it removed.
+    """
+
+    def __init__(self, path: str, on_fire, on_sync=None):
+        self.on_fire = on_fire
+        self.on_sync = on_sync
+        self.version = 0
+        self._heap = AlarmHeap()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._listing = (-1, [])
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS alarms ('
+            'alarm_id TEXT PRIMARY KEY, fire_at REAL NOT NULL, '
+            'label TEXT NOT NULL, payload TEXT NOT NULL)')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS finished ('
+            'alarm_id TEXT PRIMARY KEY, fire_at REAL NOT NULL, '
+            'label TEXT NOT NULL, payload TEXT NOT NULL, '
+            'status TEXT NOT NULL, finished_at REAL NOT NULL)')
+        self._db.commit()
+        self._data_version = None
+        self._load()
+
+    def _load(self) -> bool:
+        """
+        Reads the alarms table into the heap again if another connection has
+        changed the database since it was last read. Returns True if it had.
+        The caller holds the lock, or is the constructor.
+        """
+        data_version = self._db.execute('PRAGMA data_version').fetchone()[0]
+        if data_version == self._data_version:
+            return False
+        self._data_version = data_version
+        self._heap = AlarmHeap()
+        for row in self._db.execute(
+                'SELECT alarm_id, fire_at, label, payload FROM alarms'):
+            self._heap.push(Alarm(row[0], row[1], row[2], json.loads(row[3])))
+        return True
+
+    def sync(self) -> bool:
+        """
+        Picks up the alarms other processes sharing the database added or
+        removed, and wakes the dispatcher. Returns True if there were any.
+        """
+        with self._cond:
+            before = {alarm.alarm_id: alarm for alarm in self._heap.items()}
+            if not self._load():
+                return False
+            after = {alarm.alarm_id: alarm for alarm in self._heap.items()}
+            self.version += 1
+            self._cond.notify()
+        added = [alarm for alarm in after.values()
+                 if before.get(alarm.alarm_id) != alarm]
+        removed = [alarm for alarm in before.values()
+                   if after.get(alarm.alarm_id) != alarm]
+        if self.on_sync is not None and (added or removed):
+            self.on_sync(added, removed)
+        return True
+
+    def add(self, fire_at: float, label: str, payload: dict = None,
+            alarm_id: str = None) -> Alarm:
+        """
+        Saves a new alarm and wakes the dispatcher if it is now the earliest.
+        Adding an alarm with an id that already exists replaces it.
+        """
+        alarm = Alarm(alarm_id or uuid.uuid4().hex, float(fire_at), label,
+                      payload or {})
+        with self._cond:
+            self._db.execute(
+                'INSERT OR REPLACE INTO alarms VALUES (?, ?, ?, ?)',
+                (alarm.alarm_id, alarm.fire_at, alarm.label,
+                 json.dumps(alarm.payload)))
+            self._db.commit()
+            self._heap.remove(alarm.alarm_id)
+            self._heap.push(alarm)
+            self.version += 1
+            self._cond.notify()
+        return alarm
+
+    def add_once(self, alarm_id: str, fire_at: float, label: str,
+                 payload: dict = None) -> tuple:
+        """
+        Adds an alarm with the given id unless an alarm with that id is
+        pending or finished in the last day. Returns the alarm, its status
+        and whether it was added by this call.
+        """
+        with self._cond:
+            known = self.get(alarm_id)
+            if known is not None:
+                return known + (False,)
+            return self.add(fire_at, label, payload, alarm_id), PENDING, True
+
+    def add_many(self, alarms: list) -> list:
+        """
+        Adds many alarms in one transaction, skipping any whose id is
+        pending or finished in the last day, and wakes the dispatcher once.
+        Returns the alarms that were added.
+        """
+        with self._cond:
+            added, seen = [], set()
+            for alarm in alarms:
+                alarm = alarm._replace(alarm_id=alarm.alarm_id
+                                       or uuid.uuid4().hex,
+                                       fire_at=float(alarm.fire_at),
+                                       payload=alarm.payload or {})
+                if alarm.alarm_id in seen or self.get(alarm.alarm_id):
+                    continue
+                seen.add(alarm.alarm_id)
+                added.append(alarm)
+            if not added:
+                return added
+            self._db.executemany(
+                'INSERT INTO alarms VALUES (?, ?, ?, ?)',
+                [(alarm.alarm_id, alarm.fire_at, alarm.label,
+                  json.dumps(alarm.payload)) for alarm in added])
+            self._db.commit()
+            for alarm in added:
+                self._heap.push(alarm)
+            self.version += 1
+            self._cond.notify()
+        return added
+
+    def get(self, alarm_id: str) -> tuple:
+        """
+        Returns the alarm with the given id and its status, pending, fired
+        or cancelled, or None if there is no such alarm. The database is
+        asked as well as the heap, so an alarm another process added or
+        finished since the last sync is found too.
+        """
+        with self._cond:
+            alarm = self._heap.get(alarm_id)
+            if alarm is not None:
+                return alarm, PENDING
+            row = self._db.execute(
+                'SELECT alarm_id, fire_at, label, payload, ? '
+                'FROM alarms WHERE alarm_id = ?', (PENDING, alarm_id)
+            ).fetchone() or self._db.execute(
+                'SELECT alarm_id, fire_at, label, payload, status '
+                'FROM finished WHERE alarm_id = ?', (alarm_id,)).fetchone()
+        if row is None:
+            return None
+        return Alarm(row[0], row[1], row[2], json.loads(row[3])), row[4]
+
+    def _finish(self, alarm: Alarm, status: str) -> bool:
+        """
+        Moves an alarm from the alarms table to the finished table, and
+        forgets finished alarms older than FINISHED_SECONDS. Returns False,
+        and changes nothing, if another process already finished it. The
+        caller holds the lock and commits.
+        """
+        now = time.time()
+        if not self._db.execute('DELETE FROM alarms WHERE alarm_id = ?',
+                                (alarm.alarm_id,)).rowcount:
+            return False
+        self._db.execute(
+            'INSERT OR REPLACE INTO finished VALUES (?, ?, ?, ?, ?, ?)',
+            (alarm.alarm_id, alarm.fire_at, alarm.label,
+             json.dumps(alarm.payload), status, now))
+        self._db.execute('DELETE FROM finished WHERE finished_at < ?',
+                         (now - FINISHED_SECONDS,))
+        return True
+
+    def cancel(self, alarm_id: str) -> Alarm:
+        """
+        Deletes the alarm with the given id and returns it. Returns None if
+        there was no such alarm. An alarm another process added since the
+        last sync is cancelled through its row in the database.
+        """
+        with self._cond:
+            alarm = self._heap.remove(alarm_id)
+            if alarm is None:
+                row = self._db.execute(
+                    'SELECT alarm_id, fire_at, label, payload FROM alarms '
+                    'WHERE alarm_id = ?', (alarm_id,)).fetchone()
+                if row is None:
+                    return None
+                alarm = Alarm(row[0], row[1], row[2], json.loads(row[3]))
+            finished = self._finish(alarm, CANCELLED)
+            self._db.commit()
+            self.version += 1
+            self._cond.notify()
+        return alarm if finished else None
+
+    def upcoming(self) -> list:
+        """
+        Returns the pending alarms sorted by fire time. The sorted list is
+        kept until the next change, so repeated page renders do not re-sort.
+        """
+        with self._cond:
+            if self._listing[0] != self.version:
+                self._listing = (self.version, self._heap.items())
+            return self._listing[1]
+
+    def empty(self) -> bool:
+        """
+        True if there are no pending alarms.
+        """
+        return len(self._heap) == 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def start(self):
+        """
+        Starts the dispatcher thread.
+        """
+        self._stopping = False
+        self._thread = threading.Thread(target=self._dispatch,
+                                        name='alarm-dispatcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the dispatcher thread and closes the database.
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self._db.close()
+
+    def _claim(self, alarm: Alarm) -> bool:
+        """
+        Takes an alarm that is going off out of the alarms table, or moves
+        it to its next time if it repeats. Returns False if another process
+        sharing the database cancelled or moved it first. The caller holds
+        the lock and commits.
+        """
+        rule = alarm.payload.get('repeat')
+        fire_at = None
+        if rule:
+            try:
+                fire_at = next_fire(rule, alarm.fire_at,
+                                    alarm.payload.get('time_zone'))
+            except ValueError:
+                log.exception('Alarm ' + alarm.label
+                              + ' has a bad repeat rule')
+        if fire_at is None:
+            return self._finish(alarm, FIRED)
+        if not self._db.execute(
+                'UPDATE alarms SET fire_at = ? '
+                'WHERE alarm_id = ? AND fire_at = ?',
+                (fire_at, alarm.alarm_id, alarm.fire_at)).rowcount:
+            return False
+        self._heap.push(alarm._replace(fire_at=fire_at))
+        return True
+
+    def _next_due(self) -> Alarm:
+        """
+        Waits until the earliest alarm is due, then removes and returns it,
+        putting it back at its next time if it repeats. Returns None when
+        the engine is stopping.
+        """
+        with self._cond:
+            while not self._stopping:
+                alarm = self._heap.peek()
+                if alarm is None:
+                    self._cond.wait()
+                    continue
+                delay = alarm.fire_at - time.time()
+                if delay > 0:
+                    self._cond.wait(min(delay, MAX_WAIT_SECONDS))
+                    continue
+                self._heap.pop()
+                claimed = self._claim(alarm)
+                self._db.commit()
+                self.version += 1
+                if claimed:
+                    return alarm
+        return None
+
+    def _dispatch(self):
+        while True:
+            alarm = self._next_due()
+            if alarm is None:
+                return
+            try:
+                self.on_fire(alarm)
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Alarm ' + alarm.label + ' failed')
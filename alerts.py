@@ -0,0 +1,170 @@
+"""
+This module raises the covid alerts. An alert rule watches one metric of one
+area in the covid store and goes off when the newest value, its rolling
+average or the growth of that average on the window before reaches the
+rule's threshold. The rules are checked when the covid store has stored new
+values for their metric, rather than on a timer, and are kept in an index by
+area and metric so an ingest only looks at the rules it can affect. A rule
+that went off is disarmed until the value falls below its clear level, which
+is the threshold unless a lower one is given, and it does not go off again
+within its cooldown even then, so a value hovering around the threshold
+does not repeat the alert.
+"""
+
+import logging
+import threading
+import time
+from typing import NamedTuple
+
+from covid_store import WINDOW
+
+log = logging.getLogger(__name__)
+
+ABSOLUTE = 'absolute'  # The newest value
+ROLLING = 'rolling'  # The rolling average over the window
+RELATIVE = 'relative'  # The growth of the rolling average, as a fraction
+KINDS = {ABSOLUTE: 'value', ROLLING: 'average', RELATIVE: 'growth'}
+# The field of the covid store's trend rows that each kind of rule checks.
+COOLDOWN_SECONDS = 86400
+CASES = 'newCasesByPublishDate'
+LABELS = {CASES: 'cases', 'cumCasesByPublishDate': 'total cases',
+          'newDeathsByDeathDate': 'deaths',
+          'cumDeathsByDeathDate': 'total deaths'}
+
+
+class Rule(NamedTuple):
+    """
+    An alert rule. The name identifies the rule across config reloads, and
+    the alert is announced to the household when user is None, and shown
+    to that user otherwise.
+    """
+    name: str
+    area: str
+    metric: str
+    kind: str
+    threshold: float
+    clear: float = None
+    window: int = WINDOW
+    cooldown: float = COOLDOWN_SECONDS
+    user: str = None
+
+
+class Alert(NamedTuple):
+    """
+    A rule that went off, with the value that set it off and its date.
+    """
+    rule: Rule
+    value: float
+    date: str
+
+
+def alert_text(alert: Alert) -> str:
+    """
+    The sentence announcing an alert.
+    """
+    rule = alert.rule
+    label = LABELS.get(rule.metric, rule.metric)
+    days = 'seven' if rule.window == 7 else str(rule.window)
+    if rule.kind == ABSOLUTE:
+        return 'COVID Alert, there were ' + str(alert.value) + ' ' + label \
+            + ' on ' + alert.date + '.'
+    if rule.kind == ROLLING:
+        return 'COVID Alert, the ' + days + ' day average of ' + label \
+            + ' has reached ' + str(round(alert.value)) + '.'
+    before = 'the week' if rule.window == 7 \
+        else 'the ' + days + ' days'
+    return 'COVID Alert, the ' + days + ' day average of ' + label \
+        + ' has increased by ' + str(round(alert.value * 100)) \
+        + ' percent on ' + before + ' before.'
+
+
+class RuleState:
+    """
+    Whether a rule can go off, and when it last did.
+    """
+
+    def __init__(self):
+        self.armed = True
+        self.alerted_at = None
+
+
+class AlertEngine:
+    """
+    The alert rules, indexed by area and metric, checked against a covid
+    store. on_alert is called with every Alert that goes off.
+    """
+
+    def __init__(self, store, on_alert, rules=()):
+        self.store = store
+        self.on_alert = on_alert
+        self._index = {}
+        self._state = {}
+        self._lock = threading.Lock()
+        self.set_rules(rules)
+
+    def set_rules(self, rules):
+        """
+        Replaces the rules. A rule that is unchanged keeps its state, so
+        reloading the config does not repeat its alert.
+        """
+        index = {}
+        for rule in rules:
+            index.setdefault(rule.area, {}).setdefault(
+                rule.metric, []).append(rule)
+        with self._lock:
+            self._state = {rule: self._state.get(rule) or RuleState()
+                           for rule in rules}
+            self._index = index
+
+    def rules(self, area: str, metric: str) -> list:
+        """
+        The rules watching a metric of an area.
+        """
+        return self._index.get(area, {}).get(metric, [])
+
+    def evaluate(self, area: str, metrics=None, now: float = None) -> list:
+        """
+        Checks the rules of the given metrics of area, or all of its rules,
+        against the newest data in the store, calls on_alert with each
+        Alert that goes off and returns them. This is subscribed to the
+        store, so it runs after every ingest.
+        """
+        now = time.time() if now is None else now
+        watched = self._index.get(area, {})
+        alerts = []
+        for metric in watched if metrics is None else metrics:
+            rows = {}
+            for rule in watched.get(metric, ()):
+                if rule.window not in rows:
+                    rows[rule.window] = self.store.newest(area, metric,
+                                                          rule.window)
+                row = rows[rule.window]
+                value = row and row[KINDS[rule.kind]]
+                if value is not None and self._check(rule, value, now):
+                    alerts.append(Alert(rule, value, row['date']))
+        for alert in alerts:
+            log.info('Alert ' + alert.rule.name + ' for ' + area + ': '
+                     + str(alert.value))
+            self.on_alert(alert)
+        return alerts
+
+    def _check(self, rule: Rule, value: float, now: float) -> bool:
+        """
+        True if the rule goes off at value, disarming it. A value below the
+        clear level arms it again.
+        """
+        with self._lock:
+            state = self._state.get(rule)
+            if state is None:  # The rules were replaced meanwhile.
+                return False
+            clear = rule.threshold if rule.clear is None else rule.clear
+            if value < clear:
+                state.armed = True
+                return False
+            if value < rule.threshold or not state.armed \
+                    or (state.alerted_at is not None
+                        and now - state.alerted_at < rule.cooldown):
+                return False
+            state.armed = False
+            state.alerted_at = now
+            return True
@@ -4,273 +4,362 @@
 This is the app module of the Smart Daily Briefings Website. This contains a
 range of functions, and is responsible for the hosting of the flask web server.
 """
-import sched
 import time
-import datetime
+IMPORT_STARTED = time.perf_counter()  # Start of the import to first response
+# pylint: disable=wrong-import-position
+import threading
+import functools
+import hashlib
 import json
+import math
 import logging
-import pyttsx3
+import logging.handlers
+import queue
+import atexit
 from apscheduler.schedulers.background import BackgroundScheduler
 from flask.logging import create_logger
-from flask import Flask, render_template, request, redirect, Markup
-from dataget import weather, news, get_national_covid_json
+from werkzeug.http import parse_accept_header
+from flask import Flask, render_template, request, redirect, jsonify, \
+    Response, get_template_attribute
+from dataget import refresh_all, last_known_weather, load_config, PROVIDERS, \
+    BREAKERS, UNCHANGED, CONFIG
+from config import Config
+from providers import LEAD_SECONDS
+from snapshot import SnapshotStore, COVID_ROWS, fetched_now
+from alarms import AlarmEngine, Alarm, PENDING
+from speech import SpeechWorker, BACKENDS, ALARM, COVID_ALERT
+from audio_cache import AudioCache
+from notifications import NotificationBuilder, with_markup, \
+    write_json_atomically
+from tenants import TenantBriefings, load_profiles
+from startup import Readiness, STALE, READY, FAILED
+from metrics import REGISTRY
+from events import EventBus, snapshot_changes, HOUSEHOLD
+from covid_store import CovidStore, area_key, WINDOW
+from alerts import AlertEngine, Rule, alert_text, CASES, RELATIVE, \
+    COOLDOWN_SECONDS
+from jsonstream import iter_items, first_items
+from fragments import FragmentCache, Page
+from storage import STORAGE, state_path
+from recurrence import zone, parse_when, make_rule, first_fire
+from leader import Leader
+from shared_cache import SharedCache
 
 app = Flask(__name__)
 log = create_logger(app)
-logging.basicConfig(filename='log.log', level=logging.INFO,
-                    format='%(asctime)s %(levelname)s %(name)s : %(message)s'
-                    )
-s = sched.scheduler(time.time, time.sleep)
+log_queue = queue.SimpleQueue()
+log_file = logging.FileHandler(state_path('log.log'))
+log_file.setFormatter(logging.Formatter(
+    '%(asctime)s %(levelname)s %(name)s : %(message)s'))
+log_listener = logging.handlers.QueueListener(log_queue, log_file)
+logging.getLogger().addHandler(logging.handlers.QueueHandler(log_queue))
+logging.getLogger().setLevel(logging.INFO)
+log_listener.start()
+atexit.register(log_listener.stop)
+# Log records are only put on a queue by the thread that logs them, and a
+# listener thread writes them to log.log, so a request never waits for disk.
 schedd = BackgroundScheduler()  # This initializes the APScheduler
 
-schedd.add_job(func=weather, trigger='interval', hours=1)
-schedd.add_job(func=news, trigger='interval', hours=1)
-schedd.add_job(func=get_national_covid_json, trigger='interval',
-               hours=1)
-# Weather, News, and Covid data is updated once per hour with APScheduler
 
-weather()  # Updates the weather on runtime
+def add_timed_job(func, **trigger):
+    """
+    Adds func to the scheduler with the given trigger, timing every run of
+    it for the /metrics route.
+    """
+    return schedd.add_job(
+        func=REGISTRY.timed('job_seconds', job=func.__name__)(func),
+        **trigger)
+
 
-news()  # Updates the news on runtime
+briefing = SnapshotStore()  # In-memory copy of the data shown on /index
+readiness = Readiness(IMPORT_STARTED)
+notification_builder = NotificationBuilder(
+    state_path('notifications.json'), state_path('dismissed.json'))
+covid_store = CovidStore(state_path('covid.db'))  # Every covid metric by date
+BRIEFING_CACHE = state_path('briefing.json')
+# The compact copy of the snapshot fields saved after each refresh.
+tenants = TenantBriefings(load_profiles(load_config()), covid_store)
+# The users from config.json, who are served alongside the household.
+events = EventBus()  # Changes pushed to the open pages by the /events route
 
-get_national_covid_json()  # Updates the covid data on runtime
+
+def publish(user: str, kind: str, data=None):
+    """
+    Pushes an event to the open pages of user, or of the household when
+    user is None, and counts it for the /metrics route.
+    """
+    events.publish(user, kind, data)
+    REGISTRY.inc('events_published_total', kind=kind)
 
 
-def current_time_refresh() -> str:
+def publish_changes(user: str):
     """
-    This functions main job is to make sure the current time is always up
-    to date for the alarms to be set accurately.
-    It uses an Advanced Python Scheduler outside of
-    the function to update the current time once every 60 seconds.
+    Returns a snapshot subscriber that publishes what changed on the page
+    of user.
     """
+    def subscriber(old, new):
+        for kind, data in snapshot_changes(old, new):
+            publish(user, kind, data)
+    return subscriber
 
-    now = datetime.datetime.now()
-    current_time = now.strftime('%D/%M/%Y T %H:%M')
-    return current_time
 
+briefing.subscribe(publish_changes(None))
+for tenant_name, tenant_briefing in tenants.tenants.items():
+    tenant_briefing.store.subscribe(publish_changes(tenant_name))
 
-schedd.add_job(func=current_time_refresh, trigger='interval',
-               seconds=60)
+leader = Leader(state_path('leader.lock'))  # Held by the process running jobs
+shared = SharedCache(state_path('shared.db'))  # Snapshots all processes read
+SHARED_FIELDS = ('notifications', 'news', 'weather', 'covid', 'fetched')
+READINESS = '.readiness'  # The shared channel of the leader's startup state
+SYNC_SECONDS = 1
+applying = threading.local()  # Set while changes from the cache are applied
+VIEWED = '.viewed'  # The shared channel of the last time anyone looked
+VIEWER_SECONDS = 600
+# How long after a page or API request the data is kept fresh for viewers.
+REFRESH_SECONDS = 30  # How often the provider registry is asked what is due
+VIEWED_SHARE_SECONDS = 60  # How often a process shares that it has viewers
+viewed = {'at': 0.0, 'shared': 0.0}
+# When this process last saw a viewer, and when it last shared that.
+CONFIG_QUERIES = {'weather': ('weather_city_name', 'weather_api_key'),
+                  'news': ('news_sources', 'news_api_key'),
+                  'covid': ('covid_area_type', 'covid_area_name')}
+# The settings behind the upstream queries of each provider.
 
 
-def tts(announcement, *args):
+def configure_providers(config: Config):
     """
-    The tts function takes one argument, announcement, and uses pyttsx3 to
-    announce the required information. The function tries to end the
-    pyttsx3 engine loop, but if there is an error, it passes. Then the
-    announcement is made, and the user is redirected back to the /index page.
+    Applies the provider settings and the alarm lead time of config to the
+    provider registry.
     """
-    engine = pyttsx3.init()
-    try:
-        engine.endLoop()
-    except BaseException:
-        pass
-    engine.say(announcement)
-    engine.runAndWait()
-    engine.stop()
+    PROVIDERS.configure(config.providers)
+    PROVIDERS.lead = LEAD_SECONDS if config.alarm_lead_seconds is None \
+        else config.alarm_lead_seconds
+
+
+configure_providers(CONFIG.current())
+
+
+def share_changes(channel: str):
+    """
+    Returns a snapshot subscriber that writes the fields that changed to
+    the shared cache, unless they came from it.
+    """
+    def subscriber(old, new):
+        if getattr(applying, 'active', False):
+            return
+        changed = {field: getattr(new, field) for field in SHARED_FIELDS
+                   if getattr(new, field) != getattr(old, field)}
+        if changed:
+            shared.publish(channel, changed)
+    return subscriber
+
+
+def apply_shared():
+    """
+    Swaps the snapshot fields that other processes changed into the stores
+    of this one, which pushes them to the pages open on this process, and
+    follows the startup state of the leader.
+    """
+    for channel, fields in shared.changes().items():
+        if channel == READINESS:
+            if not leader.is_leader:
+                readiness.mark(fields['state'])
+            continue
+        if channel == VIEWED:
+            viewed['at'] = viewed['shared'] = max(viewed['at'], fields['at'])
+            continue
+        tenant = tenants.get(channel)
+        if tenant is None and channel != HOUSEHOLD:
+            continue
+        if 'notifications' in fields:
+            fields['notifications'] = with_markup(fields['notifications'])
+        applying.active = True
+        try:
+            (tenant.store if tenant else briefing).update(**fields)
+        finally:
+            applying.active = False
+
+
+speech = SpeechWorker(BACKENDS[CONFIG.current().tts_backend](),
+                      cache=AudioCache(state_path('audio_cache')))
+# The speech worker owns the one text-to-speech engine used by the app, and
+# plays the pre-rendered weather and news briefings from the audio cache.
+
+
+def tts(announcement, *args, priority=ALARM):
+    """
+    The tts function takes one argument, announcement, and hands it to the
+    speech worker, which announces the required information on its own
+    thread, so the caller is not held up while it is spoken. Covid alerts
+    pass a higher priority so they are spoken before routine alarms. Then
+    the user is redirected back to the /index page.
+    """
+    speech.announce(announcement, priority)
     return redirect('/index')
 
 
-def hhmm_to_seconds(time_value: str) -> int:
-    """
-    This function takes the argument of time_value with the format
-    d/m/y T hh:mm with the T being a separator between date and time.
-    The function extracts the integer values of the hours and minutes,
-    multiplies them by 3600 and 60 respectively, and returns this value.
-    """
-
-    time_val_list = time_value.split('T')
-    time_val_list1 = time_val_list[1]
-    ':'.join(time_val_list1)
-    time_val_list1 = str(time_val_list1)
-    (hours, minutes) = time_val_list1.split(':')
-    return int(hours) * 3600 + int(minutes) * 60
-
-
-def extract_data_for_notifications():
-    """
-    This function is responsible for extracting the articles from the
-    news.json file and the covid case statistics from the covid.json file.
-    Notifications is created here as a list of dictionaries,
-    based on the length of the number of articles, plus one for the covid
-    update. The uk_covid19 module can return updates where the deaths display
-    as null or None, and I have observed this for up to the past two updates.
-    As a defensive measure I have implemented type checking to
-    ensure that only numbers are displayed in the notification, and not a null
-    or None value. The function dumps the relevant data to a notifications.json
-    file. This function is also run with the Advanced Python Scheduler every
-    hour to update the notifications.json file.
-    """
-
-    news_json = open('news.json', 'r')
-    covid = open('covid.json', 'r')
-    log.info('news.json and covid.json have been opened in read mode')
-    interim = json.load(covid)
-    covid_data = interim['data']
-    news_json = json.load(news_json)
-    art = news_json['articles']
-    notifications = [{} for x in range(len(art) + 1)]
-    i = 1
-    for article in art:
-        new2 = notifications[i]
-        new2['title'] = article['title']
-        url = article['url']
-        desc = article['description']
-        new2['content'] = Markup("<a href='" + url + "'>" + desc
-                                 + '</a>')
-        i += 1
-    log.info('Articles have been updated from json')
-    today = covid_data[0]
-    previous_update_1 = covid_data[1]
-    previous_update_2 = covid_data[2]
-    new4 = notifications[0]
-    new4['title'] = 'Coronavirus Data Update'
-    if isinstance(today['newDeathsByDeathDate'], int) \
-            or isinstance(today['cumDeathsByDeathDate'], int):
-        new4['content'] = "Today's New Cases: " \
-            + str(today['newCasesByPublishDate']) + '\tTotal Cases: ' \
-            + str(today['cumCasesByPublishDate']) \
-            + "\nToday's New Deaths: " \
-            + str(today['newDeathsByDeathDate']) + '\nTotal Deaths: ' \
-            + str(today['cumDeathsByDeathDate'])
-    elif isinstance(previous_update_1['newDeathsByDeathDate'], int) \
-            or isinstance(previous_update_1['cumDeathsByDeathDate'], int):
-        new4['content'] = "Today's New Cases: " \
-            + str(today['newCasesByPublishDate']) + '\tTotal Cases: ' \
-            + str(today['cumCasesByPublishDate']) \
-            + "\nToday's New Deaths: " \
-            + str(previous_update_1['newDeathsByDeathDate']) \
-            + '\nTotal Deaths: ' \
-            + str(previous_update_1['cumDeathsByDeathDate'])
-    else:
-        new4['content'] = "Today's New Cases: " \
-            + str(today['newCasesByPublishDate']) + '\nTotal Cases: ' \
-            + str(today['cumCasesByPublishDate']) \
-            + "\nToday's New Deaths: " \
-            + str(previous_update_2['newDeathsByDeathDate']) \
-            + "\nToday's New Deaths: " \
-            + str(previous_update_2['cumDeathsByDeathDate'])
-    with open('notifications.json', 'w') as ofile:
-        json.dump(notifications, ofile, sort_keys=True, indent=4)
+def fire_alarm(alarm):
+    """
+    This is called by the alarm engine on its dispatcher thread when an
+    alarm is due, and announces it with the briefings it asked for, put
+    together from the snapshot as it is now.
+    """
 
+    log.info(alarm.label + ' alarm has gone off')
+    publish(alarm.payload.get('user'), 'alarm_fired', {'id': alarm.alarm_id})
+    tts(announcement_for(alarm), alarm.label)
+    if alarm.payload.get('repeat'):
+        found = alarm_engine.get(alarm.alarm_id)
+        if found and found[1] == PENDING:  # Back at its next time.
+            publish_added(found[0])
 
-extract_data_for_notifications()  # Extracts most recent data from the API's on
-# runtime.
-schedd.add_job(func=extract_data_for_notifications, trigger='interval',
-               hours=1)  # Updates notifications hourly.
 
+def publish_synced(added: list, removed: list):
+    """
+    Pushes the alarms another process added, moved or removed to the pages
+    open on this process.
+    """
+    for alarm in removed:
+        publish(alarm.payload.get('user'), 'alarm_cancelled',
+                {'id': alarm.alarm_id})
+    for alarm in added:
+        publish_added(alarm)
 
-def extract_data() -> list:
+
+alarm_engine = AlarmEngine(state_path('alarms.db'), on_fire=fire_alarm,
+                           on_sync=publish_synced)  # Saved alarms
+
+
+def household_area() -> str:
+    """
+    The key in the covid store of the covid area in config.json.
+    """
+    config = CONFIG.current()
+    return area_key(config.covid_area_type, config.covid_area_name)
+
+
+def ingest_covid(covid_json: dict) -> dict:
+    """
+    Adds a covid API response for the household area to the covid store,
+    where only new or revised values are written, and returns the summary
+    of the area with the latest value and trend of every metric.
+    """
+    area = household_area()
+    covid_store.ingest(area, covid_json['data'], covid_json.get('lastUpdate'))
+    return covid_store.summary(area)
+
+
+def extract_data_for_notifications(news_json: dict = None,
+                                   covid_json: dict = None) -> bool:
     """
-    This function opens the notifications.json file and creates another list
-    of dictionaries called notifications. It then uses the
-    file to populate the dictionaries, and then returns the list for use later.
+    This function is responsible for passing the articles from the news API
+    response and the covid case statistics from the covid store, after the
+    covid API response has been added to it, to the notification builder.
+    The builder compares them with the current notifications by url, so
+    only new or changed notifications are added and articles that are no
+    longer in the top headlines are retired. Either response can be left
+    out to keep the current notifications of that kind.
+    The notifications.json file is only rewritten when something changed,
+    in which case this returns True. This function is also run with the
+    Advanced Python Scheduler every hour as part of the refresh.
     """
 
-    with open('notifications.json', 'r') as notif:
-        notif = json.load(notif)
-        notifications = [{} for i in range(len(notif))]
-        i = 0
-        for element in notif:
-            notifs = notifications[i]
-            notifs_file = notif[i]
-            notifs['title'] = notifs_file['title']
-            notifs['content'] = Markup(notifs_file['content'])
-            i += 1
-        return notifications
+    articles = news_json['articles'] if news_json else None
+    covid_summary = ingest_covid(covid_json) if covid_json else None
+    changed = notification_builder.update(articles, covid_summary)
+    if changed:
+        log.info('Notifications have been updated')
+    return changed
+
 
+@REGISTRY.timed('extract_data_seconds')
+def extract_data() -> list:
+    """
+    This function creates a list of dictionaries called notifications from
+    the notifications that have not been dismissed, with the content marked
+    as safe html, and then returns the list for use later.
+    """
 
-extract_data()  # Updates the notifications data structure on runtime in order
-# to make sure the displayed notifications are the most recent.
+    return with_markup(notification_builder.visible())
 
 
 def news_for_alarms() -> list:
     """
-    This function opens the news.json file and creates a list called
+    This function reads the news.json file and creates a list called
     articles. Here it appends the article titles for reading by the
-    announcement.It returns this list for use in s.enter later on.
+    announcement.It returns this list for use in the alarms later on. Only
+    the titles are decoded, one article at a time, so the whole file is
+    never held in memory.
     """
 
-    with open('news.json', 'r') as news_data:
-        log.info('News.json has been opened for an alarm')
-        news_data = json.load(news_data)
-        art = news_data['articles']
-        i = 0
-        articles = []
-        for article in art:
-            article = article['title']
-            article = str(article)
-            articles.append(article)
-            i += 1
-        return articles
+    log.info('News.json has been opened for an alarm')
+    articles = []
+    for article in iter_items(state_path('news.json'), 'articles',
+                              fields=('title',)):
+        articles.append(str(article['title']))
+    return articles
 
 
-def store_data():
+def alert_rules(config: Config) -> list:
     """
-    This function is run by the Advanced Python Scheduler every 12 hours.
-    It opens the covid json file as read, and opens a textfile named
-    local_covid_store as write.It then adds the current case count to
-    the local_covid_store file.
+    The alert rules: one for the household and one for every user, which go
+    off when the 7 day average of new cases has grown on the week before by
+    their user_threshold_number or more, as a fraction, and the rules in the
+    alerts list of config.json. Those watch the area of their user, or the
+    household area if they have none.
     """
+    household = area_key(config.covid_area_type, config.covid_area_name)
+    areas = {None: household}
+    rules = [Rule('cases', household, CASES, RELATIVE,
+                  config.user_threshold_number)]
+    for name, tenant in tenants.tenants.items():
+        profile = tenant.profile
+        areas[name] = area_key(profile.covid_area_type,
+                               profile.covid_area_name)
+        rules.append(Rule('cases-' + name, areas[name], CASES, RELATIVE,
+                          profile.user_threshold_number, user=name))
+    for index, settings in enumerate(config.alerts):
+        user = settings.get('user')
+        if user not in areas:
+            log.warning('Skipping an alert for unknown user ' + str(user))
+            continue
+        rules.append(Rule(
+            settings.get('name') or 'alert-' + str(index), areas[user],
+            settings['metric'], settings['kind'], settings['threshold'],
+            settings.get('clear'), settings.get('window', WINDOW),
+            settings.get('cooldown', COOLDOWN_SECONDS), user))
+    return rules
+
 
-    with open('covid.json', 'r') as covid:
-        with open('local_covid_store.txt', 'w') as local_covid:
-            log.info(
-                'covid.json and local_covid_store.txt have been opened'
-                'as read and write respectively')
-            interim = json.load(covid)
-            covid_data = interim['data']
-            today = covid_data[0]
-            today_cases = today['newCasesByPublishDate']
-            today_cases = str(today_cases)
-            local_covid.write(today_cases)
+def raise_alert(alert):
+    """
+    Speaks an alert of the household, before routine alarms, or shows an
+    alert of a user on their pages, and counts it for the /metrics route.
+    """
+    text = alert_text(alert)
+    log.info(text)
+    REGISTRY.inc('alerts_total', kind=alert.rule.kind)
+    if alert.rule.user is None:
+        tts(text, 'dummy_arg', priority=COVID_ALERT)
+    else:
+        publish(alert.rule.user, 'alert', {'text': text})
 
 
-schedd.add_job(
-    func=store_data,
-    trigger='interval',
-    hours=12)  # This creates an
-# APScheduler instance calls the store_data function to store the most
-# recent case data.
+alert_engine = AlertEngine(covid_store, raise_alert,
+                           alert_rules(CONFIG.current()))
+covid_store.subscribe(alert_engine.evaluate)
+# The rules are checked whenever new covid data is stored for their metric.
 
 
 def check_cases_change():
     """
-    This function is also run every 1 hour by the Advanced Python Scheduler.
-    It opens both the covid.json file and the local_covid_store.txt files
-    in read mode. It then compares the values, if the increase in cases
-    since the last update is more than 30%,it uses tts to announce this.
-    Otherwise it returns false.
-    """
-
-    with open('covid.json', 'r') as covid:
-        with open('local_covid_store.txt', 'r') as local_covid:
-            log.info(
-                'covid.json and local_covid_store.txt have been opened as read')
-            interim = json.load(covid)
-            covid_data = interim['data']
-            today_ap = covid_data[0]
-            today_api = today_ap['newCasesByPublishDate']
-            today_local = local_covid.read()
-            today_local = int(today_local)
-            file = open('config.json', 'r')
-            file = json.load(file)
-            user_number = file['user_threshold_number']
-            if (today_api - today_local) / today_api >= user_number:
-                today_api = str(today_api)
-                log.info('Case increse by more than ' + str(user_number)
-                         + 'percent since last update!')
-                return tts(
-                    'COVID Alert, Cases have increased by ' + str(user_number)
-                    + 'percent or more since the last update.', 'dummy_arg')
-            else:
-                return 'False'
-
-
-check_cases_change()
-schedd.add_job(func=check_cases_change, trigger='interval', minutes=60)
-# This once again uses APScheduler to check if the cases have increased
-# by a percentage value set by the user every hour.
+    Checks the alert rules of the household area against the covid store
+    now, which otherwise happens as new data is stored. A rule only goes
+    off again once the value has fallen below its clear level and its
+    cooldown has passed. Returns the alerts, or 'False' if there were none.
+    """
+
+    return alert_engine.evaluate(household_area()) or 'False'
 
 
 def s_since_epoch(arg: float) -> str:
@@ -282,133 +371,927 @@ def s_since_epoch(arg: float) -> str:
     return time.strftime('%m/%d/%y %H:%M', time.gmtime(arg))
 
 
-weather = weather()
-news_for_alarm = news_for_alarms()
+def alarm_view(alarm) -> dict:
+    """
+    The id, title and content of an alarm as shown on the page.
+    """
+    content = s_since_epoch(alarm.fire_at)
+    if alarm.payload.get('repeat'):
+        content += ', repeats ' + alarm.payload['repeat']
+    return {'id': alarm.alarm_id, 'title': alarm.label, 'content': content}
+
+
+def alarm_time_zone(tenant) -> str:
+    """
+    The time zone name of a tenant, or of the household from config.json,
+    or None for the local time zone.
+    """
+    if tenant:
+        return tenant.profile.time_zone
+    return CONFIG.current().time_zone
+
+
+LATEST_ALARM = 253402300799  # The last second of the year 9999, in UTC
+PRERENDER_LIMIT = 8  # The most announcements one pass queues to pre-render
+
+
+def plan_alarm(when, repeat: str = None, time_zone: str = None) -> tuple:
+    """
+    Works out when an alarm first goes off from when, seconds since the
+    epoch or a date and time as text, and its repeat rule, daily, weekdays,
+    weekends or a cron expression. Returns the fire time and the cron rule,
+    which is None for an alarm that does not repeat. Raises ValueError for
+    a time, rule or time zone that can not be read, or a time that is not
+    between the epoch and LATEST_ALARM.
+    """
+    tz = zone(time_zone)
+    start = parse_when(when, tz) if isinstance(when, str) else float(when)
+    if not math.isfinite(start) or not 0 <= start <= LATEST_ALARM:
+        raise ValueError('The alarm time is out of range')
+    rule = make_rule(repeat, start, tz)
+    return first_fire(rule, start, tz), rule
+
+
+def alarm_payload(user: str, rule: str = None, time_zone: str = None,
+                  briefings: tuple = ()) -> dict:
+    """
+    The payload saved with an alarm. briefings names the providers whose
+    data is announced when it goes off, weather or news.
+    """
+    payload = {'user': user, 'briefings': list(briefings)}
+    if rule:
+        payload.update(repeat=rule, time_zone=time_zone)
+    return payload
+
+
+def announcement_for(alarm):
+    """
+    The announcement of an alarm, with its briefings taken from the current
+    snapshot of its user, or of the household. Alarms saved before the
+    briefings were put together when they go off keep the announcement
+    they were saved with.
+    """
+    payload = alarm.payload
+    if 'briefings' not in payload:
+        return payload['announcement']
+    tenant = tenants.get(payload.get('user'))
+    snap = tenant.store.current() if tenant else briefing.current()
+    return choose_announcement(snap, alarm.label,
+                               'weather' in payload['briefings'],
+                               'news' in payload['briefings'])
+
+
+def prepare_alarms() -> int:
+    """
+    Renders the announcements of the alarms due within the lead time of
+    the provider registry into the audio cache, from the current snapshots,
+    so they play straight away. Alarms due together with the same
+    announcement share one rendering, and the soonest PRERENDER_LIMIT are
+    queued, the rest waiting for a later pass. Returns the number queued.
+    """
+    horizon = time.time() + PROVIDERS.lead
+    return speech.prerender([announcement_for(alarm)
+                             for alarm in alarm_engine.upcoming()
+                             if alarm.fire_at <= horizon], PRERENDER_LIMIT)
+
+
+def wanted_briefings(weather: bool, news: bool) -> tuple:
+    """
+    The names of the providers an alarm with the given tick boxes needs.
+    """
+    return tuple(name for name, wanted in (('weather', weather),
+                                           ('news', news)) if wanted)
+
+
+def user_alarms(user: str) -> list:
+    """
+    The pending alarms of user, or of the household, by fire time.
+    """
+    return [alarm for alarm in alarm_engine.upcoming()
+            if alarm.payload.get('user') == user]
+
+
+def find_alarm(alarm_id: str, user: str) -> tuple:
+    """
+    The alarm with the given id and its status, if it belongs to user, or
+    to the household when user is None. Returns None otherwise, so the
+    alarms of other users can not be read or cancelled.
+    """
+    found = alarm_engine.get(alarm_id)
+    if found is None or found[0].payload.get('user') != user:
+        return None
+    return found
+
+
+def publish_added(alarm):
+    """
+    Pushes a pending alarm to the open pages of its user, placed before the
+    alarm that goes off after it.
+    """
+    user = alarm.payload.get('user')
+    pending = [alarm.alarm_id for alarm in user_alarms(user)]
+    if alarm.alarm_id in pending:  # It may have gone off already.
+        later = pending[pending.index(alarm.alarm_id) + 1:]
+        publish(user, 'alarm_added', dict(
+            alarm_view(alarm), before=later[0] if later else None))
+
+
+def schedule_alarm(user: str, fire_at: float, label: str,
+                   alarm_id: str = None, rule: str = None,
+                   time_zone: str = None, briefings: tuple = ()) -> tuple:
+    """
+    Adds an alarm for user, or the household, and pushes it to their open
+    pages. The briefings it announces are put together when it goes off.
+    With an alarm_id the alarm is only added if that id is new, so a client
+    can safely repeat the request. An alarm with a cron rule goes off again
+    at every time the rule allows, on the clock of time_zone.
+    Returns the alarm, its status and whether it was added.
+    """
+    payload = alarm_payload(user, rule, time_zone, briefings)
+    if alarm_id is None:
+        alarm = alarm_engine.add(fire_at, label, payload)
+        status, added = PENDING, True
+    else:
+        alarm, status, added = alarm_engine.add_once(alarm_id, fire_at,
+                                                     label, payload)
+    if not added:
+        return alarm, status, added
+    log.info('Alarm added')
+    publish_added(alarm)
+    return alarm, status, added
+
+
+def cancel_alarm(alarm_id: str):
+    """
+    Cancels a pending alarm and removes it from the open pages. Returns the
+    alarm, or None if it was not pending.
+    """
+    cancelled = alarm_engine.cancel(alarm_id)
+    if cancelled:
+        log.info('Alarm ' + alarm_id + ' has been cancelled')
+        publish(cancelled.payload.get('user'), 'alarm_cancelled',
+                {'id': cancelled.alarm_id})
+    return cancelled
+
+
+def choose_announcement(snap, label: str, weather: bool, news: bool):
+    """
+    The announcement for an alarm with the given label, with the weather
+    and news briefings from snap if they were asked for.
+    """
+    briefings = alarm_announcements(snap)
+    if weather:
+        if not news:
+            return briefings['weather']
+        return briefings['both']
+    if news:
+        return briefings['news']
+    return label + ' Has Finished'
+
+
+def alarm_announcements(snap) -> dict:
+    """
+    Builds the three briefings an alarm can include from a snapshot, the
+    weather, the news headlines, or both.
+    """
+
+    news_for_alarm = list(snap.news)
+    return {'weather': snap.weather, 'news': news_for_alarm,
+            'both': (snap.weather, news_for_alarm)}
+
+
+def refresh_briefing(names=None) -> dict:
+    """
+    Fetches the providers in names, or all of them by default, concurrently
+    with refresh_all, updates the notifications that changed, and swaps
+    everything that was fetched into the briefing snapshot in one update.
+    A provider that failed, or whose data has not changed, keeps its
+    previous data in the snapshot and nothing is rebuilt from it. The users
+    from config.json are refreshed after the household, sharing its upstream
+    queries. The alarms due soon are then pre-rendered from the new data so
+    they can play straight away. Returns the results of refresh_all.
+    """
+
+    results = refresh_all(names)
+    try:
+        tenants.refresh(load_config(), names)
+    except Exception:  # pylint: disable=broad-except
+        log.exception('Refreshing the users failed')
+    fresh = {name: result for name, result in results.items()
+             if result is not UNCHANGED}
+    changes = {}
+    if 'weather' in fresh:
+        changes['weather'] = fresh['weather']
+    if 'news' in fresh:
+        changes['news'] = news_for_alarms()
+    if 'covid' in fresh:
+        changes['covid'] = fresh['covid']['data'][:COVID_ROWS]
+    if extract_data_for_notifications(fresh.get('news'), fresh.get('covid')):
+        changes['notifications'] = extract_data()
+    if results:
+        changes['fetched'] = fetched_now(briefing.current(), results)
+    if changes:
+        save_briefing_cache(briefing.update(**changes))
+    prepare_alarms()
+    return results
+
+
+def how_long(seconds: float) -> str:
+    """
+    A length of time in words, in minutes, hours or days.
+    """
+    for unit, size in (('day', 86400), ('hour', 3600)):
+        if seconds >= 2 * size:
+            return str(int(seconds // size)) + ' ' + unit + 's'
+    return str(max(1, int(seconds // 60))) + ' minutes'
+
+
+def stale_notes(snap, now: float = None) -> list:
+    """
+    A sentence for every provider whose data in snap is older than its ttl,
+    which happens while it is down and the last good data is shown.
+    """
+    now = time.time() if now is None else now
+    return [(PROVIDERS[name].title or name) + ' is from '
+            + how_long(now - fetched) + ' ago'
+            for name, fetched in snap.fetched
+            if name in PROVIDERS and now - fetched > PROVIDERS[name].ttl]
+
+
+def watched() -> bool:
+    """
+    True if a page or the API was used on any process in the last
+    VIEWER_SECONDS, or a page is open on the events stream.
+    """
+    return time.time() - viewed['at'] < VIEWER_SECONDS
+
+
+def alarm_needs() -> dict:
+    """
+    The fire time of the next alarm that announces each provider's data,
+    by provider name.
+    """
+    needs = {}
+    for alarm in alarm_engine.upcoming():  # Soonest first.
+        for name in alarm.payload.get('briefings', ()):
+            needs.setdefault(name, alarm.fire_at)
+    return needs
+
+
+def refresh_due():
+    """
+    Refreshes the providers the registry says are due, given whether anyone
+    is looking at the website and when the next alarms go off, so the data
+    of every alarm due within the lead time is fetched together, ahead of
+    them. Nothing is fetched if none are, but alarms that came within the
+    lead time are still pre-rendered.
+    """
+    names = PROVIDERS.due(watched(), alarm_needs())
+    if names:
+        log.info('Refreshing ' + ', '.join(names))
+        refresh_briefing(names)
+    else:
+        prepare_alarms()
+
+
+def save_briefing_cache(snap):
+    """
+    Saves the weather, the news titles, the newest covid rows and when
+    each provider last answered from the snapshot to briefing.json, a
+    small file that the next start reads instead of the full provider
+    responses.
+    """
+
+    write_json_atomically(BRIEFING_CACHE, {
+        'weather': snap.weather, 'news': snap.news, 'covid': snap.covid,
+        'fetched': snap.fetched}, separators=(',', ':'))
+
+
+def load_last_known():
+    """
+    Fills the briefing snapshot from the files saved by the previous run,
+    without calling any API, so the first page can be served straight away.
+    The compact briefing.json is read if there is one, and otherwise the
+    news titles and newest covid rows are streamed out of news.json and
+    covid.json. The covid store is only filled from covid.json when it has
+    nothing for the area yet. A file that is missing or unreadable leaves
+    its field empty until the warm up has fetched it.
+    """
+
+    try:
+        with open(BRIEFING_CACHE, 'r') as cache:
+            changes = json.load(cache)
+    except (OSError, ValueError):
+        changes = {'weather': last_known_weather()}
+        loaders = {'news': news_for_alarms,
+                   'covid': lambda: first_items(state_path('covid.json'),
+                                                'data', COVID_ROWS)}
+        for field, loader in loaders.items():
+            try:
+                changes[field] = loader()
+            except (OSError, ValueError, KeyError):
+                log.info('No last known ' + field + ' data on disk')
+    try:
+        if not covid_store.latest(household_area()):
+            with open(state_path('covid.json'), 'r') as covid:
+                ingest_covid(json.load(covid))
+    except (OSError, ValueError, KeyError):
+        log.info('No last known covid data on disk')
+    changes['notifications'] = extract_data()
+    briefing.update(**changes)
+    readiness.mark(STALE)
+
+
+def warm_up():
+    """
+    Fetches fresh data from every provider, which checks the alert rules.
+    The app is marked as ready if every provider answered, or failed if any
+    did not, in which case the last known data keeps being served.
+    """
+
+    try:
+        results = refresh_briefing()
+    except Exception:  # pylint: disable=broad-except
+        log.exception('Warm up failed, serving the last known data')
+        readiness.mark(FAILED)
+    else:
+        readiness.mark(READY if len(results) == len(PROVIDERS) else FAILED)
+    shared.publish(READINESS, {'state': readiness.state})
+
+
+def lead(eager: bool = False):
+    """
+    Starts the jobs only the leader runs, the scheduled refreshes and the
+    alarm dispatcher, and the warm up, which blocks if eager is set.
+    """
+
+    schedd.start()
+    alarm_engine.start()
+    if eager:
+        warm_up()  # Blocks the import until fresh data has been fetched.
+    else:
+        threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+
+
+def follow():
+    """
+    Runs on every process. Once a second it applies the changes the other
+    processes shared, picks up the alarms they added or removed, shares
+    when this process last had a viewer, at most once a minute, and takes
+    over the jobs if the leader has gone.
+    """
+
+    while True:
+        time.sleep(SYNC_SECONDS)
+        try:
+            if not leader.is_leader and leader.try_acquire():
+                lead()
+            apply_shared()
+            if events.listeners:
+                viewed['at'] = time.time()
+            if viewed['at'] - viewed['shared'] >= VIEWED_SHARE_SECONDS:
+                viewed['shared'] = viewed['at']
+                shared.publish(VIEWED, {'at': viewed['at']})
+            alarm_engine.sync()
+        except Exception:  # pylint: disable=broad-except
+            log.exception('Syncing with the other processes failed')
+
+
+load_last_known()  # Serves the data from the last run until the warm up ends.
+briefing.subscribe(share_changes(HOUSEHOLD))
+for tenant_name, tenant_briefing in tenants.tenants.items():
+    tenant_briefing.store.subscribe(share_changes(tenant_name))
+# Only changes made after the files on disk were loaded are shared.
+add_timed_job(refresh_due, trigger='interval', seconds=REFRESH_SECONDS)
+# Weather, News, Covid data and the notifications built from them are updated
+# when the provider registry says they are due.
+
+
+def apply_config(old: Config, new: Config):
+    """
+    Applies a reloaded config.json without a restart. The provider
+    settings, the users and the alert rules change straight away, the time
+    zone is read when it is used, and on the leader the providers whose
+    queries changed are fetched again. The tts backend and the startup mode
+    only change on a restart.
+    """
+    configure_providers(new)
+    for name in tenants.update_profiles(load_profiles(new.data)):
+        store = tenants.get(name).store
+        store.subscribe(publish_changes(name))
+        store.subscribe(share_changes(name))
+    alert_engine.set_rules(alert_rules(new))
+    if old.users != new.users:
+        names = list(PROVIDERS)
+    else:
+        names = [name for name, keys in CONFIG_QUERIES.items()
+                 if any(getattr(old, key) != getattr(new, key)
+                        for key in keys)]
+    if names and leader.is_leader:
+        log.info('The config changed, refreshing ' + ', '.join(names))
+        add_timed_job(refresh_briefing, args=(names,))
+
+
+CONFIG.subscribe(apply_config)
+
+
+def dismiss_notification(key: str) -> bool:
+    """
+    Dismisses the notification with the given key for one hour, and swaps
+    the remaining notifications into the briefing snapshot. The dismissal
+    is saved in dismissed.json so it survives a restart.
+    """
+
+    if notification_builder.dismiss(key):
+        log.info(key + ' has been dismissed for one hour.')
+        briefing.update(notifications=extract_data())
+        return True
+    return False
+
+
+def expire_dismissals():
+    """
+    Shows notifications again once their hour of being dismissed is up.
+    """
+
+    if notification_builder.expire():
+        briefing.update(notifications=extract_data())
+    tenants.expire()
+
+
+add_timed_job(expire_dismissals, trigger='interval', minutes=1)
 
 
 @app.route('/index', methods=['GET'])
+@REGISTRY.timed('event_schedule_seconds')
 def event_schedule():
     """
-    This function begins with starting the sched instance. Then variables are assigned from the
-    request return values of the alarm time box, the label box, and the two tick boxes.
-    Then, if an alarm is set, the notifications variable is assigned to the return value of
-    the function named extract_data, then there are some if statements to check which boxes
-    have been checked. Depending on this, an alarm with the desired functionality is created
-    and added to the queue. Then, a list of dictionaries named alarms is created, populated
-    with the values from the sched queue, which was assigned to the variable name queue.
-    This then returns the template index.html with alarms and notifications defined as
-    themselves in order to display them on the website. When the page is loaded normally
-    and an alarm has not been created, the notifications are also loaded from the return
-    value of the extract_data function, and then the list of dictionaries named alarms is
-    created, populated with the values from the sched queue, which is assigned to the
-    variable named queue.
-    """
-
-    s.run(blocking=False)
-    alarm_time = request.args.get('alarm')
-    current_time = current_time_refresh()
+    This function begins by looking up the user named in the user query
+    parameter, if any, so one website can serve every user in config.json,
+    and the household when no user is given. It then cancels the alarm, if
+    it is one of the user's, or removes the notification that was dismissed,
+    if any, and reads the current briefing snapshot of the user, so the page
+    never opens the json files on disk. Variables are assigned from the
+    request return values of the alarm time box, the label box, the repeat
+    box and the two tick boxes. If an alarm is set, its date and time are
+    read on the clock of the user's time zone, and the alarm is added to the
+    alarm engine with the briefings whose boxes were checked. Then, a list
+    of dictionaries named alarms is created, populated with the pending
+    alarms of the user. This then returns the template index.html with
+    alarms and notifications defined as themselves in order to display them
+    on the website. The page is built from cached card fragments and kept,
+    gzipped too, until the data it shows changes.
+    """
+
+    args = request.args.to_dict()  # A missing key costs no KeyError here
+    tenant = tenants.get(args.get('user'))
+    user = tenant.profile.name if tenant else None
+    last_event_id = events.last_id  # The page is at least this up to date.
+    alarm_item = args.get('alarm_item')
+    if alarm_item and find_alarm(alarm_item, user):
+        cancel_alarm(alarm_item)
+    notif = args.get('notif')
+    if notif and tenant:
+        tenants.dismiss(user, notif)
+    elif notif:
+        dismiss_notification(notif)
+    snap = tenant.store.current() if tenant else briefing.current()
+    alarm_time = args.get('alarm')
     if alarm_time:
-        yes_no_weather = request.args.get('weather')
-        log.info('weather checkbox status requested from server')
-        yes_no_news = request.args.get('news')
-        log.info('news checkbox status requested from server')
-        notifications = extract_data()
-        current_time = current_time_refresh()
-        alarm_label = request.args.get('two')
-        log.info('Alarm label requested from server')
-        notif = request.args.get('notif')
-        both = (weather, news_for_alarm)
-        delay = hhmm_to_seconds(alarm_time) \
-            - hhmm_to_seconds(current_time)
-        if yes_no_weather:
-            if not yes_no_news:
-                s.enter(int(delay), 1, tts, [weather, alarm_label])
-                log.info('Alarm added')
-            else:
-                s.enter(int(delay), 1, tts, [both, alarm_label])
-                log.info('Alarm added')
-        elif yes_no_news:
-            if not yes_no_weather:
-                s.enter(int(delay), 1, tts, [news_for_alarm,
-                                             alarm_label])
-                log.info('Alarm added')
+        yes_no_weather = args.get('weather')
+        yes_no_news = args.get('news')
+        alarm_label = args.get('two')
+        time_zone = alarm_time_zone(tenant)
+        try:
+            fire_at, rule = plan_alarm(alarm_time, args.get('repeat'),
+                                       time_zone)
+        except ValueError as error:
+            log.warning('Alarm not set: ' + str(error))
         else:
-            s.enter(int(delay), 1, tts, [alarm_label + ' Has Finished',
-                                         alarm_label])
-            log.info('Alarm added')
-        queue = s.queue
-        alarms = [{} for x in range(len(queue))]
-        i = 0
-        if notif:
-            notif_1 = open('notifications.json', 'r')
-            notif_loaded = json.load(z)
-            i = 0
-            for element in notif_loaded:
-                notification = element['title']
-                if notification == notif:
-                    log.info(
-                        notification +
-                        ' has been dismissed for one hour.')
-                    notif_loaded.pop(i)
-                    i += 1
-                else:
-                    i += 1
-            with open('notifications.json', 'w') as data_file:
-                json.dump(notif_loaded, data_file)
-        for alarm in alarms:
-            alarm_item_1 = queue[i]
-            alarm_item_data = alarm_item_1[3]
-            alarm['title'] = str(alarm_item_data[1])
-            alarm['content'] = str(s_since_epoch(alarm_item_1[0]))
-            i += 1
-        return render_template('index.html', alarms=alarms,
-                               image='kek.png',
-                               notifications=notifications)
+            schedule_alarm(user, fire_at, alarm_label,
+                           rule=rule, time_zone=time_zone,
+                           briefings=wanted_briefings(yes_no_weather,
+                                                      yes_no_news))
+    stale = tuple(stale_notes(snap))
+
+    def render():
+        return Page(render_template(
+            'index.html', image='kek.png', user=user,
+            last_event_id=events.token(last_event_id), stale=stale,
+            alarm_cards=[card('alarm_card', user, alarm_view(alarm))
+                         for alarm in user_alarms(user)],
+            notification_cards=[card('notification_card', user, entry)
+                                for entry in snap.notifications]))
+    page = PAGES.get((user, last_event_id, snap.version,
+                      alarm_engine.version, stale), render)
+    return page_response(page)
+
+
+def card(macro: str, user: str, item: dict):
+    """
+    The html of an alarm or notification card from a macro in cards.html,
+    rendered once for each user and content.
+    """
+    return FRAGMENTS.get(
+        (macro, user) + tuple(item.items()),
+        lambda: get_template_attribute('cards.html', macro)(item, user))
+
+
+def page_response(page: Page) -> Response:
+    """
+    A response with the gzipped copy of a page if the browser accepts it,
+    or the page as it is. The headers are the same for every page, so they
+    are built once rather than set one by one on each response.
+    """
+    if accepts_gzip(request.headers.get('Accept-Encoding', '')):
+        return Response(page.gzipped, headers=GZIP_HEADERS)
+    return Response(page.body, headers=PLAIN_HEADERS)
+
+
+@functools.lru_cache(maxsize=64)
+def accepts_gzip(accept_encoding: str) -> bool:
+    """
+    True if an Accept-Encoding header allows gzip. Browsers send the same
+    few headers again and again, so each is only parsed once.
+    """
+    return parse_accept_header(accept_encoding)['gzip'] > 0
+
+
+PLAIN_HEADERS = (('Content-Type', 'text/html; charset=utf-8'),
+                 ('Vary', 'Accept-Encoding'))
+GZIP_HEADERS = PLAIN_HEADERS + (('Content-Encoding', 'gzip'),)
+
+
+FRAGMENTS = FragmentCache(1000)  # Rendered alarm and notification cards
+PAGES = FragmentCache(64)  # Whole /index pages by the data they show
+API_BODIES = FragmentCache(256)  # API json bodies and ETags by data version
+IMPORT_LIMIT = 1000  # The most alarms one import request can add.
+
+
+def api_error(status: int, message: str):
+    """
+    A json error response for the API routes.
+    """
+    return jsonify({'error': message}), status
+
+
+def api_user():
+    """
+    The tenant named in the user query parameter of an API request, None
+    for the household, or False if there is no user with that name.
+    """
+    name = request.args.get('user')
+    if not name:
+        return None
+    return tenants.get(name) or False
+
+
+def conditional_json(key: tuple, build):
+    """
+    Returns the json from build() with a strong ETag made from a digest of
+    it, so every process serving the same data gives the same ETag, or an
+    empty 304 Not Modified if the client sent that ETag in If-None-Match.
+    The body and its ETag are kept for key, which names the data and its
+    version in this process, so build is called once for each version.
+    """
+    etag, body = API_BODIES.get(key, lambda: json_etag(build()))
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
     else:
-        notifications = extract_data()
-        i = 0
-        queue = s.queue
-        alarms = [{} for x in range(len(queue))]
-        alarm_label = request.args.get('two')
-        notif = request.args.get('notif')
-        current_time = current_time_refresh()
-        if notif:
-            notif_1 = open('notifications.json', 'r')
-            notif_loaded = json.load(notif_1)
-            i = 0
-            for element in notif_loaded:
-                notification = element['title']
-                if notification == notif:
-                    log.info(
-                        notification +
-                        ' has been dismissed for one hour.')
-                    notif_loaded.pop(i)
-                    i += 1
-                else:
-                    i += 1
-            with open('notifications.json', 'w') as data_file:
-                json.dump(notif_loaded, data_file)
-        for alarm in alarms:
-            alarm_item_1 = queue[i]
-            alarm_item_data = alarm_item_1[3]
-            alarm['title'] = str(alarm_item_data[1])
-            alarm['content'] = str(s_since_epoch(alarm_item_1[0]))
-            i += 1
-        return render_template('index.html', alarms=alarms,
-                               image='kek.png',
-                               notifications=notifications)
-
-
-schedd.start()
+        response = jsonify(body)
+    response.set_etag(etag)
+    return response
+
+
+def json_etag(body) -> tuple:
+    """
+    The ETag of a json body, a digest of its canonical form, and the body.
+    """
+    text = json.dumps(body, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:20], body
+
+
+def alarm_json(alarm, status: str = PENDING) -> dict:
+    """
+    An alarm as it is returned by the API.
+    """
+    return dict(alarm_view(alarm), fire_at=alarm.fire_at, status=status,
+                user=alarm.payload.get('user'),
+                repeat=alarm.payload.get('repeat'))
+
+
+def api_alarm_fields(body, tenant) -> dict:
+    """
+    Reads the alarm in a json request body, on the clock of the time zone
+    of tenant, as keyword arguments for schedule_alarm. Raises ValueError
+    with a message for the client if it is not valid.
+    """
+    if not isinstance(body, dict):
+        raise ValueError('Expected a json object')
+    alarm_id = body.get('id')
+    label = body.get('label')
+    fire_at = body.get('fire_at', body.get('at'))
+    repeat = body.get('repeat')
+    time_zone = body.get('time_zone') or alarm_time_zone(tenant)
+    if not isinstance(label, str) or not label.strip():
+        raise ValueError('label is required')
+    if isinstance(fire_at, bool) \
+            or not isinstance(fire_at, (int, float, str)):
+        raise ValueError('fire_at must be seconds since the epoch, or at a '
+                         'date and time')
+    if alarm_id is not None and (not isinstance(alarm_id, str)
+                                 or not 0 < len(alarm_id) <= 64):
+        raise ValueError('id must be a string of up to 64 characters')
+    if not isinstance(repeat, (str, type(None))) \
+            or not isinstance(time_zone, (str, type(None))):
+        raise ValueError('repeat and time_zone must be strings')
+    fire_at, rule = plan_alarm(fire_at, repeat, time_zone)
+    return {'fire_at': fire_at, 'label': label, 'alarm_id': alarm_id,
+            'rule': rule, 'time_zone': time_zone if rule else None,
+            'briefings': wanted_briefings(body.get('weather'),
+                                          body.get('news'))}
+
+
+@app.route('/api/alarms', methods=['GET'])
+def api_alarms():
+    """
+    Lists the pending alarms of the user, or the household, by fire time.
+    """
+
+    tenant = api_user()
+    if tenant is False:
+        return api_error(404, 'No such user')
+    user = tenant.profile.name if tenant else None
+    return conditional_json(('alarms', user, alarm_engine.version), lambda: {
+        'alarms': [alarm_json(alarm) for alarm in user_alarms(user)]})
+
+
+@app.route('/api/alarms', methods=['POST'])
+@app.route('/api/alarms/<alarm_id>', methods=['PUT'])
+def api_create_alarm(alarm_id: str = None):
+    """
+    Creates an alarm from a json body with a label, a fire_at time in
+    seconds since the epoch or an at date and time, and optional weather
+    and news flags, repeat rule and time zone. The id can be given in the
+    url of a PUT or as id in the body of a POST, and a request with an id
+    that was already used returns the alarm it made with 200 instead of
+    making another one, so a client can retry safely.
+    """
+
+    tenant = api_user()
+    if tenant is False:
+        return api_error(404, 'No such user')
+    body = request.get_json(silent=True)
+    if alarm_id is not None and isinstance(body, dict):
+        body = dict(body, id=alarm_id)
+    try:
+        fields = api_alarm_fields(body, tenant)
+    except ValueError as error:
+        return api_error(400, str(error))
+    user = tenant.profile.name if tenant else None
+    alarm, status, added = schedule_alarm(user, **fields)
+    response = jsonify(alarm_json(alarm, status))
+    response.status_code = 201 if added else 200
+    response.headers['Location'] = '/api/alarms/' + alarm.alarm_id
+    return response
+
+
+@app.route('/api/alarms/import', methods=['POST'])
+def api_import_alarms():
+    """
+    Creates many alarms at once from a json body with an alarms list, each
+    in the same form as for POST /api/alarms. Nothing is added unless every
+    alarm is valid. The alarms are saved in one transaction and the open
+    pages are told to reload once, and alarms whose id was already used are
+    skipped, so an import can be repeated.
+    """
+
+    tenant = api_user()
+    if tenant is False:
+        return api_error(404, 'No such user')
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('alarms'), list):
+        return api_error(400, 'Expected a json object with an alarms list')
+    if len(body['alarms']) > IMPORT_LIMIT:
+        return api_error(413, 'At most ' + str(IMPORT_LIMIT)
+                         + ' alarms can be imported at once')
+    user = tenant.profile.name if tenant else None
+    alarms = []
+    for index, item in enumerate(body['alarms']):
+        try:
+            fields = api_alarm_fields(item, tenant)
+        except ValueError as error:
+            return api_error(400, 'alarms[' + str(index) + ']: ' + str(error))
+        alarms.append(Alarm(fields['alarm_id'], fields['fire_at'],
+                            fields['label'], alarm_payload(
+                                user, fields['rule'], fields['time_zone'],
+                                fields['briefings'])))
+    added = alarm_engine.add_many(alarms)
+    if added:
+        log.info(str(len(added)) + ' alarms imported')
+        publish(user, 'reload')
+    response = jsonify({'added': len(added),
+                        'skipped': len(alarms) - len(added),
+                        'alarms': [alarm_json(alarm) for alarm in added]})
+    response.status_code = 201 if added else 200
+    return response
+
+
+def api_find_alarm(alarm_id: str):
+    """
+    The alarm with the given id and its status, if it belongs to the user
+    named in the user query parameter, or to the household when none is,
+    as the alarms of other users are not found. Returns None otherwise.
+    """
+    tenant = api_user()
+    if tenant is False:
+        return None
+    return find_alarm(alarm_id, tenant.profile.name if tenant else None)
+
+
+@app.route('/api/alarms/<alarm_id>', methods=['GET'])
+def api_alarm(alarm_id: str):
+    """
+    Returns one alarm of the user, or the household, with its status,
+    pending, fired or cancelled.
+    """
+
+    found = api_find_alarm(alarm_id)
+    if found is None:
+        return api_error(404, 'No such alarm')
+    return jsonify(alarm_json(*found))
+
+
+@app.route('/api/alarms/<alarm_id>', methods=['DELETE'])
+def api_cancel_alarm(alarm_id: str):
+    """
+    Cancels an alarm of the user, or the household. Cancelling an alarm
+    that already went off or was already cancelled also succeeds, so the
+    request can be repeated.
+    """
+
+    if api_find_alarm(alarm_id) is None:
+        return api_error(404, 'No such alarm')
+    cancel_alarm(alarm_id)
+    return Response(status=204)
+
+
+@app.route('/api/notifications', methods=['GET'])
+def api_notifications():
+    """
+    Lists the notifications of the user, or the household, that are not
+    dismissed, with the time each provider last answered, so a client can
+    tell how old they are.
+    """
+
+    tenant = api_user()
+    if tenant is False:
+        return api_error(404, 'No such user')
+    user = tenant.profile.name if tenant else None
+    snap = (tenant.store if tenant else briefing).current()
+    return conditional_json(('notifications', user, snap.version), lambda: {
+        'notifications': [{'key': entry['key'], 'title': entry['title'],
+                           'content': str(entry['content'])}
+                          for entry in snap.notifications],
+        'fetched_at': dict(snap.fetched)})
+
+
+@app.route('/api/notifications/<path:key>', methods=['DELETE'])
+def api_dismiss_notification(key: str):
+    """
+    Dismisses a notification by its key for one hour. Dismissing one that
+    is already dismissed succeeds and changes nothing.
+    """
+
+    tenant = api_user()
+    if tenant is False:
+        return api_error(404, 'No such user')
+    if tenant:
+        dismissed = tenants.dismiss(tenant.profile.name, key)
+    else:
+        dismissed = dismiss_notification(key)
+    if not dismissed:
+        return api_error(404, 'No such notification')
+    return Response(status=204)
+
+
+def page_snapshot(channel: str) -> dict:
+    """
+    The notifications and pending alarms on the page of a channel, the
+    name of a user or the household, as the data of a snapshot event.
+    """
+    tenant = tenants.get(channel)
+    user = tenant.profile.name if tenant else None
+    snap = tenant.store.current() if tenant else briefing.current()
+    notifications = [{'key': entry['key'], 'title': entry['title'],
+                      'content': str(entry['content'])}
+                     for entry in snap.notifications]
+    return {'notifications': notifications,
+            'alarms': [alarm_view(alarm) for alarm in user_alarms(user)]}
+
+
+@app.route('/events')
+def event_stream():
+    """
+    Streams the changes to the page of the user named in the user query
+    parameter, or of the household, as server-sent events. The page passes
+    the last event id it was rendered with in the after parameter, and the
+    browser sends the Last-Event-ID header when it reconnects, so no change
+    is missed in between. A page whose id is from another process is sent
+    a snapshot of its notifications and alarms to catch up from.
+    """
+
+    tenant = tenants.get(request.args.get('user'))
+    after = request.headers.get('Last-Event-ID') \
+        or request.args.get('after', '')
+    stream = events.stream(events.parse(after),
+                           tenant.profile.name if tenant else None,
+                           snapshot=page_snapshot)
+    return Response(stream, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
+@app.before_request
+def record_view():
+    """
+    Notes the time of every request for a page or the API, so the providers
+    are kept fresh while someone is using the website.
+    """
+
+    if request.endpoint not in (None, 'ready', 'metrics', 'static'):
+        viewed['at'] = time.time()
+
+
+@app.after_request
+def record_first_response(response):
+    """
+    Counts the response by route and status for the /metrics route, and
+    logs how long it took from the start of the import to the first
+    response, which is also reported by the /ready route.
+    """
+
+    REGISTRY.inc('http_responses_total', status=response.status_code,
+                 route=request.url_rule.rule if request.url_rule else 'none')
+
+    if readiness.record_response():
+        log.info('First response sent '
+                 + str(readiness.as_dict()['import_to_first_response_ms'])
+                 + 'ms after the import started')
+    return response
+
+
+@app.route('/ready')
+def ready():
+    """
+    Reports the startup state and timings as json. The status is 200 once
+    the warm up has fetched fresh data, and 503 while the app is still
+    serving the last known data.
+    """
+
+    body = readiness.as_dict()
+    body['version'] = briefing.version
+    body['leader'] = leader.is_leader
+    body['providers'] = PROVIDERS.metrics()
+    body['circuits'] = {name: breaker.state
+                        for name, breaker in BREAKERS.items()}
+    body['speech'] = speech.metrics()
+    body['audio_cache'] = speech.cache.metrics()
+    body['render_cache'] = {'fragments': FRAGMENTS.metrics(),
+                            'pages': PAGES.metrics()}
+    body['storage'] = {'writes': STORAGE.writes, 'syncs': STORAGE.syncs}
+    return jsonify(body), 200 if readiness.is_ready else 503
+
+
+@app.route('/metrics')
+def metrics():
+    """
+    Reports the counters and latency histograms of the route handlers,
+    provider fetches, text-to-speech and scheduled jobs in the Prometheus
+    text format.
+    """
+
+    return Response(REGISTRY.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+speech.start()
+CONFIG.start()
+if leader.try_acquire():
+    lead(CONFIG.current().startup_mode == 'eager')
+else:
+    log.info('Another process is the leader, following it')
+    apply_shared()
+threading.Thread(target=follow, name='follower', daemon=True).start()
 
 
 def queue_check_test():
-    x = s.empty()
+    x = alarm_engine.empty()
     return x
 
 
 def notifications_format_test() -> bool:
-    with open('notifications.json', 'r') as file:
+    with open(state_path('notifications.json'), 'r') as file:
         notifications = json.load(file)
         notifications = notifications[0]
         if notifications['title'] == notifications['title'] and \
@@ -0,0 +1,121 @@
+"""
+This module keeps rendered announcements on disk so they do not have to be
+synthesized again when an alarm goes off. Each clip is named after a hash
+of the text it speaks, so a clip is reused for as long as the weather and
+news it was made from have not changed. The least recently used clips are
+deleted once there are more than max_entries of them or they take up more
+than max_bytes.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+EXTENSION = '.wav'
+
+
+def clip_key(text: str) -> str:
+    """
+    The cache key for a text, which is also the name of its clip.
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:32]
+
+
+class AudioCache:
+    """
+    An LRU cache of rendered clips in directory. The recency order is kept
+    in memory and rebuilt from the file modification times on startup.
+    """
+
+    def __init__(self, directory: str, max_entries: int = 32,
+                 max_bytes: int = 50 * 1024 * 1024):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        os.makedirs(directory, exist_ok=True)
+        clips = []
+        for name in os.listdir(directory):
+            if name.endswith(EXTENSION):
+                info = os.stat(os.path.join(directory, name))
+                clips.append((info.st_mtime, name[:-len(EXTENSION)],
+                              info.st_size))
+        for _, key, size in sorted(clips):
+            self._entries[key] = size
+            self._bytes += size
+
+    def path_for(self, text: str) -> str:
+        """
+        Where the clip for text is, or would be, saved.
+        """
+        return os.path.join(self.directory, clip_key(text) + EXTENSION)
+
+    def get(self, text: str) -> str:
+        """
+        Returns the path of the clip for text and marks it as recently
+        used, or returns None if it has not been rendered.
+        """
+        key = clip_key(text)
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        path = self.path_for(text)
+        try:
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self._forget(key)
+            return None
+        return path
+
+    def __contains__(self, text: str) -> bool:
+        return clip_key(text) in self._entries
+
+    def render(self, text: str, backend) -> str:
+        """
+        Renders text to a clip with backend.save_to_file, then evicts the
+        least recently used clips if the cache is over its limits. The clip
+        is written under a temporary name first, so a clip that is being
+        rendered is never played. Returns the path of the clip.
+        """
+        path = self.path_for(text)
+        temp_path = path + '.part'
+        backend.save_to_file(text, temp_path)
+        os.replace(temp_path, path)
+        key = clip_key(text)
+        with self._lock:
+            self._forget(key)
+            self._entries[key] = os.path.getsize(path)
+            self._bytes += self._entries[key]
+            while len(self._entries) > 1 and (
+                    len(self._entries) > self.max_entries
+                    or self._bytes > self.max_bytes):
+                oldest = next(iter(self._entries))
+                self._forget(oldest)
+                try:
+                    os.remove(os.path.join(self.directory,
+                                           oldest + EXTENSION))
+                except OSError:
+                    log.warning('Could not remove clip ' + oldest)
+        return path
+
+    def _forget(self, key):
+        self._bytes -= self._entries.pop(key, 0)
+
+    def metrics(self) -> dict:
+        """
+        Hit and miss counts and the current size of the cache.
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self._entries), 'bytes': self._bytes}
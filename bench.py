@@ -0,0 +1,306 @@
+"""
+This module is the benchmark and load test for the website. It runs the
+app against the local stub providers from stub_server, in a scratch copy of
+the json state files, and measures the /index throughput and latency with
+a number of concurrent clients, the cost of building the /index page with
+and without its render caches, the cost of adding an alarm as the number
+of pending alarms grows, the cold import time of app.py and the duration of
+the hourly refresh job. The results are printed as json, or written to the
+file given with --output, so two runs can be compared to catch regressions.
+
+    python bench.py --clients 8 --requests 400 --output bench.json
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from werkzeug.serving import make_server
+import storage
+from alarms import AlarmEngine
+from http_cache import ResponseCache
+from stub_server import StubProviders
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STATE_FILES = ['config.json', 'news.json', 'covid.json', 'notifications.json']
+ALARM_SIZES = (0, 100, 1000, 5000)
+
+COLD_IMPORT = '''
+import json, os, sys, time
+started = time.perf_counter()
+import dataget
+dataget.WEATHER_URL, dataget.NEWS_URL, dataget.COVID_URL = sys.argv[1:4]
+import app
+imported = time.perf_counter()
+app.readiness.wait(60)
+print(json.dumps({'import_ms': (imported - started) * 1000,
+                  'ready_ms': (time.perf_counter() - started) * 1000}))
+sys.stdout.flush()
+os._exit(0)
+'''
+# Run in a new interpreter for every sample, so nothing is already imported.
+
+
+def make_workdir() -> str:
+    """
+    Copies the json state files into a new scratch directory, with the
+    silent speech backend, and returns its path.
+    """
+    workdir = tempfile.mkdtemp(prefix='briefings-bench-')
+    for name in STATE_FILES:
+        shutil.copy(os.path.join(HERE, name), workdir)
+    with open(os.path.join(workdir, 'config.json'), 'r') as conf:
+        settings = json.load(conf)
+    settings['tts_backend'] = 'null'
+    with open(os.path.join(workdir, 'config.json'), 'w') as conf:
+        json.dump(settings, conf)
+    return workdir
+
+
+def percentile(samples: list, fraction: float) -> float:
+    """
+    The value below which the given fraction of the samples fall, using the
+    nearest rank.
+    """
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+    rank = max(1, math.ceil(fraction * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summary(seconds: list) -> dict:
+    """
+    The count, mean, p50, p99 and max of a list of durations, in ms.
+    """
+    def millis(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {'count': len(seconds),
+            'mean_ms': millis(statistics.mean(seconds) if seconds else None),
+            'p50_ms': millis(percentile(seconds, 0.5)),
+            'p99_ms': millis(percentile(seconds, 0.99)),
+            'max_ms': millis(max(seconds) if seconds else None)}
+
+
+def index_load(app_module, clients: int, total: int) -> dict:
+    """
+    Serves the app on a free local port and has clients threads request
+    /index total times between them. Returns the throughput in requests
+    per second and the latency summary.
+    """
+    server = make_server('127.0.0.1', 0, app_module.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = 'http://127.0.0.1:' + str(server.server_port) + '/index'
+    local = threading.local()
+    errors = []
+
+    def one(_):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        started = time.perf_counter()
+        response = local.session.get(url)
+        if response.status_code != 200:
+            errors.append(response.status_code)
+        return time.perf_counter() - started
+
+    try:
+        requests.get(url)  # The first request renders the template cold.
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as pool:
+            latencies = list(pool.map(one, range(total)))
+        elapsed = time.perf_counter() - started
+    finally:
+        server.shutdown()
+    return dict(summary(latencies), clients=clients, errors=len(errors),
+                requests_per_second=round(total / elapsed, 1))
+
+
+def index_render(app_module, samples: int = 200) -> dict:
+    """
+    Times building the /index page in process, by calling its view inside a
+    request context, with the page and card caches cleared before every
+    call and with them kept, and returns how many times faster the kept
+    page is at the median. A whole request through the test client is timed
+    too, as the part of it that is Flask and werkzeug is the same either
+    way. The size of the page and of its gzipped copy are returned as well.
+    """
+    client = app_module.app.test_client()
+    headers = {'Accept-Encoding': 'gzip'}
+    results = {}
+    for kind in ('uncached', 'cached'):
+        durations = []
+        for _ in range(samples):
+            if kind == 'uncached':
+                app_module.PAGES.clear()
+                app_module.FRAGMENTS.clear()
+            with app_module.app.test_request_context('/index',
+                                                     headers=headers):
+                started = time.perf_counter()
+                app_module.event_schedule()
+                durations.append(time.perf_counter() - started)
+        results[kind] = summary(durations)
+    results['speedup'] = round(results['uncached']['p50_ms']
+                               / results['cached']['p50_ms'], 1)
+    durations = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        client.get('/index', headers=headers)
+        durations.append(time.perf_counter() - started)
+    results['cached_request'] = summary(durations)
+    results['bytes'] = len(client.get('/index').data)
+    results['gzip_bytes'] = len(client.get(
+        '/index', headers={'Accept-Encoding': 'gzip'}).data)
+    return results
+
+
+def alarm_creation(workdir: str, sizes: tuple = ALARM_SIZES,
+                   batch: int = 50) -> list:
+    """
+    For every size, fills a new alarm engine with that many pending alarms
+    and then times adding batch more, one at a time, and listing them.
+    """
+    results = []
+    for size in sizes:
+        path = os.path.join(workdir, 'bench-alarms-' + str(size) + '.db')
+        engine = AlarmEngine(path, on_fire=lambda alarm: None)
+        far = time.time() + 86400
+        for i in range(size):
+            engine.add(far + i, 'Filler ' + str(i))
+        adds = []
+        for i in range(batch):
+            started = time.perf_counter()
+            engine.add(far - i, 'Bench ' + str(i), {'announcement': ''})
+            adds.append(time.perf_counter() - started)
+            engine.upcoming()
+        listing = []
+        for i in range(batch):
+            started = time.perf_counter()
+            engine.upcoming()
+            listing.append(time.perf_counter() - started)
+        results.append({'pending': size, 'add': summary(adds),
+                        'upcoming': summary(listing)})
+    return results
+
+
+def cold_import(stub, samples: int) -> dict:
+    """
+    Imports app.py in a new interpreter samples times, each in a new scratch
+    directory, and returns the import and ready time summaries.
+    """
+    imports, readies = [], []
+    env = dict(os.environ, PYTHONPATH=HERE + os.pathsep
+               + os.environ.get('PYTHONPATH', ''))
+    for _ in range(samples):
+        workdir = make_workdir()
+        try:
+            output = subprocess.run(
+                [sys.executable, '-c', COLD_IMPORT, stub.weather_url,
+                 stub.news_url, stub.covid_url], cwd=workdir,
+                env=dict(env, BRIEFINGS_DIR=workdir),
+                check=True, capture_output=True, text=True, timeout=120)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        timings = json.loads(output.stdout.strip().splitlines()[-1])
+        imports.append(timings['import_ms'] / 1000)
+        readies.append(timings['ready_ms'] / 1000)
+    return {'import': summary(imports), 'ready': summary(readies)}
+
+
+def refresh_job(app_module, workdir: str, samples: int) -> dict:
+    """
+    Times the refresh job with the shared fetch cache cleared before every
+    run, so each run asks the stub again. Cold runs also start with an
+    empty HTTP response cache, so the full payloads are fetched, and
+    conditional runs keep it, so the stub answers 304.
+    """
+    import dataget  # pylint: disable=import-outside-toplevel
+    results = {}
+    for kind in ('cold', 'conditional'):
+        durations = []
+        for i in range(samples):
+            if kind == 'cold':
+                dataget.http_cache = ResponseCache(os.path.join(
+                    workdir, 'bench-http-cache-' + str(i)))
+            dataget.shared.invalidate()
+            started = time.perf_counter()
+            app_module.refresh_briefing()
+            durations.append(time.perf_counter() - started)
+        results[kind] = summary(durations)
+    return results
+
+
+def run(clients: int = 8, total: int = 400, import_samples: int = 3,
+        refresh_samples: int = 10, delay: float = 0.0) -> dict:
+    """
+    Runs every benchmark against a stub whose responses take delay seconds
+    and returns the results.
+    """
+    results = {'python': platform.python_version(),
+               'platform': platform.platform(),
+               'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'provider_delay_s': delay}
+    workdir = make_workdir()
+    storage.STATE_DIR = workdir  # Before the app's modules are imported
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        with StubProviders(delay=delay) as stub:
+            results['cold_import'] = cold_import(stub, import_samples)
+            import dataget  # pylint: disable=import-outside-toplevel
+            dataget.WEATHER_URL = stub.weather_url
+            dataget.NEWS_URL = stub.news_url
+            dataget.COVID_URL = stub.covid_url
+            import app  # pylint: disable=import-outside-toplevel
+            app.readiness.wait(60)
+            results['refresh_job'] = refresh_job(app, workdir,
+                                                 refresh_samples)
+            results['index'] = index_load(app, clients, total)
+            results['index_render'] = index_render(app)
+            results['alarm_creation'] = alarm_creation(workdir)
+    finally:
+        os.chdir(cwd)
+    shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def main():
+    """
+    Parses the command line, runs the benchmarks and writes the json.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--clients', type=int, default=8,
+                        help='concurrent /index clients')
+    parser.add_argument('--requests', type=int, default=400,
+                        help='total /index requests')
+    parser.add_argument('--import-samples', type=int, default=3)
+    parser.add_argument('--refresh-samples', type=int, default=10)
+    parser.add_argument('--delay', type=float, default=0.0,
+                        help='seconds each stub response takes')
+    parser.add_argument('--output', help='file to write the json to')
+    args = parser.parse_args()
+    results = run(args.clients, args.requests, args.import_samples,
+                  args.refresh_samples, args.delay)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as ofile:
+            ofile.write(text + '\n')
+    else:
+        print(text)
+    sys.stdout.flush()
+    os._exit(0)  # The app's scheduler and workers are not stopped.
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+This module has the circuit breakers that stop the app from calling a
+provider that is down. Each provider has one. It is closed while the
+provider answers, and opens after a number of failures in a row, after
+which calls fail straight away with CircuitOpen instead of waiting for
+timeouts. Once reset_seconds have passed it is half open, and one call is
+let through as a probe. If the probe succeeds the breaker closes again,
+and if it fails the breaker stays open for another reset_seconds.
+"""
+
+import logging
+import threading
+import time
+
+from metrics import REGISTRY
+
+log = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of calling a provider whose circuit breaker is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    The breaker of one provider, shared by every thread that calls it.
+    """
+
+    def __init__(self, name: str, threshold: int = 3,
+                 reset_seconds: float = 60):
+        self.name = name
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """
+        Closed, open, or half open once reset_seconds have passed.
+        """
+        if self.opened_at is None:
+            return CLOSED
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return HALF_OPEN
+        return OPEN
+
+    def call(self, func, *args, **kwargs):
+        """
+        Calls func unless the breaker is open, or half open with a probe
+        already running, in which case CircuitOpen is raised.
+        """
+        with self._lock:
+            state = self.state
+            if state == OPEN or (state == HALF_OPEN and self._probing):
+                raise CircuitOpen(self.name + ' is not being called, it '
+                                  'failed ' + str(self.failures)
+                                  + ' times in a row')
+            probe = state == HALF_OPEN
+            self._probing = self._probing or probe
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self._failed(probe)
+            raise
+        self._succeeded(probe)
+        return result
+
+    def _failed(self, probe: bool):
+        with self._lock:
+            self.failures += 1
+            if probe:
+                self._probing = False
+            if probe or (self.opened_at is None
+                         and self.failures >= self.threshold):
+                self.opened_at = time.monotonic()
+                REGISTRY.inc('circuit_opened_total', provider=self.name)
+                log.warning('Circuit for ' + self.name + ' is open for '
+                            + str(self.reset_seconds) + ' seconds')
+
+    def _succeeded(self, probe: bool):
+        with self._lock:
+            if probe:
+                self._probing = False
+                log.info('Circuit for ' + self.name + ' is closed again')
+            self.failures = 0
+            self.opened_at = None
@@ -0,0 +1,232 @@
+"""
+This module reads config.json once and keeps it in memory as a Config, so
+the functions that need a setting no longer open and parse the file every
+time. The file is checked before it is used, and a setting of the wrong type
+is reported with its name instead of failing later deep inside a refresh.
+ConfigFile looks at the modification time of the file every few seconds and
+reloads it when it has changed. A file that no longer loads or checks is
+logged and the previous config is kept, and the functions subscribed to the
+config are called with the old and the new one after every reload.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import NamedTuple
+
+from recurrence import zone
+from alerts import KINDS
+from speech import BACKENDS
+
+log = logging.getLogger(__name__)
+
+POLL_SECONDS = 2  # How often config.json is checked for changes
+STARTUP_MODES = ('lazy', 'eager')
+
+
+class Config(NamedTuple):
+    """
+    The settings in config.json. data is the whole file as a dictionary,
+    for the functions that take the config as one, and must not be changed.
+    """
+    weather_api_key: str
+    news_api_key: str
+    covid_area_type: str
+    covid_area_name: str
+    weather_city_name: str
+    user_threshold_number: float
+    news_sources: str
+    time_zone: str
+    startup_mode: str
+    tts_backend: str
+    alarm_lead_seconds: float
+    providers: dict
+    users: list
+    alerts: list
+    data: dict
+
+
+def _check(data: dict, key: str, kinds, default=...):
+    """
+    The value of key in data, which has to be one of the given types. A key
+    without a default is required.
+    """
+    if key not in data:
+        if default is ...:
+            raise ValueError('config.json has no ' + key)
+        return default
+    value = data[key]
+    if isinstance(value, bool) or not isinstance(value, kinds):
+        if default is None and value is None:
+            return None
+        raise ValueError('config.json has a ' + type(value).__name__
+                         + ' for ' + key)
+    return value
+
+
+def parse_config(data: dict) -> Config:
+    """
+    Checks the dictionary loaded from config.json and builds a Config from
+    it. Raises ValueError naming the first setting that is wrong.
+    """
+    if not isinstance(data, dict):
+        raise ValueError('config.json is not an object')
+    number = (int, float)
+    config = Config(
+        weather_api_key=_check(data, 'weather_api_key', str),
+        news_api_key=_check(data, 'news_api_key', str),
+        covid_area_type=_check(data, 'covid_area_type', str),
+        covid_area_name=_check(data, 'covid_area_name', str),
+        weather_city_name=_check(data, 'weather_city_name', str),
+        user_threshold_number=_check(data, 'user_threshold_number', number),
+        news_sources=_check(data, 'news_sources', str, 'bbc-news'),
+        time_zone=_check(data, 'time_zone', str, None),
+        startup_mode=_check(data, 'startup_mode', str, 'lazy'),
+        tts_backend=_check(data, 'tts_backend', str, 'pyttsx3'),
+        alarm_lead_seconds=_check(data, 'alarm_lead_seconds', number, None),
+        providers=_check(data, 'providers', dict, {}),
+        users=_check(data, 'users', list, []),
+        alerts=_check(data, 'alerts', list, []),
+        data=data)
+    if config.startup_mode not in STARTUP_MODES:
+        raise ValueError('config.json has an unknown startup_mode '
+                         + config.startup_mode)
+    if config.tts_backend not in BACKENDS:
+        raise ValueError('config.json has an unknown tts_backend '
+                         + config.tts_backend)
+    if config.time_zone is not None:
+        try:
+            zone(config.time_zone)
+        except Exception as error:
+            raise ValueError('config.json has an unknown time_zone '
+                             + config.time_zone) from error
+    for name, settings in config.providers.items():
+        if not isinstance(settings, dict):
+            raise ValueError('config.json has a ' + type(settings).__name__
+                             + ' for the settings of provider ' + name)
+    for user in config.users:
+        if not isinstance(user, dict):
+            raise ValueError('config.json has a ' + type(user).__name__
+                             + ' in users')
+    for rule in config.alerts:
+        _check_alert(rule)
+    return config
+
+
+def _check_alert(rule: dict):
+    """
+    Checks one entry of the alerts list, which needs a metric, a kind and a
+    threshold, and can have a name, a user, a clear level, a window in days
+    and a cooldown in seconds.
+    """
+    if not isinstance(rule, dict):
+        raise ValueError('config.json has a ' + type(rule).__name__
+                         + ' in alerts')
+    number = (int, float)
+    _check(rule, 'metric', str)
+    _check(rule, 'threshold', number)
+    if _check(rule, 'kind', str) not in KINDS:
+        raise ValueError('config.json has an alert of unknown kind '
+                         + rule['kind'])
+    _check(rule, 'name', str, None)
+    _check(rule, 'user', str, None)
+    _check(rule, 'clear', number, None)
+    _check(rule, 'cooldown', number, None)
+    if _check(rule, 'window', int, 1) < 1:
+        raise ValueError('config.json has an alert with a window under 1')
+
+
+class ConfigFile:
+    """
+    The config loaded from a file, reloaded when the file changes.
+    """
+
+    def __init__(self, path: str = 'config.json',
+                 poll_seconds: float = POLL_SECONDS):
+        self.path = path
+        self.poll_seconds = poll_seconds
+        self._config = None
+        self._stamp = None
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def current(self) -> Config:
+        """
+        The config, loaded from the file the first time it is asked for.
+        Raises ValueError if the file does not check at that point.
+        """
+        config = self._config
+        if config is None:
+            with self._lock:
+                if self._config is None:
+                    self._stamp = self._read_stamp()
+                    self._config = self._load()
+                config = self._config
+        return config
+
+    def subscribe(self, callback):
+        """
+        Calls callback(old, new) with the old and the new Config after the
+        file has been reloaded.
+        """
+        self._subscribers.append(callback)
+
+    def reload(self) -> bool:
+        """
+        Reloads the file if its modification time or size has changed.
+        Returns True if a new config was loaded, and False if the file has
+        not changed or the new one did not load, which is logged.
+        """
+        with self._lock:
+            stamp = self._read_stamp()
+            if self._config is not None and stamp == self._stamp:
+                return False
+            self._stamp = stamp
+            try:
+                config = self._load()
+            except (OSError, ValueError) as error:
+                log.error('Keeping the previous config, ' + self.path
+                          + ' did not load: ' + str(error))
+                return False
+            old, self._config = self._config, config
+        if old is not None and old.data != config.data:
+            log.info('Reloaded ' + self.path)
+            for callback in self._subscribers:
+                try:
+                    callback(old, config)
+                except Exception:  # pylint: disable=broad-except
+                    log.exception('A config subscriber failed')
+        return True
+
+    def start(self):
+        """
+        Starts checking the file for changes every poll_seconds on a daemon
+        thread.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._poll, name='config',
+                                            daemon=True)
+            self._thread.start()
+
+    def _poll(self):
+        while True:
+            time.sleep(self.poll_seconds)
+            self.reload()
+
+    def _read_stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _load(self) -> Config:
+        with open(self.path, 'r') as file:
+            try:
+                data = json.load(file)
+            except json.JSONDecodeError as error:
+                raise ValueError(str(error)) from error
+        return parse_config(data)
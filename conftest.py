@@ -0,0 +1,50 @@
+"""
+Test setup shared by the whole suite. Before test_all imports the app, the
+providers in dataget are pointed at a local stub server, and BRIEFINGS_DIR
+and the working directory are set to a scratch copy of the json state files
+so a test run never overwrites the real ones, even from the threads the app
+leaves running after pytest has changed back to the directory it started
+in. The scratch config uses the silent speech backend, so the tests run on
+machines without a speech engine.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+from stub_server import StubProviders
+
+STATE_FILES = ['config.json', 'news.json', 'covid.json', 'notifications.json']
+
+stub = StubProviders()
+
+
+def pytest_configure(config):  # pylint: disable=unused-argument
+    """
+    Starts the stub server and switches into the scratch directory. The
+    app's modules are first imported here, once BRIEFINGS_DIR is set, as
+    their state files are kept in the directory it names.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    workdir = tempfile.mkdtemp(prefix='briefings-test-')
+    for name in STATE_FILES:
+        shutil.copy(os.path.join(here, name), workdir)
+    os.environ['BRIEFINGS_DIR'] = workdir
+    os.chdir(workdir)
+    with open('config.json', 'r') as conf:
+        settings = json.load(conf)
+    settings['tts_backend'] = 'null'
+    with open('config.json', 'w') as conf:
+        json.dump(settings, conf)
+    stub.start()
+    import dataget  # pylint: disable=import-outside-toplevel
+    dataget.WEATHER_URL = stub.weather_url
+    dataget.NEWS_URL = stub.news_url
+    dataget.COVID_URL = stub.covid_url
+
+
+def pytest_unconfigure(config):  # pylint: disable=unused-argument
+    """
+    Stops the stub server.
+    """
+    stub.stop()
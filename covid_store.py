@@ -0,0 +1,182 @@
+"""
+This module keeps the history of every covid metric returned by the
+coronavirus API in an SQLite table, covid.db, instead of the single case
+count that used to be written to local_covid_store.txt. Each value is one
+row keyed by area, metric and date, so a refresh only writes the values
+that are new or changed. Null values are not stored, which makes the
+newest row of a metric its latest non-null value. Rolling averages and
+growth rates are worked out by SQLite window functions over the whole
+column in one query, so alerts and notifications never re-parse the json.
+The functions subscribed to the store are told which metrics of an area
+got new values after every ingest, so alerts are checked as data arrives.
+"""
+
+import datetime
+import logging
+import sqlite3
+import threading
+
+log = logging.getLogger(__name__)
+
+WINDOW = 7
+# The number of reported days in a rolling average.
+
+TRENDS = '''
+WITH framed AS (
+    SELECT metric, date, value,
+           AVG(value) OVER recent AS average,
+           COUNT(value) OVER recent AS reported
+    FROM covid WHERE area = :area {metric_filter}
+    WINDOW recent AS (PARTITION BY metric ORDER BY date
+                      ROWS BETWEEN :preceding PRECEDING AND CURRENT ROW)
+), averaged AS (
+    SELECT metric, date, value,
+           CASE WHEN reported = :window THEN average END AS average
+    FROM framed
+)
+SELECT metric, date, value, average,
+       average / LAG(average, :window) OVER (PARTITION BY metric
+                                             ORDER BY date) - 1 AS growth,
+       ROW_NUMBER() OVER (PARTITION BY metric ORDER BY date DESC) AS age
+FROM averaged
+'''
+# The growth is the change of the rolling average over one window, so with
+# a window of 7 it is the change on the week before. The first days of a
+# history have fewer than a window of values before them, so their average,
+# and the growth that compares with it, are null rather than worked out
+# from a part of the window.
+
+
+def area_key(covid_area_type: str, covid_area_name: str) -> str:
+    """
+    The key of an area in the store.
+    """
+    return covid_area_type + '/' + covid_area_name
+
+
+def dated_rows(rows: list, last_update: str = None) -> list:
+    """
+    Returns the rows with a date. The API is asked for the date of every
+    row, but rows saved before it was are one per day, newest first, so
+    they are dated back from the day of last_update, or today.
+    """
+    if all('date' in row for row in rows):
+        return rows
+    try:
+        newest = datetime.date.fromisoformat(str(last_update)[:10])
+    except ValueError:
+        newest = datetime.date.today()
+    return [dict(row, date=row.get('date') or str(
+        newest - datetime.timedelta(days=index)))
+        for index, row in enumerate(rows)]
+
+
+class CovidStore:
+    """
+    The covid table, with one row for every area, date and metric.
+    """
+
+    def __init__(self, path: str = 'covid.db'):
+        self._lock = threading.Lock()
+        self._subscribers = []
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS covid ('
+            'area TEXT NOT NULL, metric TEXT NOT NULL, date TEXT NOT NULL, '
+            'value NUMERIC NOT NULL, PRIMARY KEY (area, metric, date)) '
+            'WITHOUT ROWID')
+        self._db.commit()
+
+    def ingest(self, area: str, rows: list, last_update: str = None) -> int:
+        """
+        Adds the numeric values of rows to the history of area, and updates
+        values that were revised. Returns the number of values written.
+        """
+        values = [(area, metric, row['date'], value)
+                  for row in dated_rows(rows, last_update)
+                  for metric, value in row.items()
+                  if isinstance(value, (int, float))
+                  and not isinstance(value, bool)]
+        with self._lock:
+            before = self._db.total_changes
+            self._db.executemany(
+                'INSERT INTO covid VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (area, metric, date) DO UPDATE '
+                'SET value = excluded.value WHERE value != excluded.value',
+                values)
+            self._db.commit()
+            written = self._db.total_changes - before
+        if written:
+            log.info(str(written) + ' covid values stored for ' + area)
+            metrics = sorted({value[1] for value in values})
+            for callback in self._subscribers:
+                try:
+                    callback(area, metrics)
+                except Exception:  # pylint: disable=broad-except
+                    log.exception('A covid store subscriber failed')
+        return written
+
+    def subscribe(self, callback):
+        """
+        Calls callback(area, metrics) after an ingest wrote values for
+        area, with the metrics of the rows ingested.
+        """
+        self._subscribers.append(callback)
+
+    def _trends(self, area: str, metric: str, window: int,
+                newest_only: bool) -> list:
+        query = TRENDS.format(
+            metric_filter='AND metric = :metric' if metric else '')
+        query = 'SELECT metric, date, value, average, growth FROM (' \
+                + query + ')' + (' WHERE age = 1' if newest_only else '') \
+                + ' ORDER BY metric, date'
+        with self._lock:
+            return self._db.execute(query, {
+                'area': area, 'metric': metric, 'window': window,
+                'preceding': window - 1}).fetchall()
+
+    def trends(self, area: str, metric: str, window: int = WINDOW) -> list:
+        """
+        The history of one metric, oldest first, as dictionaries with the
+        date, the value, the rolling average over window reported days and
+        the growth of that average on the window before.
+        """
+        return [{'date': row[1], 'value': row[2], 'average': row[3],
+                 'growth': row[4]}
+                for row in self._trends(area, metric, window, False)]
+
+    def newest(self, area: str, metric: str, window: int = WINDOW) -> dict:
+        """
+        The newest value of one metric of area with its date, rolling
+        average and growth, or None if there is none.
+        """
+        for row in self._trends(area, metric, window, True):
+            return {'date': row[1], 'value': row[2], 'average': row[3],
+                    'growth': row[4]}
+        return None
+
+    def summary(self, area: str, window: int = WINDOW) -> dict:
+        """
+        The newest non-null value of every metric of area, by metric, with
+        its date, rolling average and growth.
+        """
+        return {row[0]: {'date': row[1], 'value': row[2], 'average': row[3],
+                         'growth': row[4]}
+                for row in self._trends(area, None, window, True)}
+
+    def latest(self, area: str) -> dict:
+        """
+        The newest non-null value of every metric of area, by metric.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT metric, value, MAX(date) FROM covid WHERE area = ? '
+                'GROUP BY metric', (area,)).fetchall()
+        return {metric: value for metric, value, _ in rows}
+
+    def close(self):
+        """
+        Closes the database.
+        """
+        self._db.close()
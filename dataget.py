@@ -6,11 +6,234 @@ module.
 The news function calls the newsapi api and saves the results to a json file.
 The covid function uses the uk_covid19 SDK from Public Health England and saves
 the data in a json file.
+All three share one pooled requests session with per-provider timeouts and
+a bounded number of retries, and refresh_all runs them concurrently so a
+refresh takes as long as the slowest provider rather than the sum of all
+three. The calls go through an HTTP response cache that sends the saved
+validators, so when a provider answers 304 Not Modified, or sends back
+identical data, the json file is left alone and the provider returns
+UNCHANGED instead of its data.
+Each upstream query is made through fetch_weather, fetch_news or
+fetch_covid, which share one SharedFetcher, so when many users have the
+same city, news sources or covid area their queries are only made once.
+The three providers are registered in PROVIDERS with their refresh
+settings, which decide how often each one is called. Every upstream call
+goes through the circuit breaker of its provider, so a provider that is
+down is not waited on again until its breaker lets a probe through, and a
+payload that is not what the provider should send is never saved.
 """
 
-import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from uk_covid19 import Cov19API
+from http_cache import ResponseCache, request_key
+from shared_fetch import SharedFetcher
+from metrics import REGISTRY
+from providers import Provider, ProviderRegistry
+from breaker import CircuitBreaker, CircuitOpen
+from config import ConfigFile
+from storage import STORAGE, state_path
+
+log = logging.getLogger(__name__)
+
+WEATHER_URL = 'http://api.openweathermap.org/data/2.5/weather'
+NEWS_URL = 'https://newsapi.org/v2/top-headlines'
+COVID_URL = Cov19API.endpoint
+# The provider endpoints are module level so tests can point them at a stub.
+
+TIMEOUTS = {'weather': 5, 'news': 5, 'covid': 20}
+# Seconds to wait for each provider, used for both connect and read.
+RETRIES = 2
+POOL_SIZE = 8
+UNCHANGED = 'unchanged'
+# Returned by a provider instead of its data when nothing has changed.
+SHARED_TTL = 60
+# Seconds an upstream result is shared between users before it is fetched
+# again, no longer than the shortest time between two refreshes.
+
+
+def make_session() -> requests.Session:
+    """
+    Creates a requests session with a connection pool that is reused across
+    refreshes. Failed connections and 429 or 5xx responses are retried at
+    most RETRIES times with a short exponential backoff.
+    """
+    retry = Retry(total=RETRIES, backoff_factor=0.3,
+                  status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=frozenset(['GET']),
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE,
+                          pool_maxsize=POOL_SIZE, max_retries=retry)
+    new_session = requests.Session()
+    new_session.mount('http://', adapter)
+    new_session.mount('https://', adapter)
+    return new_session
+
+
+session = make_session()
+http_cache = ResponseCache(state_path('http_cache'))
+shared = SharedFetcher(SHARED_TTL)
+BREAKERS = {name: CircuitBreaker(name) for name in TIMEOUTS}
+
+
+CONFIG = ConfigFile(state_path('config.json'))  # Reloaded when it changes
+
+
+def load_config() -> dict:
+    """
+    Returns config.json as a dictionary. The file is read once and kept in
+    CONFIG, so the dictionary must not be changed.
+    """
+    return CONFIG.current().data
+
+
+def count_response(name: str, response):
+    """
+    Counts a CachedResponse from a provider by how it was answered, from
+    the cache, not modified or by its status code.
+    """
+    if response.from_cache:
+        result = 'cached'
+    elif response.not_modified:
+        result = 'not_modified'
+    else:
+        result = str(response.status)
+    REGISTRY.inc('provider_responses_total', provider=name, result=result)
+
+
+def fetch_json(name: str, url: str, params: dict) -> dict:
+    """
+    Makes a conditional request through the HTTP response cache, shared
+    with every other caller making the same request, and returns the json
+    body. Any status other than 200 or 304 raises an HTTPError, and
+    CircuitOpen is raised without a call while the provider is down. Each
+    call to the provider is timed, and counted by how it was answered.
+    """
+    def call():
+        with REGISTRY.timed('provider_fetch_seconds', provider=name):
+            response = http_cache.get(session, url, params=params,
+                                      timeout=TIMEOUTS[name])
+        count_response(name, response)
+        if response.body is None:
+            raise requests.HTTPError(name + ' returned '
+                                     + str(response.status))
+        return response.body
+
+    return shared.get(request_key(url, params),
+                      lambda: BREAKERS[name].call(call))
+
+
+def unless_unchanged(url: str, params: dict, data):
+    """
+    Returns data, or UNCHANGED if it is the same as the data returned for
+    the same request last time.
+    """
+    same = http_cache.unchanged(request_key(url, params), data)
+    return UNCHANGED if same else data
+
+
+def weather_params(city: str, api_key: str) -> dict:
+    """
+    The OpenWeatherMap query parameters for a city.
+    """
+    return {'q': city, 'units': 'metric', 'appid': api_key}
+
+
+def news_params(sources: str, api_key: str) -> dict:
+    """
+    The NewsAPI query parameters for a comma separated list of sources.
+    """
+    return {'sources': sources, 'apiKey': api_key}
+
+
+def fetch_weather(city: str, api_key: str) -> dict:
+    """
+    The OpenWeatherMap response for a city.
+    """
+    return fetch_json('weather', WEATHER_URL, weather_params(city, api_key))
+
+
+def fetch_news(sources: str, api_key: str) -> dict:
+    """
+    The NewsAPI top headlines response for a comma separated list of news
+    sources.
+    """
+    return fetch_json('news', NEWS_URL, news_params(sources, api_key))
+
+
+_assembled_covid = {}
+# The last full covid response for each area, reused when page 1 is a 304.
+
+
+def covid_api_params(covid_area_type: str, covid_area_name: str) -> dict:
+    """
+    The coronavirus API parameters for an area, built by the uk_covid19 SDK,
+    asking for the date and four metrics, new cases, total cases, new
+    deaths, and total deaths.
+    """
+    area_info = [
+        'areaType=' + covid_area_type,
+        'areaName=' + covid_area_name
+    ]
+    total_and_new_cases_deaths = {
+        "date": "date",
+        "newCasesByPublishDate": "newCasesByPublishDate",
+        "cumCasesByPublishDate": "cumCasesByPublishDate",
+        "newDeathsByDeathDate": "newDeathsByDeathDate",
+        "cumDeathsByDeathDate": "cumDeathsByDeathDate"
+    }
+    api_return = Cov19API(
+        filters=area_info,
+        structure=total_and_new_cases_deaths)
+    return api_return.api_params
+
+
+def fetch_covid(covid_area_type: str, covid_area_name: str) -> dict:
+    """
+    The full covid response for an area, with every page joined together,
+    fetched with the shared session the same way Cov19API.get_json does,
+    so the connection is pooled and every page has a timeout. The first
+    page is a conditional request, and if it has not been modified the
+    last full response is reused without fetching the other pages.
+    """
+    base_params = covid_api_params(covid_area_type, covid_area_name)
+    key = request_key(COVID_URL, base_params)
+
+    @REGISTRY.timed('provider_fetch_seconds', provider='covid')
+    def call():
+        params = dict(base_params, format='json', page=1)
+        first_page = http_cache.get(session, COVID_URL, params=dict(params),
+                                    timeout=TIMEOUTS['covid'])
+        count_response('covid', first_page)
+        if first_page.not_modified and key in _assembled_covid:
+            return _assembled_covid[key]
+        if first_page.status >= 400:
+            raise requests.HTTPError('covid returned '
+                                     + str(first_page.status))
+        covid_resp_json = {'data': [], 'lastUpdate': None}
+        if first_page.body is not None:
+            covid_resp_json['data'].extend(first_page.body['data'])
+            covid_resp_json['lastUpdate'] = first_page.last_modified
+            params['page'] += 1
+            while True:
+                response = session.get(COVID_URL, params=params,
+                                       timeout=TIMEOUTS['covid'])
+                response.raise_for_status()
+                if response.status_code == 204:
+                    break
+                covid_resp_json['data'].extend(response.json()['data'])
+                covid_resp_json['lastUpdate'] = \
+                    response.headers.get('Last-Modified')
+                params['page'] += 1
+        covid_resp_json['length'] = len(covid_resp_json['data'])
+        covid_resp_json['totalPages'] = params['page'] - 1
+        _assembled_covid[key] = covid_resp_json
+        return covid_resp_json
+
+    return shared.get(key, lambda: BREAKERS['covid'].call(call))
 
 
 def weather_test():
@@ -19,19 +242,13 @@ def weather_test():
     weather API, it will return the response code as an integer. This is part
     of the pytest functionality.
     """
-    with open('config.json', 'r') as conf:
-        conf = json.load(conf)
-        # Gets the API key from the config.json file
-        weather_api_key = conf["weather_api_key"]
-        weather_city_name = conf['weather_city_name']
-        response = requests.get(
-            'http://api.openweathermap.org/data/2.5/weather?'
-            'q=' +
-            weather_city_name +
-            '&units=metric&appid=' +
-            weather_api_key)
-        response_code = response.status_code
-        return response_code
+    conf = load_config()
+    response = session.get(
+        WEATHER_URL,
+        params=weather_params(conf['weather_city_name'],
+                              conf['weather_api_key']),
+        timeout=TIMEOUTS['weather'])
+    return response.status_code
 
 
 def news_test():
@@ -40,99 +257,154 @@ def news_test():
     news API, it will return the response code as an integer. This is part
     of the pytest functionality.
     """
-    with open('config.json', 'r') as cfile:
-        config = json.load(cfile)
-        news_api_key = config["news_api_key"]
-        response = requests.get("https://newsapi.org/v2/top-headlines?"
-                                "sources=bbc-news&apiKey=" + news_api_key)
-        response_code = response.status_code
-        return response_code
+    config = load_config()
+    response = session.get(
+        NEWS_URL,
+        params=news_params(config.get('news_sources', 'bbc-news'),
+                           config['news_api_key']),
+        timeout=TIMEOUTS['news'])
+    return response.status_code
 
 
-def weather():
+def weather_data_extractor(weather_json: dict) -> tuple:
+    """
+    The weather_data_extractor takes the relevant data from a weather API
+    response and returns three vaalues, the current temperature, what it
+    currently feels like, and a one-two word description of the weather.
+    A ValueError is raised for a response without them, such as an error.
     """
-    This function is responsible for weather data. There are two functions
-    nested within it, weather_api_call, and weather_data_extractor.
-    In weather_api_call the requests module is used to call the OpenWeatherMap
-    API.The API key, and requested city are taken from the config.json file.
-    This function returns nothing. The weather_data_extractor takes the
-    relevant data from the weather.json file and returns three vaalues,
-    the current temperature, what it currently feels like, and a one-two
-    word description of the weather.
+    try:
+        temp = weather_json["main"]
+        weather_item = weather_json["weather"]
+        desc = weather_item[0]
+        current_temperature = "The current temperature is: " + \
+            str(int(temp["temp"])) + "C"
+        current_feels_like = "Feels like: " + \
+            str(int(temp["feels_like"])) + "C"
+        forecast = desc["main"]
+    except (KeyError, IndexError, TypeError) as error:
+        raise ValueError('Not a weather report: ' + str(
+            weather_json.get('message') if isinstance(weather_json, dict)
+            else weather_json)[:200]) from error
+    return current_feels_like, current_temperature, forecast
+
+
+def last_known_weather() -> tuple:
+    """
+    Extracts the weather from the weather.json file saved by the last
+    successful call, without calling the API. Returns an empty tuple if
+    there is no usable saved response.
+    """
+    try:
+        return weather_data_extractor(
+            STORAGE.read(state_path('weather.json')))
+    except (OSError, ValueError, KeyError, IndexError):
+        return ()
+
+
+def weather(config=None):
+    """
+    This function is responsible for weather data. There is a function
+    nested within it, weather_api_call, in which the shared session is used
+    to call the OpenWeatherMap API.The API key, and requested city are taken
+    from the config.json file, unless a config dictionary is passed in. The
+    temperature, feels like and description are extracted first, so a
+    response without them raises ValueError and is never saved. If the
+    weather has changed, the response is saved to the weather.json file and
+    the extracted weather returned. Otherwise UNCHANGED is returned.
     """
     def weather_api_call():
-        with open('config.json', 'r') as conf:
-            conf = json.load(conf)
-            # Gets the API key from the config.json file
-            weather_api_key = conf["weather_api_key"]
-            weather_city_name = conf['weather_city_name']
-            response = requests.get(
-                'http://api.openweathermap.org/data/2.5/weather?'
-                'q=' + weather_city_name + '&units=metric&appid=' + weather_api_key)
-            resp_json = response.json()
-            with open('weather.json', 'w') as outfile:
-                # Uses the data from the API to overwrite the weather data
-                json.dump(resp_json, outfile)
-                outfile.close()
-
-    def weather_data_extractor():
-        with open('weather.json', 'r') as weather_json:
-            weather_json = json.load(weather_json)
-            temp = weather_json["main"]
-            weather_item = weather_json["weather"]
-            desc = weather_item[0]
-            current_temperature = "The current temperature is: " + \
-                str(int(temp["temp"])) + "C"
-            current_feels_like = "Feels like: " + \
-                str(int(temp["feels_like"])) + "C"
-            forecast = desc["main"]
-            return current_feels_like, current_temperature, forecast
-
-    weather_api_call()
-    return weather_data_extractor()
-
-
-def news():
-    """
-    The news function here also utilizes the requests module in order to call
+        conf = config or load_config()
+        # Gets the API key from the config.json file
+        params = weather_params(conf['weather_city_name'],
+                                conf['weather_api_key'])
+        resp_json = fetch_json('weather', WEATHER_URL, params)
+        extracted = weather_data_extractor(resp_json)
+        if unless_unchanged(WEATHER_URL, params, resp_json) is UNCHANGED:
+            return UNCHANGED
+        # Uses the data from the API to overwrite the weather data
+        STORAGE.write(state_path('weather.json'), resp_json)
+        return extracted
+
+    return weather_api_call()
+
+
+def news(config=None) -> dict:
+    """
+    The news function here also utilizes the shared session in order to call
     the NewsAPI API for top headlines. The API key is also derived from the
-    config.json file. The data the API returns is added to the news.json file.
+    config.json file. If the headlines have changed, the data the API returns
+    is added to the news.json file and returned, otherwise UNCHANGED is. A
+    response without a list of articles raises ValueError and is not saved.
     """
-    with open('config.json', 'r') as cfile:
-        config = json.load(cfile)
-        news_api_key = config["news_api_key"]
-        response = requests.get("https://newsapi.org/v2/top-headlines?"
-                                "sources=bbc-news&apiKey=" + news_api_key)
-        resp_json = response.json()
-        with open("news.json", 'w') as file:
-            json.dump(resp_json, file)
-            file.close()
+    config = config or load_config()
+    params = news_params(config.get('news_sources', 'bbc-news'),
+                         config['news_api_key'])
+    resp_json = fetch_json('news', NEWS_URL, params)
+    if not isinstance(resp_json, dict) \
+            or not isinstance(resp_json.get('articles'), list):
+        raise ValueError('Not a list of headlines: ' + str(resp_json)[:200])
+    resp_json = unless_unchanged(NEWS_URL, params, resp_json)
+    if resp_json is not UNCHANGED:
+        STORAGE.write(state_path('news.json'), resp_json)
+    return resp_json
 
 
-def get_national_covid_json():
+def get_national_covid_json(config=None) -> dict:
     """
     This function uses the uk_covid19 module provided by Public Health England.
     The function uses the config.json file to set the areaType and areaName,
     and default values are set to the nation of England. The API returns a list
     of dictionaries with four metrics, new cases, total cases, new deaths,
-    and total deaths. All of this is saved to a file named covid.json.
+    and total deaths, which fetch_covid gets page by page. If the data is the
+    same as last time UNCHANGED is returned. Otherwise all of this is saved to
+    a file named covid.json.
     """
-    with open('config.json', 'r') as file:
-        file2 = json.load(file)
-        covid_area_type = file2['covid_area_type']
-        covid_area_name = file2['covid_area_name']
-    area_info = [
-        'areaType=' + covid_area_type,
-        'areaName=' + covid_area_name
-    ]
-    total_and_new_cases_deaths = {
-        "newCasesByPublishDate": "newCasesByPublishDate",
-        "cumCasesByPublishDate": "cumCasesByPublishDate",
-        "newDeathsByDeathDate": "newDeathsByDeathDate",
-        "cumDeathsByDeathDate": "cumDeathsByDeathDate"
-    }
-    api_return = Cov19API(
-        filters=area_info,
-        structure=total_and_new_cases_deaths)
-    covid_resp_json = api_return.get_json(save_as='covid.json')
+    file2 = config or load_config()
+    covid_area_type = file2['covid_area_type']
+    covid_area_name = file2['covid_area_name']
+    covid_resp_json = fetch_covid(covid_area_type, covid_area_name)
+    if unless_unchanged(COVID_URL,
+                        covid_api_params(covid_area_type, covid_area_name),
+                        covid_resp_json['data']) is UNCHANGED:
+        return UNCHANGED
+    STORAGE.write(state_path('covid.json'), covid_resp_json,
+                  separators=(',', ':'))
     return covid_resp_json
+
+
+PROVIDERS = ProviderRegistry([
+    Provider('weather', weather, ttl=1800, min_interval=60, alarm_ttl=600,
+             title='The weather'),
+    Provider('news', news, ttl=3600, min_interval=300, alarm_ttl=1200,
+             title='The news'),
+    Provider('covid', get_national_covid_json, ttl=6 * 3600,
+             min_interval=600, always=True, title='The covid data'),
+])
+# Weather goes stale within the hour, the covid figures change about daily.
+
+
+def refresh_all(names=None) -> dict:
+    """
+    Fetches every provider in names, or all of them by default, at the same
+    time on a small thread pool. config.json is read once and handed to each
+    provider. Returns a dictionary of provider name to result, which is
+    UNCHANGED for a provider whose data has not changed. A provider that
+    raised is logged and left out so the others are still used. The
+    outcome of each one is recorded in PROVIDERS.
+    """
+    names = list(names or PROVIDERS)
+    config = load_config()
+    results = {}
+    with ThreadPoolExecutor(max_workers=len(names)) as pool:
+        futures = {name: pool.submit(PROVIDERS[name].fetch, config)
+                   for name in names}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except CircuitOpen as error:
+                log.warning(str(error))
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Refreshing ' + name + ' failed')
+            PROVIDERS.record(name, name in results)
+    return results
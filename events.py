@@ -0,0 +1,176 @@
+"""
+This module is the push channel behind the /events route. Instead of every
+open page reloading /index once a minute, the app publishes an event when
+something on the page changes, a notification added or dismissed or an
+alarm added, fired or cancelled, and each page listens for the events of
+its own user with server-sent events. An idle page costs one waiting thread
+on the server and nothing else.
+
+Events are numbered in the order they are published and the most recent
+ones are kept in a ring, so a page that reconnects with the Last-Event-ID
+header gets the events it missed. Every process serving the website has its
+own numbering, so an event id starts with the epoch of the process that
+gave it. A page that was away for longer than the ring covers, or whose id
+is from another process or from before a restart, is sent a snapshot of
+everything it shows instead, and carries on from there.
+"""
+
+import collections
+import json
+import threading
+import uuid
+from typing import NamedTuple
+
+HISTORY = 256
+# The number of recent events kept for pages that reconnect.
+HOUSEHOLD = ''
+# The channel of the household page, which has no user.
+
+
+class Event(NamedTuple):
+    """
+    One change, published on the channel of the user whose page shows it.
+    """
+    event_id: int
+    channel: str
+    kind: str
+    data: object
+
+    def sse(self, epoch: str) -> str:
+        """
+        The event in the text/event-stream format, with its id tagged with
+        the epoch of the bus that published it.
+        """
+        return ('id: ' + epoch + '-' + str(self.event_id)
+                + '\nevent: ' + self.kind
+                + '\ndata: ' + json.dumps(self.data, separators=(',', ':'))
+                + '\n\n')
+
+
+def notification_changes(old: tuple, new: tuple) -> list:
+    """
+    The notification_added and notification_removed events that turn the
+    old list of notifications into the new one, as (kind, data) pairs. A
+    notification whose content changed is removed and added again.
+    """
+    old_by_key = {entry['key']: entry for entry in old}
+    new_by_key = {entry['key']: entry for entry in new}
+    changes = [('notification_removed', {'key': key})
+               for key, entry in old_by_key.items()
+               if new_by_key.get(key) != entry]
+    changes.extend(
+        ('notification_added', {
+            'key': entry['key'], 'title': entry['title'],
+            'content': str(entry['content']),
+            'before': new[index + 1]['key'] if index + 1 < len(new) else None})
+        for index, entry in enumerate(new)
+        if old_by_key.get(entry['key']) != entry)
+    return changes
+
+
+def snapshot_changes(old, new) -> list:
+    """
+    The events for the difference between two briefing snapshots, as
+    (kind, data) pairs. Only the notifications are on the page, so the
+    other fields of a snapshot do not publish anything.
+    """
+    return notification_changes(old.notifications, new.notifications)
+
+
+class EventBus:
+    """
+    Publishes numbered events and lets any number of threads wait for the
+    events of a channel after a given id.
+    """
+
+    def __init__(self, history: int = HISTORY):
+        self.epoch = uuid.uuid4().hex[:8]
+        self.last_id = 0
+        self.listeners = 0
+        self._events = collections.deque(maxlen=history)
+        self._cond = threading.Condition()
+
+    def publish(self, channel: str, kind: str, data=None) -> Event:
+        """
+        Adds an event to the channel and wakes every waiting listener.
+        """
+        with self._cond:
+            self.last_id += 1
+            event = Event(self.last_id, channel or HOUSEHOLD, kind, data)
+            self._events.append(event)
+            self._cond.notify_all()
+        return event
+
+    def token(self, event_id: int) -> str:
+        """
+        The id of an event as it is sent to a page.
+        """
+        return self.epoch + '-' + str(event_id)
+
+    def parse(self, token: str) -> int:
+        """
+        The event number in an id sent by this bus, or None for an id from
+        another process, from before a restart, or one that is not valid.
+        """
+        epoch, _, number = str(token).partition('-')
+        if epoch != self.epoch or not number.isdigit():
+            return None
+        return int(number)
+
+    def since(self, after_id: int, channel: str) -> list:
+        """
+        The events of the channel after after_id, or a single reload event
+        if some of them are no longer kept, or the id is from before the
+        app was restarted.
+        """
+        channel = channel or HOUSEHOLD
+        with self._cond:
+            if after_id > self.last_id or (
+                    self._events
+                    and after_id < self._events[0].event_id - 1):
+                return [Event(self.last_id, channel, 'reload', None)]
+            return [event for event in self._events
+                    if event.event_id > after_id
+                    and event.channel == channel]
+
+    def wait(self, after_id: int, channel: str, timeout: float) -> list:
+        """
+        Like since, but blocks for up to timeout seconds until there is an
+        event for the channel. Returns an empty list on timeout.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self.since(after_id, channel),
+                                timeout)
+            return self.since(after_id, channel)
+
+    def stream(self, after_id: int, channel: str, heartbeat: float = 15.0,
+               snapshot=None):
+        """
+        Yields the events of the channel as server-sent events, forever,
+        with a comment every heartbeat seconds so proxies keep the
+        connection open. The number of open streams is kept in listeners.
+        An after_id of None is an id this bus did not give. Where the page
+        would be told to reload, it is sent a snapshot event instead, with
+        the data snapshot(channel) returns, if snapshot is given.
+        """
+        with self._cond:
+            self.listeners += 1
+        try:
+            while True:
+                if after_id is None:
+                    events = [Event(self.last_id, channel or HOUSEHOLD,
+                                    'reload', None)]
+                else:
+                    events = self.wait(after_id, channel, heartbeat)
+                if not events:
+                    yield ': keep-alive\n\n'
+                    continue
+                if events[0].kind == 'reload' and snapshot is not None:
+                    events = [events[0]._replace(
+                        kind='snapshot', data=snapshot(channel))]
+                for event in events:
+                    yield event.sse(self.epoch)
+                after_id = events[-1].event_id
+        finally:
+            with self._cond:
+                self.listeners -= 1
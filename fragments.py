@@ -0,0 +1,76 @@
+"""
+This module keeps rendered pieces of the website in memory, so the /index
+route does not render the same html again on every request. Every alarm and
+notification card is rendered once for its content and kept as a fragment,
+and the whole page is kept for the versions of the data it was built from,
+with a gzipped copy to send to the browsers that accept it. A fragment is
+keyed by what it shows, so a card whose content changes is simply rendered
+under a new key, and the least recently used ones are dropped once there
+are more than max_entries.
+"""
+
+import gzip
+import threading
+from collections import OrderedDict
+
+GZIP_LEVEL = 6
+
+
+class FragmentCache:
+    """
+    An LRU cache of rendered fragments by key.
+    """
+
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, render):
+        """
+        The fragment for key, rendered by calling render if it is not kept.
+        Two threads may render the same missing fragment, and the second
+        one keeps its copy.
+        """
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self.misses += 1
+        fragment = render()
+        with self._lock:
+            self._entries[key] = fragment
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return fragment
+
+    def clear(self):
+        """
+        Drops every fragment, for example after the templates changed.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def metrics(self) -> dict:
+        """
+        The number of fragments kept, and the hits and misses so far.
+        """
+        return {'entries': len(self._entries), 'hits': self.hits,
+                'misses': self.misses}
+
+
+class Page:
+    """
+    A rendered page as utf-8 bytes, and gzipped.
+    """
+
+    def __init__(self, html: str):
+        self.body = html.encode('utf-8')
+        self.gzipped = gzip.compress(self.body, GZIP_LEVEL)
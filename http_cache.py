@@ -0,0 +1,140 @@
+"""
+This module is an HTTP response cache for the provider calls in dataget.
+For every request it keeps the ETag and Last-Modified validators and the
+body of the last response, and sends them back as If-None-Match and
+If-Modified-Since, so a provider can answer 304 Not Modified instead of
+sending the whole payload again. A response with a Cache-Control max-age
+is reused without a request at all until it expires. It also keeps a digest
+of the data from each request, so a refresh that returns identical content can
+be told apart from one that changed something.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import NamedTuple
+from storage import STORAGE
+
+log = logging.getLogger(__name__)
+
+MAX_AGE = re.compile(r'max-age=(\d+)')
+
+
+class CachedResponse(NamedTuple):
+    """
+    The result of ResponseCache.get. not_modified is True when the body is
+    the cached one, either because the provider answered 304 or because the
+    cached response had not expired yet, in which case from_cache is True.
+    """
+    status: int
+    body: object
+    not_modified: bool
+    from_cache: bool
+    last_modified: str = None
+
+
+def freshness(headers) -> float:
+    """
+    The number of seconds a response may be reused for without asking the
+    provider again, from its Cache-Control header.
+    """
+    cache_control = headers.get('Cache-Control', '')
+    if 'no-cache' in cache_control or 'no-store' in cache_control:
+        return 0
+    match = MAX_AGE.search(cache_control)
+    return int(match.group(1)) if match else 0
+
+
+def request_key(url: str, params: dict = None) -> str:
+    """
+    The cache key of a request, its url and sorted query parameters.
+    """
+    return url + '?' + json.dumps(sorted((params or {}).items()))
+
+
+class ResponseCache:
+    """
+    Keeps one json file per request in directory, named after a hash of the
+    request key, which is read the first time that request is made.
+    """
+
+    def __init__(self, directory: str = 'http_cache'):
+        self.directory = directory
+        self._entries = {}
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + '.json')
+
+    def _entry(self, key: str) -> dict:
+        with self._lock:
+            if key not in self._entries:
+                try:
+                    with open(self._path(key), 'r') as saved:
+                        self._entries[key] = json.load(saved)
+                except (OSError, ValueError):
+                    self._entries[key] = None
+            return self._entries[key]
+
+    def _save(self, key: str, entry: dict):
+        with self._lock:
+            self._entries[key] = entry
+            os.makedirs(self.directory, exist_ok=True)
+            STORAGE.write(self._path(key), entry, separators=(',', ':'))
+
+    def get(self, session, url: str, params: dict = None,
+            timeout: float = None) -> CachedResponse:
+        """
+        Makes a conditional GET request with session and returns the json
+        body, from the cache if the provider says it has not been modified.
+        Responses that are not json or not 200 are returned but not cached.
+        """
+        key = request_key(url, params)
+        entry = self._entry(key)
+        if entry and entry['expires_at'] > time.time():
+            return CachedResponse(200, entry['body'], True, True,
+                                  entry.get('last_modified'))
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        response = session.get(url, params=params, headers=headers,
+                               timeout=timeout)
+        if response.status_code == 304 and entry:
+            entry = dict(entry, expires_at=time.time()
+                         + freshness(response.headers))
+            with self._lock:
+                self._entries[key] = entry
+            return CachedResponse(304, entry['body'], True, False,
+                                  entry.get('last_modified'))
+        if response.status_code != 200:
+            return CachedResponse(response.status_code, None, False, False)
+        body = response.json()
+        if 'no-store' not in response.headers.get('Cache-Control', ''):
+            self._save(key, {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'expires_at': time.time() + freshness(response.headers),
+                'body': body,
+            })
+        return CachedResponse(200, body, False, False,
+                              response.headers.get('Last-Modified'))
+
+    def unchanged(self, key: str, data) -> bool:
+        """
+        Compares a digest of data with the digest from the last call for
+        key, and remembers the new one. Returns True if they are the same.
+        """
+        digest = hashlib.sha256(json.dumps(
+            data, sort_keys=True).encode('utf-8')).hexdigest()
+        with self._lock:
+            same = self._digests.get(key) == digest
+            self._digests[key] = digest
+        return same
@@ -0,0 +1,119 @@
+"""
+This module reads the items of one array in a large json file without
+loading the whole document. The file is read in chunks and the top level
+object is walked key by key. The values of other keys are decoded and
+dropped, and the items of the wanted array are decoded one at a time, so
+reading the newest few rows of covid.json, which lists the newest first,
+stops after those rows instead of parsing the whole history.
+"""
+
+import json
+from itertools import islice
+
+CHUNK_SIZE = 65536
+WHITESPACE = ' \t\n\r'
+
+_decoder = json.JSONDecoder()
+
+
+class _Reader:
+    """
+    A buffer over a text file that decodes one json value at a time,
+    reading more of the file whenever a value runs past the buffer.
+    """
+
+    def __init__(self, ofile, chunk_size: int):
+        self.file = ofile
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        chunk = self.file.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """
+        Skips whitespace and returns the next character, or '' at the end.
+        """
+        while True:
+            while self.pos < len(self.buffer) \
+                    and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self._fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, chars: str) -> str:
+        """
+        Consumes the next character, which must be one of chars.
+        """
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError('Expected one of ' + repr(chars) + ' but found '
+                             + repr(char))
+        self.pos += 1
+        return char
+
+    def value(self):
+        """
+        Decodes the next json value. A value that ends exactly at the end
+        of the buffer may be a cut off number, so more is read first.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.eof or not self._fill():
+                    raise
+                continue
+            if end == len(self.buffer) and not self.eof and self._fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_items(path: str, key: str, fields: tuple = None,
+               chunk_size: int = CHUNK_SIZE):
+    """
+    Yields the items of the array under key in the top level object of the
+    json file at path, in order. With fields, each item is a dictionary
+    with only those fields. Yields nothing if there is no such key.
+    """
+    with open(path, 'r') as ofile:
+        reader = _Reader(ofile, chunk_size)
+        reader.expect('{')
+        if reader.peek() == '}':
+            return
+        while True:
+            name = reader.value()
+            reader.expect(':')
+            if name == key and reader.peek() == '[':
+                reader.expect('[')
+                if reader.peek() == ']':
+                    return
+                while True:
+                    item = reader.value()
+                    if fields is not None:
+                        item = {field: item.get(field) for field in fields}
+                    yield item
+                    if reader.expect(',]') == ']':
+                        return
+            reader.value()
+            if reader.expect(',}') == '}':
+                return
+
+
+def first_items(path: str, key: str, count: int, fields: tuple = None,
+                chunk_size: int = CHUNK_SIZE) -> list:
+    """
+    The first count items of the array under key, read without parsing
+    the rest of the file.
+    """
+    return list(islice(iter_items(path, key, fields, chunk_size), count))
@@ -0,0 +1,68 @@
+"""
+This module picks one leader among the processes serving the website, for
+example the workers of gunicorn. The leader is the process that holds an
+exclusive lock on leader.lock, and only it runs the hourly refresh, the
+covid check and the alarm dispatcher, so the providers are asked once per
+refresh and an alarm goes off once however many workers there are. The
+operating system lets go of the lock when the leader exits, and the next
+worker to try takes over.
+"""
+
+import logging
+import os
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+log = logging.getLogger(__name__)
+
+
+class Leader:
+    """
+    A non-blocking lock on a file. try_acquire can be called as often as
+    needed, and is true from the call that took the lock onwards.
+    """
+
+    def __init__(self, path: str = 'leader.lock'):
+        self.path = path
+        self.is_leader = False
+        self._file = None
+
+    def try_acquire(self) -> bool:
+        """
+        Takes the lock if no other process holds it. Returns True if this
+        process is the leader.
+        """
+        if self.is_leader:
+            return True
+        if self._file is None:
+            self._file = open(self.path, 'a+')
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(),
+                            fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.write(str(os.getpid()))
+        self._file.flush()
+        self.is_leader = True
+        log.info('Process ' + str(os.getpid()) + ' is the leader')
+        return True
+
+    def release(self):
+        """
+        Lets go of the lock so another process can lead.
+        """
+        if self._file is None:
+            return
+        self._file.close()  # Closing the file releases the lock.
+        self._file = None
+        self.is_leader = False
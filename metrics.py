@@ -0,0 +1,162 @@
+"""
+This module collects counters and latency histograms from the hot paths of
+the app, the /index route, the provider fetches, text-to-speech and the
+scheduled jobs, and renders them in the Prometheus text format for the
+/metrics route. Everything is kept in memory in one Registry, REGISTRY,
+and recording a value only takes a lock for as long as a few additions.
+"""
+
+import functools
+import threading
+import time
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           30.0)
+# The upper bounds in seconds of the histogram buckets, the last bucket
+# being everything above them.
+
+
+def label_text(labels: tuple) -> str:
+    """
+    The labels of a series as they are written after its name.
+    """
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"')
+        + '"' for name, value in labels) + '}'
+
+
+class Registry:
+    """
+    Holds every counter and histogram by name, each with one series for
+    every set of labels it has been recorded with.
+    """
+
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name: str, text: str):
+        """
+        Sets the help text written above a metric.
+        """
+        self._help[name] = text
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        """
+        Adds amount to the counter name with the given labels.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name: str, seconds: float, **labels):
+        """
+        Records one duration in the histogram name with the given labels.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                index = i
+                break
+        with self._lock:
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = \
+                    [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += seconds
+
+    def timed(self, name: str, **labels):
+        """
+        Times a block of code, or every call of a function when used as a
+        decorator, into the histogram name. A call that raises is recorded
+        too, and also counted in a counter named like the histogram with
+        _errors_total in place of _seconds.
+        """
+        return Timer(self, name, labels)
+
+    def value(self, name: str, **labels) -> float:
+        """
+        The current value of a counter, or the number of observations in a
+        histogram.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key in self._histograms:
+                return sum(self._histograms[key][0])
+            return self._counters.get(key, 0)
+
+    def render(self) -> str:
+        """
+        Every metric in the Prometheus text exposition format.
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(series[0]), series[1])
+                          for key, series in self._histograms.items()}
+        lines = []
+        for kind, series in (('counter', counters),
+                             ('histogram', histograms)):
+            for name in sorted({name for name, _ in series}):
+                if name in self._help:
+                    lines.append('# HELP ' + name + ' ' + self._help[name])
+                lines.append('# TYPE ' + name + ' ' + kind)
+                for key in sorted(key for key in series if key[0] == name):
+                    if kind == 'counter':
+                        lines.append(name + label_text(key[1]) + ' '
+                                     + repr(float(series[key])))
+                        continue
+                    counts, total = series[key]
+                    running = 0
+                    bounds = [repr(bound) for bound in self.buckets] + ['+Inf']
+                    for bound, count in zip(bounds, counts):
+                        running += count
+                        lines.append(name + '_bucket' + label_text(
+                            key[1] + (('le', bound),)) + ' ' + str(running))
+                    lines.append(name + '_sum' + label_text(key[1]) + ' '
+                                 + repr(total))
+                    lines.append(name + '_count' + label_text(key[1]) + ' '
+                                 + str(running))
+        return '\n'.join(lines) + '\n'
+
+
+class Timer:
+    """
+    The context manager and decorator returned by Registry.timed.
+    """
+
+    def __init__(self, registry: Registry, name: str, labels: dict):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self._started = threading.local()
+
+    def __enter__(self):
+        self._started.__dict__.setdefault('stack', []).append(
+            time.perf_counter())
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        seconds = time.perf_counter() - self._started.stack.pop()
+        self.registry.observe(self.name, seconds, **self.labels)
+        if error_type is not None:
+            self.registry.inc(self.name.rsplit('_seconds', 1)[0]
+                              + '_errors_total', **self.labels)
+        return False
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        return wrapper
+
+
+REGISTRY = Registry()
+# The registry shared by every module of the app.
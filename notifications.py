@@ -0,0 +1,238 @@
+"""
+This module builds the notifications shown on the right of the website.
+Each notification has a key, the url for a news article or 'covid' for the
+covid update, and the NotificationBuilder compares the newest articles and
+covid data with the notifications it already has by key. Only new, changed
+or retired notifications are touched, and notifications.json is only
+rewritten when something changed. Dismissed notifications are kept in a
+separate index, dismissed.json, with the time the dismissal runs out.
+When several processes serve the website, a builder reads either file
+again if another process has rewritten it.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from markupsafe import Markup, escape
+from storage import STORAGE
+
+log = logging.getLogger(__name__)
+
+COVID_KEY = 'covid'
+DISMISS_SECONDS = 3600
+
+
+def write_json_atomically(path: str, data, **kwargs):
+    """
+    Saves data to path with the storage engine, so a reader on another
+    thread never sees a half written file. Returns the generation written.
+    """
+    return STORAGE.write(path, data, **kwargs)
+
+
+def with_markup(entries: list) -> list:
+    """
+    Copies notifications for the template, with the content marked as safe
+    html.
+    """
+    return [{'key': entry['key'], 'title': entry['title'],
+             'content': Markup(entry['content'])} for entry in entries]
+
+
+def article_key(article: dict) -> str:
+    """
+    The key of a news article, its url, or a hash of its title if it has
+    no url.
+    """
+    return article.get('url') or hashlib.sha1(
+        str(article.get('title')).encode('utf-8')).hexdigest()
+
+
+def article_notification(article: dict) -> dict:
+    """
+    The notification for a news article, its title and a link to it with
+    the description as the text. The url and description are escaped so an
+    article can not inject html into the page.
+    """
+    return {
+        'key': article_key(article),
+        'title': article['title'],
+        'content': "<a href='" + str(escape(article['url'])) + "'>"
+                   + str(escape(article['description'] or '')) + '</a>',
+    }
+
+
+def covid_notification(covid_summary: dict) -> dict:
+    """
+    The covid update notification, from the summary of an area in the covid
+    store. The uk_covid19 module can return updates where the deaths display
+    as null or None, for the past few days, but the store only keeps
+    numbers, so each figure is the latest one that is not null. The 7 day
+    average of new cases and its change on the week before are added when
+    there is enough history for them.
+    """
+    def latest(metric):
+        return str(covid_summary.get(metric, {}).get('value'))
+
+    content = "Today's New Cases: " + latest('newCasesByPublishDate') \
+        + '\tTotal Cases: ' + latest('cumCasesByPublishDate') \
+        + "\nToday's New Deaths: " + latest('newDeathsByDeathDate') \
+        + '\nTotal Deaths: ' + latest('cumDeathsByDeathDate')
+    cases = covid_summary.get('newCasesByPublishDate')
+    if cases and cases['growth'] is not None:
+        content += '\n7 Day Average Cases: ' + str(round(cases['average'])) \
+            + (' (up ' if cases['growth'] >= 0 else ' (down ') \
+            + str(round(abs(cases['growth']) * 100, 1)) \
+            + '% on the week before)'
+    return {
+        'key': COVID_KEY,
+        'title': 'Coronavirus Data Update',
+        'content': content,
+    }
+
+
+class NotificationBuilder:
+    """
+    Holds the current notifications in memory, in the order they are shown,
+    with the covid update first and then the articles in the order the news
+    API returned them. The files are read when the builder is made, and
+    again only when their modification time changes.
+    """
+
+    def __init__(self, path: str = 'notifications.json',
+                 dismissed_path: str = 'dismissed.json',
+                 dismiss_seconds: int = DISMISS_SECONDS):
+        self.path = path
+        self.dismissed_path = dismissed_path
+        self.dismiss_seconds = dismiss_seconds
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._dismissed = {}
+        self._mtimes = {}
+        self._reload()
+
+    def _changed(self, path: str) -> bool:
+        """
+        True if the file at path was written since it was last read or
+        saved by this builder.
+        """
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if self._mtimes.get(path, -1) == mtime:
+            return False
+        self._mtimes[path] = mtime
+        return True
+
+    def _reload(self):
+        """
+        Reads the notifications and the dismissals again if another process
+        rewrote them. The caller holds the lock, or is the constructor.
+        """
+        if self._changed(self.path):
+            try:
+                with open(self.path, 'r') as notif:
+                    self._entries = {}
+                    for entry in json.load(notif):
+                        key = entry.get('key') or article_key(entry)
+                        self._entries[key] = dict(entry, key=key)
+            except (OSError, ValueError):
+                log.info('No saved notifications in ' + self.path)
+        if self._changed(self.dismissed_path):
+            try:
+                with open(self.dismissed_path, 'r') as dismissed:
+                    self._dismissed = json.load(dismissed)
+            except (OSError, ValueError):
+                self._dismissed = {}
+
+    def update(self, articles: list = None,
+               covid_summary: dict = None) -> bool:
+        """
+        Brings the notifications in line with the given articles and the
+        summary of the covid area from the covid store. Either can be left
+        out to keep the current notifications of that kind. The
+        notifications are only saved if any were added, changed or retired,
+        in which case True is returned.
+        """
+        with self._lock:
+            self._reload()
+            covid = self._entries.get(COVID_KEY)
+            if covid_summary:
+                covid = covid_notification(covid_summary)
+            if articles is None:
+                news = [entry for key, entry in self._entries.items()
+                        if key != COVID_KEY]
+            else:
+                news = [article_notification(article)
+                        for article in articles]
+            entries = {entry['key']: entry
+                       for entry in ([covid] if covid else []) + news}
+            if entries == self._entries \
+                    and list(entries) == list(self._entries):
+                return False
+            added = entries.keys() - self._entries.keys()
+            retired = self._entries.keys() - entries.keys()
+            log.info(str(len(added)) + ' notifications added, '
+                     + str(len(retired)) + ' retired')
+            self._entries = entries
+            for key in retired:
+                self._dismissed.pop(key, None)
+            write_json_atomically(self.path, list(entries.values()),
+                                  separators=(',', ':'))
+            self._changed(self.path)
+            if retired:
+                self._save_dismissed()
+            return True
+
+    def dismiss(self, key_or_title: str, now: float = None) -> bool:
+        """
+        Hides the notification with the given key, or title, for
+        dismiss_seconds. Dismissing it again while it is hidden changes
+        nothing. Returns False if there is no such notification.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            self._reload()
+            for key, entry in self._entries.items():
+                if key_or_title in (key, entry['title']):
+                    if self._dismissed.get(key, 0) > now:
+                        return True
+                    self._dismissed[key] = now + self.dismiss_seconds
+                    self._save_dismissed()
+                    return True
+        return False
+
+    def expire(self, now: float = None) -> bool:
+        """
+        Forgets dismissals that have run out. Returns True if any did, as
+        those notifications are shown again.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            self._reload()
+            expired = [key for key, until in self._dismissed.items()
+                       if until <= now]
+            for key in expired:
+                del self._dismissed[key]
+            if expired:
+                self._save_dismissed()
+            return bool(expired)
+
+    def visible(self, now: float = None) -> list:
+        """
+        The notifications that are not currently dismissed, in order.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            self._reload()
+            return [entry for key, entry in self._entries.items()
+                    if self._dismissed.get(key, 0) <= now]
+
+    def _save_dismissed(self):
+        write_json_atomically(self.dismissed_path, self._dismissed,
+                              separators=(',', ':'))
+        self._changed(self.dismissed_path)
@@ -0,0 +1,157 @@
+"""
+This module decides when each data provider is refreshed. Every provider is
+registered with the function that fetches, parses and saves its data, how
+long its data stays fresh, how fresh it has to be when an alarm that uses
+it goes off, and the shortest time allowed between two calls to it. The
+scheduler asks the registry which providers are due every minute or so
+instead of refreshing everything once an hour. A provider is refreshed when
+its data is older than its ttl and someone is looking at the website, or
+just before an alarm that announces it, and a provider that failed is
+retried after a backoff that doubles with every failure in a row.
+"""
+
+import threading
+import time
+from typing import NamedTuple, Callable
+
+LEAD_SECONDS = 900
+# How long before an alarm its providers are brought up to date.
+RETRY_SECONDS = 60
+# The wait before the first retry of a provider that failed.
+
+
+class Provider(NamedTuple):
+    """
+    A data provider. The fetch function takes the config dictionary. An
+    alarm_ttl of None means no alarm announces the provider's data, and a
+    provider that is always needed is refreshed even when nobody is looking,
+    like the covid data behind the case alerts. The title names the data on
+    the website.
+    """
+    name: str
+    fetch: Callable
+    ttl: float
+    min_interval: float = 60
+    alarm_ttl: float = None
+    always: bool = False
+    title: str = None
+
+
+class ProviderState:
+    """
+    When a provider was last called and last answered, and how many times
+    in a row it has failed.
+    """
+
+    def __init__(self):
+        self.last_attempt = None
+        self.last_success = None
+        self.failures = 0
+
+
+class ProviderRegistry:
+    """
+    The registered providers with the refresh state of each, and the lead
+    time in seconds before an alarm at which its providers are refreshed.
+    """
+
+    def __init__(self, providers=(), lead: float = LEAD_SECONDS):
+        self.lead = lead
+        self._providers = {}
+        self._defaults = {}
+        self._state = {}
+        self._lock = threading.Lock()
+        for provider in providers:
+            self.register(provider)
+
+    def register(self, provider: Provider):
+        """
+        Adds a provider, or replaces the one with the same name.
+        """
+        with self._lock:
+            self._providers[provider.name] = provider
+            self._defaults[provider.name] = provider
+            self._state.setdefault(provider.name, ProviderState())
+
+    def configure(self, settings: dict):
+        """
+        Overrides the ttl, min_interval, alarm_ttl or always settings of
+        providers from a dictionary of settings by provider name, such as
+        the providers section of config.json. A provider left out of the
+        settings goes back to the settings it was registered with.
+        """
+        settings = settings or {}
+        with self._lock:
+            for name, provider in self._defaults.items():
+                self._providers[name] = provider._replace(**{
+                    key: value
+                    for key, value in settings.get(name, {}).items()
+                    if key in ('ttl', 'min_interval', 'alarm_ttl', 'always')})
+
+    def __getitem__(self, name: str) -> Provider:
+        return self._providers[name]
+
+    def __iter__(self):
+        return iter(list(self._providers))
+
+    def __len__(self):
+        return len(self._providers)
+
+    def due(self, watched: bool, alarms: dict = None,
+            now: float = None) -> list:
+        """
+        The names of the providers to refresh now. watched is True if
+        someone is looking at the website, and alarms has the time of the
+        next alarm that announces each provider's data, by name.
+        """
+        now = time.time() if now is None else now
+        alarms = alarms or {}
+        names = []
+        with self._lock:
+            for name, provider in self._providers.items():
+                state = self._state[name]
+                if state.last_attempt is not None:
+                    wait = provider.min_interval
+                    if state.failures:
+                        wait = max(wait, min(
+                            provider.ttl,
+                            RETRY_SECONDS * 2 ** (state.failures - 1)))
+                    if now - state.last_attempt < wait:
+                        continue
+                age = float('inf') if state.last_success is None \
+                    else now - state.last_success
+                alarm_at = alarms.get(name)
+                if alarm_at is not None and provider.alarm_ttl is not None \
+                        and alarm_at - now <= self.lead \
+                        and age > provider.alarm_ttl:
+                    names.append(name)
+                elif (watched or provider.always) and age >= provider.ttl:
+                    names.append(name)
+        return names
+
+    def record(self, name: str, succeeded: bool, now: float = None):
+        """
+        Records the outcome of a refresh of a provider.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            state = self._state[name]
+            state.last_attempt = now
+            if succeeded:
+                state.last_success = now
+                state.failures = 0
+            else:
+                state.failures += 1
+
+    def metrics(self, now: float = None) -> dict:
+        """
+        The age of each provider's data in seconds, or None if it has never
+        been fetched, and its failures in a row.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            return {name: {
+                'age': None if state.last_success is None
+                else round(now - state.last_success, 1),
+                'failures': state.failures}
+                for name, state in self._state.items()}
@@ -0,0 +1,217 @@
+"""
+This module works out when alarms go off. It parses the times typed into
+the website or sent to the API as full dates and times, in the local time
+zone or a named one, and it handles repeating alarms. A repeat rule is a
+cron expression, minute hour day-of-month month day-of-week, and the names
+daily, weekdays and weekends are turned into one at the time of day the
+alarm was set for. Only the next time an alarm goes off is ever worked
+out, when it is added and again each time it goes off, so a repeating
+alarm takes one place in the alarm engine however often it repeats.
+"""
+
+import datetime
+import re
+import time
+
+try:
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+except ImportError:  # Python 3.8 only has the local time zone.
+    ZoneInfo = None
+    ZoneInfoNotFoundError = KeyError
+
+NAMED_RULES = {
+    'daily': '{minute} {hour} * * *',
+    'weekdays': '{minute} {hour} * * 1-5',
+    'weekends': '{minute} {hour} * * 0,6',
+}
+FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+DAY_NAMES = ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat']
+SEARCH_DAYS = 366 * 8
+# Far enough ahead to find a 29th of February on a given day of the week.
+FORMATS = ('%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M',
+           '%d/%m/%Y T %H:%M', '%d/%m/%Y %H:%M')
+CLOCK = re.compile(r'^(\d{1,2}):(\d{2})$')
+
+
+def zone(name: str = None):
+    """
+    The tzinfo for a time zone name such as Europe/London, or None for the
+    local time zone. Raises ValueError for an unknown name.
+    """
+    if not name:
+        return None
+    if ZoneInfo is None:
+        raise ValueError('Named time zones need Python 3.9 or higher')
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError) as error:
+        raise ValueError('Unknown time zone ' + repr(name)) from error
+
+
+def wall_time(timestamp: float, tz=None) -> datetime.datetime:
+    """
+    The naive date and time on the clock in tz at timestamp.
+    """
+    if tz is None:
+        return datetime.datetime.fromtimestamp(timestamp)
+    return datetime.datetime.fromtimestamp(timestamp, tz).replace(tzinfo=None)
+
+
+def timestamp_of(wall: datetime.datetime, tz=None) -> float:
+    """
+    The timestamp of a naive date and time on the clock in tz.
+    """
+    if tz is not None:
+        wall = wall.replace(tzinfo=tz)
+    return wall.timestamp()
+
+
+def parse_when(text: str, tz=None, now: float = None) -> float:
+    """
+    The timestamp of a date and time typed as 2020-10-20T15:25, the format
+    of the datetime-local box, or 20/10/2020 T 15:25, or an ISO time with
+    an offset. A time of day on its own, 07:30, is the next time the clock
+    in tz shows it. Raises ValueError if the text is none of these.
+    """
+    text = (text or '').strip()
+    now = time.time() if now is None else now
+    clock = CLOCK.match(text)
+    if clock:
+        hour, minute = int(clock.group(1)), int(clock.group(2))
+        wall = wall_time(now, tz).replace(hour=hour, minute=minute,
+                                          second=0, microsecond=0)
+        if timestamp_of(wall, tz) <= now:
+            wall += datetime.timedelta(days=1)
+        return timestamp_of(wall, tz)
+    for fmt in FORMATS:
+        try:
+            return timestamp_of(datetime.datetime.strptime(text, fmt), tz)
+        except ValueError:
+            continue
+    try:
+        parsed = datetime.datetime.fromisoformat(text.replace('Z', '+00:00'))
+    except ValueError as error:
+        raise ValueError('Can not read the time ' + repr(text)) from error
+    if parsed.tzinfo is not None:
+        return parsed.timestamp()
+    return timestamp_of(parsed, tz)
+
+
+def _field(text: str, low: int, high: int, names: list = None) -> frozenset:
+    values = set()
+    for part in text.lower().split(','):
+        step = 1
+        stepped = '/' in part
+        if stepped:
+            part, step_text = part.split('/', 1)
+            step = int(step_text)
+            if step < 1:
+                raise ValueError('A cron step must be 1 or more')
+        if part == '*':
+            first, last = low, high
+        else:
+            bounds = [names.index(bound) if names and bound in names
+                      else int(bound) for bound in part.split('-', 1)]
+            first, last = bounds[0], bounds[-1]
+            if stepped and len(bounds) == 1:
+                last = high  # 5/15 means from 5 to the end, every 15.
+        if not low <= first <= last <= high:
+            raise ValueError('Cron value ' + repr(part) + ' is out of range')
+        values.update(range(first, last + 1, step))
+    return frozenset(values)
+
+
+class Cron:
+    """
+    A parsed cron expression. As in cron, when both the day of the month
+    and the day of the week are restricted, a day matching either counts.
+    """
+
+    def __init__(self, expression: str):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError('A cron rule has five fields, not '
+                             + str(len(parts)))
+        self.expression = ' '.join(parts)
+        self.minutes, self.hours, self.days, self.months, days_of_week = (
+            _field(part, low, high, DAY_NAMES if index == 4 else None)
+            for index, (part, (low, high)) in enumerate(zip(parts, FIELDS)))
+        self.days_of_week = frozenset(day % 7 for day in days_of_week)
+        self.any_day = parts[2] == '*'
+        self.any_day_of_week = parts[4] == '*'
+
+    def matches_day(self, day: datetime.date) -> bool:
+        """
+        True if the rule goes off at some time on day.
+        """
+        if day.month not in self.months:
+            return False
+        in_month = day.day in self.days
+        in_week = (day.weekday() + 1) % 7 in self.days_of_week
+        if self.any_day or self.any_day_of_week:
+            return in_month and in_week
+        return in_month or in_week
+
+    def next_after(self, timestamp: float, tz=None) -> float:
+        """
+        The first whole minute after timestamp at which the rule goes off,
+        on the clock in tz, or None if there is none in the years ahead.
+        """
+        start = wall_time(timestamp, tz).replace(second=0, microsecond=0) \
+            + datetime.timedelta(minutes=1)
+        day = start.date()
+        hours = sorted(self.hours)
+        minutes = sorted(self.minutes)
+        for _ in range(SEARCH_DAYS):
+            if self.matches_day(day):
+                for hour in hours:
+                    for minute in minutes:
+                        wall = datetime.datetime.combine(
+                            day, datetime.time(hour, minute))
+                        if wall >= start:
+                            return timestamp_of(wall, tz)
+            day += datetime.timedelta(days=1)
+        return None
+
+
+def make_rule(repeat: str, first: float, tz=None) -> str:
+    """
+    The cron expression for a repeat given as daily, weekdays, weekends or
+    a cron expression, for an alarm first set for the timestamp first.
+    Returns None for an alarm that does not repeat, and raises ValueError
+    for a rule that can not be read.
+    """
+    repeat = (repeat or '').strip().lower()
+    if repeat in ('', 'once', 'never'):
+        return None
+    if repeat in NAMED_RULES:
+        wall = wall_time(first, tz)
+        repeat = NAMED_RULES[repeat].format(minute=wall.minute,
+                                            hour=wall.hour)
+    return Cron(repeat).expression
+
+
+def first_fire(rule: str, start: float, tz=None, now: float = None) -> float:
+    """
+    When an alarm set for start with the given rule first goes off, start
+    itself if it is a time the rule allows, otherwise the next one that is.
+    An alarm that does not repeat goes off at start. Raises ValueError for
+    a rule that never goes off, such as one for the 30th of February.
+    """
+    if rule is None:
+        return start
+    now = time.time() if now is None else now
+    fire_at = Cron(rule).next_after(max(start, now) - 1, tz)
+    if fire_at is None:
+        raise ValueError('The repeat rule ' + rule + ' never goes off')
+    return fire_at
+
+
+def next_fire(rule: str, fired_at: float, time_zone: str = None,
+              now: float = None) -> float:
+    """
+    When an alarm with the given rule goes off next, after it went off at
+    fired_at. Times missed while the app was not running are skipped.
+    """
+    now = time.time() if now is None else now
+    return Cron(rule).next_after(max(fired_at, now), zone(time_zone))
@@ -0,0 +1,80 @@
+"""
+This module shares the briefing snapshots between the processes serving the
+website. Each process writes the snapshot fields it changed to an SQLite
+table, shared.db, and reads the fields the other processes changed, so the
+workers that are not the leader show the data the leader fetched without
+asking the providers themselves. Every write gets the next generation
+number, so a reader only has to ask for the rows newer than the newest one
+it has seen.
+"""
+
+import json
+import sqlite3
+import threading
+import uuid
+
+
+class SharedCache:
+    """
+    The fields of the briefing snapshot of every channel, the household or
+    a user, with the generation they were last written at and the process
+    that wrote them.
+    """
+
+    def __init__(self, path: str = 'shared.db'):
+        self.writer = uuid.uuid4().hex
+        self.seen = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS fields ('
+            'channel TEXT NOT NULL, field TEXT NOT NULL, '
+            'generation INTEGER NOT NULL, writer TEXT NOT NULL, '
+            'value TEXT NOT NULL, PRIMARY KEY (channel, field))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS fields_generation '
+                         'ON fields (generation)')
+
+    def publish(self, channel: str, fields: dict):
+        """
+        Saves the given fields of a channel for the other processes.
+        """
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')  # One writer at a time.
+            try:
+                generation = self._db.execute(
+                    'SELECT COALESCE(MAX(generation), 0) + 1 FROM fields'
+                ).fetchone()[0]
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO fields VALUES (?, ?, ?, ?, ?)',
+                    [(channel, field, generation, self.writer,
+                      json.dumps(value, separators=(',', ':')))
+                     for field, value in fields.items()])
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def changes(self) -> dict:
+        """
+        The fields written by other processes since the last call, as a
+        dictionary of fields for each channel.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT channel, field, generation, writer, value '
+                'FROM fields WHERE generation > ? ORDER BY generation',
+                (self.seen,)).fetchall()
+            changed = {}
+            for channel, field, generation, writer, value in rows:
+                self.seen = max(self.seen, generation)
+                if writer != self.writer:
+                    changed.setdefault(channel, {})[field] = json.loads(value)
+            return changed
+
+    def close(self):
+        """
+        Closes the database.
+        """
+        self._db.close()
@@ -0,0 +1,78 @@
+"""
+This module makes sure that identical upstream queries are only made once.
+The SharedFetcher caches the result of each query by key for ttl seconds,
+and when several threads ask for the same key at the same time only the
+first one calls the provider, the others wait for its result. So when a
+thousand users live in fifty cities, a refresh makes fifty weather calls.
+"""
+
+import threading
+import time
+from concurrent.futures import Future
+
+
+class SharedFetcher:
+    """
+    A keyed cache of fetch results with a time to live, which also joins
+    concurrent fetches of the same key into one call.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.calls = 0
+        self.hits = 0
+        self.joined = 0
+        self._values = {}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, fetch):
+        """
+        Returns the cached value for key if it is younger than ttl, the
+        result of a fetch for key that is already running, or else the
+        result of calling fetch(). Exceptions from fetch are raised in
+        every caller that was waiting for it, and nothing is cached.
+        """
+        with self._lock:
+            cached = self._values.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                self.hits += 1
+                return cached[1]
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self._in_flight[key] = Future()
+                self.calls += 1
+            else:
+                self.joined += 1
+        if not leader:
+            return call.result()
+        try:
+            value = fetch()
+        except BaseException as error:
+            with self._lock:
+                del self._in_flight[key]
+            call.set_exception(error)
+            raise
+        with self._lock:
+            self._values[key] = (time.monotonic() + self.ttl, value)
+            del self._in_flight[key]
+        call.set_result(value)
+        return value
+
+    def invalidate(self, key=None):
+        """
+        Forgets the cached value for key, or every cached value.
+        """
+        with self._lock:
+            if key is None:
+                self._values.clear()
+            else:
+                self._values.pop(key, None)
+
+    def metrics(self) -> dict:
+        """
+        The number of provider calls made, cache hits and joined fetches.
+        """
+        return {'calls': self.calls, 'hits': self.hits,
+                'joined': self.joined, 'keys': len(self._values)}
@@ -0,0 +1,90 @@
+"""
+This module holds the in-memory briefing snapshot used by the app module.
+The snapshot contains everything the /index page and the alarms need, the
+notifications, the news headlines, the weather and the covid data, so that
+the request path never has to open and parse the json files on disk.
+The APScheduler jobs build new values after each refresh and swap them in
+with SnapshotStore.update, which bumps the version number, and tells the
+subscribers what changed.
+"""
+
+import threading
+import time
+from typing import NamedTuple
+
+COVID_ROWS = 7
+# The number of the newest covid rows a snapshot keeps, the full history is
+# in the covid store.
+
+
+class Snapshot(NamedTuple):
+    """
+    An immutable view of the briefing data at a given version. Every field
+    is a tuple so a snapshot handed to a request can never change under it.
+    fetched holds a (provider, time) pair for each provider with the time
+    it last answered, so the age of the data can be shown.
+    """
+    version: int = 0
+    notifications: tuple = ()
+    news: tuple = ()
+    weather: tuple = ()
+    covid: tuple = ()
+    fetched: tuple = ()
+
+
+def fetched_now(snap: Snapshot, names, now: float = None) -> tuple:
+    """
+    The fetched field of snap with the providers in names marked as having
+    answered at now.
+    """
+    now = time.time() if now is None else now
+    fetched = dict(snap.fetched)
+    fetched.update((name, now) for name in names)
+    return tuple(sorted(fetched.items()))
+
+
+class SnapshotStore:
+    """
+    The SnapshotStore keeps a reference to the current Snapshot. Readers call
+    current(), which is a single attribute read and needs no lock. Writers
+    call update() with the fields that changed, which builds a new Snapshot
+    with the version incremented and swaps it in atomically.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = Snapshot()
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        """
+        Calls callback(old, new) with the old and new snapshot after every
+        update, in the order the updates were made.
+        """
+        self._subscribers.append(callback)
+
+    def current(self) -> Snapshot:
+        """
+        Returns the current snapshot without taking the lock.
+        """
+        return self._snapshot
+
+    @property
+    def version(self) -> int:
+        """
+        The version number of the current snapshot.
+        """
+        return self._snapshot.version
+
+    def update(self, **fields) -> Snapshot:
+        """
+        Replaces the given fields, converting them to tuples, and publishes
+        the result as the next version. Returns the new snapshot.
+        """
+        fields = {key: tuple(value) for key, value in fields.items()}
+        with self._lock:
+            old = self._snapshot
+            self._snapshot = old._replace(version=old.version + 1, **fields)
+            for callback in self._subscribers:
+                callback(old, self._snapshot)
+            return self._snapshot
@@ -0,0 +1,311 @@
+"""
+This module contains the speech worker that makes every text-to-speech
+announcement. Alarms and covid alerts used to call pyttsx3 directly, which
+held up the thread that called them for as long as the announcement was
+being spoken. Now they are added to a bounded priority queue and a single
+long lived worker thread speaks them one at a time with one reusable engine.
+Covid alerts are spoken before routine alarms, and an announcement that is
+already waiting in the queue is not queued twice. When the worker has an
+AudioCache it also pre-renders announcements in its idle time, and plays
+the rendered clip instead of synthesizing the text when one is cached.
+"""
+
+import heapq
+import logging
+import subprocess
+import sys
+import threading
+import time
+from metrics import REGISTRY
+
+log = logging.getLogger(__name__)
+
+COVID_ALERT = 0
+ALARM = 1
+PRERENDER = 2
+# Lower numbers are spoken first, pre-rendering waits for idle time.
+SPEAK = 'speak'
+RENDER = 'render'
+
+
+def announcement_text(announcement) -> str:
+    """
+    Turns an announcement into the text to speak. Alarms can carry the
+    weather tuple or the list of headlines, so lists and tuples are
+    flattened into sentences.
+    """
+    if isinstance(announcement, (list, tuple)):
+        parts = [announcement_text(part) for part in announcement]
+        return '. '.join(part for part in parts if part)
+    return str(announcement).strip()
+
+
+class Pyttsx3Backend:
+    """
+    Speaks with pyttsx3. The engine is created on first use, on the worker
+    thread, and reused for every announcement after that.
+    """
+
+    def __init__(self):
+        self.engine = None
+
+    def say(self, text: str):
+        """
+        Speaks the text and blocks until it has finished.
+        """
+        if self.engine is None:
+            import pyttsx3  # pylint: disable=import-outside-toplevel
+            self.engine = pyttsx3.init()
+        self.engine.say(text)
+        self.engine.runAndWait()
+
+    def save_to_file(self, text: str, path: str):
+        """
+        Renders the text to an audio file instead of speaking it.
+        """
+        if self.engine is None:
+            import pyttsx3  # pylint: disable=import-outside-toplevel
+            self.engine = pyttsx3.init()
+        self.engine.save_to_file(text, path)
+        self.engine.runAndWait()
+
+    @staticmethod
+    def play(path: str):
+        """
+        Plays a rendered clip with the audio player of the platform and
+        blocks until it has finished.
+        """
+        if sys.platform == 'win32':
+            import winsound  # pylint: disable=import-outside-toplevel
+            winsound.PlaySound(path, winsound.SND_FILENAME)
+        elif sys.platform == 'darwin':
+            subprocess.run(['afplay', path], check=True)
+        else:
+            subprocess.run(['aplay', '-q', path], check=True)
+
+
+class NullBackend:
+    """
+    A silent backend for headless machines and the tests, which keeps the
+    texts it was asked to speak in the spoken list.
+    """
+
+    def __init__(self):
+        self.spoken = []
+        self.played = []
+
+    def say(self, text: str):
+        """
+        Records the text instead of speaking it.
+        """
+        self.spoken.append(text)
+
+    @staticmethod
+    def save_to_file(text: str, path: str):
+        """
+        Writes the text itself in place of rendered audio.
+        """
+        with open(path, 'w') as clip:
+            clip.write(text)
+
+    def play(self, path: str):
+        """
+        Records the path of the clip instead of playing it.
+        """
+        self.played.append(path)
+
+
+BACKENDS = {'pyttsx3': Pyttsx3Backend, 'null': NullBackend}
+
+
+class SpeechWorker:
+    """
+    Owns the backend, the announcement queue and the worker thread. The
+    queue holds at most maxsize announcements, anything past that is
+    dropped and counted, so a burst of alarms can never use up the memory
+    or leave the speaker hours behind. An announcement to speak makes room
+    for itself by dropping the newest waiting pre-render, which is only
+    worth having, so pre-rendering can never silence an alarm.
+    """
+
+    def __init__(self, backend, maxsize: int = 32, cache=None):
+        self.backend = backend
+        self.cache = cache
+        self.maxsize = maxsize
+        self._queue = []
+        self._pending = set()
+        self._counter = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._busy = False
+        self.spoken = 0
+        self.merged = 0
+        self.dropped = 0
+        self.failed = 0
+        self.rendered = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+    def announce(self, announcement, priority: int = ALARM) -> bool:
+        """
+        Queues an announcement and returns straight away. Returns False if
+        it was merged with an identical waiting announcement or dropped
+        because the queue is full.
+        """
+        return self._put(SPEAK, announcement_text(announcement), priority)
+
+    def prerender(self, announcements, limit: int = None) -> int:
+        """
+        Queues each announcement to be rendered into the audio cache in
+        idle time, skipping the ones that are already cached, and stopping
+        after limit that are not. Returns the number queued.
+        """
+        if self.cache is None:
+            return 0
+        texts = [announcement_text(announcement)
+                 for announcement in announcements]
+        texts = [text for text in texts if text and text not in self.cache]
+        return sum(self._put(RENDER, text, PRERENDER)
+                   for text in texts[:limit])
+
+    def _put(self, kind: str, text: str, priority: int) -> bool:
+        if not text:
+            return False
+        with self._cond:
+            if (kind, text) in self._pending:
+                self.merged += 1
+                return False
+            if len(self._queue) >= self.maxsize \
+                    and not (kind == SPEAK and self._drop_render()):
+                self.dropped += 1
+                log.warning('Speech queue full, dropped: ' + text)
+                return False
+            self._counter += 1
+            heapq.heappush(self._queue, (priority, self._counter, kind, text,
+                                         time.monotonic()))
+            self._pending.add((kind, text))
+            self._cond.notify_all()
+        return True
+
+    def _drop_render(self) -> bool:
+        """
+        Drops the waiting pre-render that would have run last. Returns
+        False if there is none. The caller holds the lock.
+        """
+        renders = [entry for entry in self._queue if entry[2] == RENDER]
+        if not renders:
+            return False
+        entry = max(renders)
+        self._queue.remove(entry)
+        heapq.heapify(self._queue)
+        self._pending.discard((RENDER, entry[3]))
+        log.info('Speech queue full, dropped the pre-render of: ' + entry[3])
+        return True
+
+    @property
+    def depth(self) -> int:
+        """
+        The number of announcements waiting to be spoken.
+        """
+        return len(self._queue)
+
+    def metrics(self) -> dict:
+        """
+        Queue depth, counters and the wait from being queued to being
+        spoken, in seconds.
+        """
+        return {
+            'depth': self.depth,
+            'spoken': self.spoken,
+            'merged': self.merged,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'rendered': self.rendered,
+            'last_latency': self.last_latency,
+            'max_latency': self.max_latency,
+            'mean_latency': self.total_latency / self.spoken
+                            if self.spoken else 0.0,
+        }
+
+    def start(self):
+        """
+        Starts the worker thread.
+        """
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='speech',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = None):
+        """
+        Stops the worker once the announcement being spoken has finished.
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def wait_idle(self, timeout: float = None) -> bool:
+        """
+        Blocks until the queue is empty and nothing is being spoken.
+        Returns False on timeout.
+        """
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self._queue and not self._busy, timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                _, _, kind, text, queued_at = heapq.heappop(self._queue)
+                self._pending.discard((kind, text))
+                self._busy = True
+            if kind == RENDER:
+                with REGISTRY.timed('tts_render_seconds'):
+                    self._render(text)
+            else:
+                latency = time.monotonic() - queued_at
+                REGISTRY.observe('tts_queue_wait_seconds', latency)
+                with REGISTRY.timed('tts_playback_seconds'):
+                    self._speak(text, latency)
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+
+    def _render(self, text):
+        try:
+            self.cache.render(text, self.backend)
+        except Exception:  # pylint: disable=broad-except
+            log.exception('Pre-rendering failed: ' + text)
+        else:
+            self.rendered += 1
+
+    def _speak(self, text, latency):
+        clip = self.cache.get(text) if self.cache is not None else None
+        try:
+            if clip is None:
+                self.backend.say(text)
+            else:
+                try:
+                    self.backend.play(clip)
+                except Exception:  # pylint: disable=broad-except
+                    log.exception('Playing ' + clip + ' failed, speaking it')
+                    self.backend.say(text)
+        except Exception:  # pylint: disable=broad-except
+            self.failed += 1
+            REGISTRY.inc('tts_failures_total')
+            log.exception('Speech failed: ' + text)
+        else:
+            self.spoken += 1
+            REGISTRY.inc('tts_announcements_total',
+                         source='say' if clip is None else 'clip')
+            self.last_latency = latency
+            self.max_latency = max(self.max_latency, latency)
+            self.total_latency += latency
@@ -0,0 +1,81 @@
+"""
+This module tracks how far the app has got through starting up. The app
+serves the last known data from disk straight away and warms its caches in
+a background thread, so the Readiness object records which of those stages
+it is in, and how long it took from the start of the import of app.py to
+the first response being sent.
+"""
+
+import threading
+import time
+
+STARTING = 'starting'
+STALE = 'stale'
+READY = 'ready'
+FAILED = 'failed'
+
+
+class Readiness:
+    """
+    Holds the startup state. It begins as starting, becomes stale once the
+    last known data has been loaded from disk, and then ready or failed
+    when the background warm up finishes.
+    """
+
+    def __init__(self, started: float):
+        self.started = started
+        self.state = STARTING
+        self.first_response_seconds = None
+        self.warm_up_seconds = None
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+
+    def mark(self, state: str):
+        """
+        Moves to the given state. Reaching ready or failed records the warm
+        up time and wakes anyone waiting on wait().
+        """
+        self.state = state
+        if state in (READY, FAILED):
+            self.warm_up_seconds = time.perf_counter() - self.started
+            self._done.set()
+
+    def record_response(self) -> bool:
+        """
+        Records the time of the first response since the import started.
+        Returns True only for the first response.
+        """
+        if self.first_response_seconds is not None:
+            return False
+        with self._lock:
+            if self.first_response_seconds is not None:
+                return False
+            self.first_response_seconds = time.perf_counter() - self.started
+            return True
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Blocks until the warm up has finished, returns False on timeout.
+        """
+        return self._done.wait(timeout)
+
+    @property
+    def is_ready(self) -> bool:
+        """
+        True once the background warm up has succeeded.
+        """
+        return self.state == READY
+
+    def as_dict(self) -> dict:
+        """
+        The readiness state and timings as a json friendly dictionary,
+        with times in milliseconds.
+        """
+        def millis(seconds):
+            return None if seconds is None else round(seconds * 1000, 1)
+        return {
+            'state': self.state,
+            'import_to_first_response_ms': millis(
+                self.first_response_seconds),
+            'import_to_ready_ms': millis(self.warm_up_seconds),
+        }
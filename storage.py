@@ -0,0 +1,161 @@
+"""
+This module saves the json state files, such as notifications.json,
+dismissed.json and the weather.json, news.json and covid.json responses, so
+that a reader never sees a file half written, even while the scheduled jobs
+and the page requests write them from several threads. A file is written to
+a temporary file of its own next to it, flushed to disk and renamed over the
+old one, one writer at a time for each file, and every write gets the next
+generation number of that file. The rename is made durable by syncing the
+directory, and writers that renamed into the same directory at about the
+same time share a single sync. Readers take no lock: they open whichever
+version of the file is there, and a file that has not changed since it was
+last read is not parsed again. The state files, config.json and the
+databases are kept in STATE_DIR, which is fixed when the app is imported,
+so a later change of the working directory does not move them.
+"""
+
+import itertools
+import json
+import os
+import threading
+
+STATE_DIR = os.path.abspath(os.environ.get('BRIEFINGS_DIR', os.curdir))
+# The directory of the state files, the working directory unless the
+# BRIEFINGS_DIR environment variable names another.
+
+
+def state_path(name: str) -> str:
+    """
+    The absolute path of the state file name in STATE_DIR.
+    """
+    return os.path.join(STATE_DIR, name)
+
+
+class Storage:
+    """
+    The writer and reader of the json state files. With durable set, the
+    data and the rename are synced to disk before write returns.
+    """
+
+    def __init__(self, durable: bool = True):
+        self.durable = durable
+        self.writes = 0
+        self.syncs = 0
+        self._guard = threading.Lock()
+        self._locks = {}
+        self._generations = {}
+        self._reads = {}
+        self._temp_ids = itertools.count()
+        self._cond = threading.Condition()
+        self._requested = {}
+        self._synced = {}
+        self._syncing = set()
+
+    def lock(self, path: str) -> threading.Lock:
+        """
+        The lock held while path is written.
+        """
+        with self._guard:
+            return self._locks.setdefault(os.path.abspath(path),
+                                          threading.Lock())
+
+    def generation(self, path: str) -> int:
+        """
+        The number of times path has been written by this process.
+        """
+        return self._generations.get(os.path.abspath(path), 0)
+
+    def write(self, path: str, data, **kwargs) -> int:
+        """
+        Dumps data as json to path, passing kwargs to json.dumps, and
+        returns the generation it was written at.
+        """
+        text = json.dumps(data, **kwargs)
+        key = os.path.abspath(path)
+        temp_path = path + '.' + str(os.getpid()) + '-' \
+            + str(next(self._temp_ids)) + '.tmp'
+        with self.lock(path):
+            try:
+                with open(temp_path, 'w') as temp:
+                    temp.write(text)
+                    if self.durable:
+                        temp.flush()
+                        os.fsync(temp.fileno())
+                os.replace(temp_path, path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+            with self._guard:
+                self.writes += 1
+                generation = self._generations.get(key, 0) + 1
+                self._generations[key] = generation
+        if self.durable:
+            self._sync_directory(os.path.dirname(key))
+        return generation
+
+    def read(self, path: str, default=None):
+        """
+        The json in path, or default if there is no such file. The result
+        is shared with other readers until the file changes, so it must not
+        be changed. Raises ValueError if the file is not json.
+        """
+        try:
+            file = open(path, 'r')
+        except FileNotFoundError:
+            return default
+        with file:
+            info = os.fstat(file.fileno())
+            stamp = (info.st_ino, info.st_mtime_ns, info.st_size)
+            key = os.path.abspath(path)
+            cached = self._reads.get(key)
+            if cached is not None and cached[0] == stamp:
+                return cached[1]
+            data = json.load(file)
+        self._reads[key] = (stamp, data)
+        return data
+
+    def _sync_directory(self, directory: str):
+        """
+        Syncs directory once this write's rename is covered by a sync. The
+        first writer to arrive syncs for every write renamed before it
+        started, and the others wait for it, or for the next one.
+        """
+        with self._cond:
+            ticket = self._requested.get(directory, 0) + 1
+            self._requested[directory] = ticket
+            while self._synced.get(directory, 0) < ticket:
+                if directory in self._syncing:
+                    self._cond.wait()
+                    continue
+                self._syncing.add(directory)
+                covered = self._requested[directory]
+                self._cond.release()
+                try:
+                    fsync_directory(directory)
+                finally:
+                    self._cond.acquire()
+                    self._syncing.discard(directory)
+                    self._synced[directory] = covered
+                    self.syncs += 1
+                    self._cond.notify_all()
+
+
+def fsync_directory(directory: str):
+    """
+    Flushes the entries of directory to disk, where the operating system
+    allows a directory to be opened, which Windows does not.
+    """
+    try:
+        handle = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(handle)
+    except OSError:
+        pass
+    finally:
+        os.close(handle)
+
+
+STORAGE = Storage()
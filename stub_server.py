@@ -0,0 +1,201 @@
+"""
+This module runs a local stand-in for the OpenWeatherMap, NewsAPI and
+coronavirus APIs, so the tests can exercise dataget without the network.
+The payloads have the same shape as the real weather.json, news.json and
+covid.json files. An optional delay makes each response slow, which is
+used to check that the providers are fetched concurrently. Every response
+has an ETag, and a request whose If-None-Match matches it gets 304. Faults
+can be injected on any path, an error status, a response that hangs, or an
+error message sent with 200 as some providers do.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+HANG = 'hang'
+BAD_PAYLOAD = 'bad_payload'
+
+WEATHER_FIXTURE = {
+    "weather": [{"id": 803, "main": "Clouds",
+                 "description": "broken clouds", "icon": "04d"}],
+    "main": {"temp": 8.4, "feels_like": 4.9, "temp_min": 7.8,
+             "temp_max": 9.0, "pressure": 1012, "humidity": 81},
+    "name": "Exeter",
+    "cod": 200
+}
+
+NEWS_FIXTURE = {
+    "status": "ok",
+    "totalResults": 2,
+    "articles": [
+        {"source": {"id": "bbc-news", "name": "BBC News"},
+         "author": "BBC News",
+         "title": "Iran rejects Biden's terms for reviving nuclear deal",
+         "description": "Tehran says the US is in no position to set "
+                        "preconditions and economic sanctions must be "
+                        "lifted.",
+         "url": "http://www.bbc.co.uk/news/world-middle-east-55177586",
+         "publishedAt": "2020-12-03T18:07:23.9087971Z"},
+        {"source": {"id": "bbc-news", "name": "BBC News"},
+         "author": "BBC News",
+         "title": "Boeing 737 Max sees first firm order since crashes",
+         "description": "Irish airline Ryanair's purchase is a boost for "
+                        "the Max, which was grounded after two deadly "
+                        "crashes.",
+         "url": "http://www.bbc.co.uk/news/business-55177846",
+         "publishedAt": "2020-12-03T17:07:22.6417558Z"}
+    ]
+}
+
+COVID_FIXTURE = {
+    "data": [
+        {"date": "2020-12-03",
+         "newCasesByPublishDate": 11992, "cumCasesByPublishDate": 1438725,
+         "newDeathsByDeathDate": None, "cumDeathsByDeathDate": None},
+        {"date": "2020-12-02",
+         "newCasesByPublishDate": 13323, "cumCasesByPublishDate": 1426733,
+         "newDeathsByDeathDate": 105, "cumDeathsByDeathDate": 63435},
+        {"date": "2020-12-01",
+         "newCasesByPublishDate": 11618, "cumCasesByPublishDate": 1413410,
+         "newDeathsByDeathDate": 306, "cumDeathsByDeathDate": 63330},
+        {"date": "2020-11-30",
+         "newCasesByPublishDate": 10869, "cumCasesByPublishDate": 1401792,
+         "newDeathsByDeathDate": 367, "cumDeathsByDeathDate": 63024}
+    ]
+}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers GET requests on the three provider paths with the payload held
+    by the server. The coronavirus API is paged, so only page 1 has data and
+    later pages return 204 No Content, as the real API does. If the server
+    has a max_age, it is sent as the Cache-Control max-age.
+    """
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Dispatches on the request path and writes the json payload.
+        """
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        server = self.server
+        server.hits[url.path] = server.hits.get(url.path, 0) + 1
+        if url.path == '/v1/data' and query.get('page', ['1'])[0] != '1':
+            self.send_response(204)
+            self.end_headers()
+            return
+        fault = server.faults.get(url.path)
+        if fault == HANG:
+            time.sleep(server.hang_seconds)
+        elif fault is not None:
+            body = json.dumps({'cod': fault if fault != BAD_PAYLOAD else 401,
+                               'status': 'error',
+                               'message': 'Injected fault'}).encode('utf-8')
+            self.send_response(200 if fault == BAD_PAYLOAD else fault)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        time.sleep(server.delay)
+        payload = server.payloads.get(url.path)
+        if payload is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = json.dumps(payload).encode('utf-8')
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', etag)
+        if server.max_age is not None:
+            self.send_header('Cache-Control',
+                             'max-age=' + str(server.max_age))
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Last-Modified', 'Thu, 03 Dec 2020 16:00:00 GMT')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """
+        Keeps the stub quiet, the tests do not need an access log.
+        """
+
+
+class StubProviders:
+    """
+    Runs StubHandler on a free local port in a background thread. Use it as
+    a context manager, or call start and stop, and point dataget at it with
+    the weather_url, news_url and covid_url attributes.
+    """
+
+    def __init__(self, delay: float = 0.0, max_age: int = None):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.daemon_threads = True
+        self.server.delay = delay
+        self.server.max_age = max_age
+        self.server.hits = {}
+        self.server.faults = {}
+        self.server.hang_seconds = 30
+        self.server.payloads = {
+            '/data/2.5/weather': WEATHER_FIXTURE,
+            '/v2/top-headlines': NEWS_FIXTURE,
+            '/v1/data': COVID_FIXTURE,
+        }
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       args=(0.05,), daemon=True)
+        base = 'http://127.0.0.1:' + str(self.server.server_port)
+        self.weather_url = base + '/data/2.5/weather'
+        self.news_url = base + '/v2/top-headlines'
+        self.covid_url = base + '/v1/data'
+
+    @property
+    def hits(self) -> dict:
+        """
+        The number of requests seen on each path.
+        """
+        return self.server.hits
+
+    def fail(self, url: str, fault):
+        """
+        Makes every request to url fail with fault, an HTTP status code,
+        HANG to wait hang_seconds before answering, or BAD_PAYLOAD to send
+        an error message with status 200.
+        """
+        self.server.faults[urlsplit(url).path] = fault
+
+    def heal(self):
+        """
+        Removes every injected fault.
+        """
+        self.server.faults.clear()
+
+    def start(self):
+        """
+        Starts serving in the background and returns self.
+        """
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the server and closes its socket.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,223 @@
+"""
+This module lets one process serve the briefings of many users. Each user
+has a profile in the users list of config.json, with their own weather city,
+news sources, covid area and covid threshold, and anything a profile leaves
+out is taken from the top level of config.json. Every user gets their own
+briefing snapshot and notifications, but a refresh only makes one upstream
+query for each distinct city, set of news sources and covid area.
+"""
+
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+from dataget import fetch_weather, fetch_news, fetch_covid, \
+    weather_data_extractor
+from notifications import NotificationBuilder, with_markup
+from snapshot import SnapshotStore, COVID_ROWS, fetched_now
+from covid_store import area_key
+from storage import state_path
+
+log = logging.getLogger(__name__)
+
+MAX_WORKERS = 8
+NAME = re.compile(r'^[A-Za-z0-9_-]+$')
+# User names are used in file names, so they are kept to these characters.
+
+
+class Profile(NamedTuple):
+    """
+    The settings of one user.
+    """
+    name: str
+    weather_city_name: str
+    news_sources: str
+    covid_area_type: str
+    covid_area_name: str
+    user_threshold_number: float
+    time_zone: str
+
+
+def load_profiles(config: dict) -> dict:
+    """
+    Builds a Profile for every entry in the users list of config, keyed by
+    name. A profile without a valid name is skipped.
+    """
+    defaults = dict(config, news_sources=config.get('news_sources',
+                                                    'bbc-news'))
+    profiles = {}
+    for user in config.get('users', []):
+        if not NAME.match(str(user.get('name', ''))):
+            log.warning('Skipping a user profile without a valid name')
+            continue
+        profiles[user['name']] = Profile(*(
+            user.get(field, defaults.get(field))
+            for field in Profile._fields))
+    return profiles
+
+
+class Tenant:
+    """
+    A user's profile with their briefing snapshot and notifications, which
+    are saved to notifications-<name>.json and dismissed-<name>.json.
+    """
+
+    def __init__(self, profile: Profile):
+        self.profile = profile
+        self.store = SnapshotStore()
+        self.notifications = NotificationBuilder(
+            state_path('notifications-' + profile.name + '.json'),
+            state_path('dismissed-' + profile.name + '.json'))
+        self.store.update(
+            notifications=with_markup(self.notifications.visible()))
+
+
+class TenantBriefings:
+    """
+    Holds a Tenant for every profile and refreshes them all together. The
+    covid data of every area is added to covid_store once per refresh.
+    """
+
+    def __init__(self, profiles: dict, covid_store):
+        self.covid_store = covid_store
+        self.tenants = {name: Tenant(profile)
+                        for name, profile in profiles.items()}
+
+    def get(self, name: str) -> Tenant:
+        """
+        The tenant with the given name, or None.
+        """
+        return self.tenants.get(name) if name else None
+
+    def __len__(self):
+        return len(self.tenants)
+
+    def update_profiles(self, profiles: dict) -> list:
+        """
+        Swaps in the profiles of a reloaded config. A user who is still
+        there keeps their snapshot and notifications, a user who has gone
+        is dropped, and the names of the new users are returned so their
+        snapshots can be subscribed to.
+        """
+        tenants = {}
+        added = []
+        for name, profile in profiles.items():
+            tenant = self.tenants.get(name)
+            if tenant is None:
+                tenant = Tenant(profile)
+                added.append(name)
+            tenant.profile = profile
+            tenants[name] = tenant
+        self.tenants = tenants
+        return added
+
+    def queries(self) -> dict:
+        """
+        The distinct upstream queries needed by every profile, each with the
+        fetch function and its arguments.
+        """
+        queries = {}
+        for tenant in self.tenants.values():
+            profile = tenant.profile
+            queries[('weather', profile.weather_city_name)] = (
+                fetch_weather, profile.weather_city_name)
+            queries[('news', profile.news_sources)] = (
+                fetch_news, profile.news_sources)
+            queries[('covid', profile.covid_area_type,
+                     profile.covid_area_name)] = (
+                fetch_covid, profile.covid_area_type, profile.covid_area_name)
+        return queries
+
+    def refresh(self, config: dict, names=None) -> int:
+        """
+        Makes every distinct query at the same time on a thread pool, then
+        swaps the results into each tenant's snapshot. Only the queries of
+        the providers in names are made, if it is given. A query that failed
+        leaves the tenants that needed it with their previous data. Returns
+        the number of queries made.
+        """
+        queries = {query: call for query, call in self.queries().items()
+                   if names is None or query[0] in names}
+        if not queries:
+            return 0
+        keys = {'weather': config['weather_api_key'],
+                'news': config['news_api_key']}
+        results = {}
+        with ThreadPoolExecutor(
+                max_workers=min(MAX_WORKERS, len(queries))) as pool:
+            futures = {}
+            for query, (fetch, *args) in queries.items():
+                if query[0] in keys:
+                    args.append(keys[query[0]])
+                futures[query] = pool.submit(fetch, *args)
+            for query, future in futures.items():
+                try:
+                    results[query] = future.result()
+                except Exception:  # pylint: disable=broad-except
+                    log.exception('Query ' + str(query) + ' failed')
+        summaries = {}
+        for query, result in results.items():
+            if query[0] == 'covid':
+                area = area_key(*query[1:])
+                self.covid_store.ingest(area, result['data'],
+                                        result.get('lastUpdate'))
+                summaries[query] = self.covid_store.summary(area)
+        for tenant in self.tenants.values():
+            self._apply(tenant, results, summaries)
+        return len(queries)
+
+    @staticmethod
+    def _apply(tenant: Tenant, results: dict, summaries: dict):
+        profile = tenant.profile
+        weather_json = results.get(('weather', profile.weather_city_name))
+        news_json = results.get(('news', profile.news_sources))
+        covid_query = ('covid', profile.covid_area_type,
+                       profile.covid_area_name)
+        covid_json = results.get(covid_query)
+        changes = {}
+        if weather_json is not None:
+            try:
+                changes['weather'] = weather_data_extractor(weather_json)
+            except ValueError:
+                log.warning('Unusable weather for ' + profile.name)
+        if news_json is not None and not isinstance(
+                news_json.get('articles'), list):
+            log.warning('Unusable news for ' + profile.name)
+            news_json = None
+        if news_json is not None:
+            changes['news'] = [str(article['title'])
+                               for article in news_json['articles']]
+        if covid_json is not None:
+            changes['covid'] = covid_json['data'][:COVID_ROWS]
+        answered = [name for name, value in (('weather', changes.get(
+            'weather')), ('news', news_json), ('covid', covid_json))
+            if value is not None]
+        if answered:
+            changes['fetched'] = fetched_now(tenant.store.current(), answered)
+        if tenant.notifications.update(
+                news_json['articles'] if news_json else None,
+                summaries.get(covid_query)):
+            changes['notifications'] = with_markup(
+                tenant.notifications.visible())
+        if changes:
+            tenant.store.update(**changes)
+
+    def dismiss(self, name: str, key: str) -> bool:
+        """
+        Dismisses a notification for one tenant.
+        """
+        tenant = self.get(name)
+        if tenant is None or not tenant.notifications.dismiss(key):
+            return False
+        tenant.store.update(notifications=with_markup(
+            tenant.notifications.visible()))
+        return True
+
+    def expire(self):
+        """
+        Shows notifications again for every tenant whose dismissals ran out.
+        """
+        for tenant in self.tenants.values():
+            if tenant.notifications.expire():
+                tenant.store.update(notifications=with_markup(
+                    tenant.notifications.visible()))
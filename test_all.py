@@ -1,13 +1,48 @@
-from app import queue_check_test, check_cases_change, notifications_format_test, hhmm_to_seconds, app
+from app import queue_check_test, check_cases_change, notifications_format_test, app, readiness, events, \
+    schedule_alarm, announcement_for, briefing, cancel_alarm, stale_notes, alarm_engine, \
+    API_BODIES
+import os
+import datetime
+import pytest
+import json
+import time
+import requests
+import dataget
 from dataget import weather_test, news_test, get_national_covid_json
+from stub_server import StubProviders
+from alarms import AlarmEngine
+from speech import SpeechWorker, NullBackend, ALARM, COVID_ALERT
+from audio_cache import AudioCache
+from notifications import NotificationBuilder
+from stub_server import NEWS_FIXTURE, COVID_FIXTURE, HANG, BAD_PAYLOAD
+from snapshot import SnapshotStore
+from shared_fetch import SharedFetcher
+from tenants import TenantBriefings, load_profiles
+from metrics import Registry
+import bench
+import app as website
+from events import EventBus, notification_changes, snapshot_changes
+from covid_store import CovidStore
+from jsonstream import iter_items, first_items
+from recurrence import zone, wall_time, parse_when, make_rule, first_fire, \
+    next_fire, Cron
+from leader import Leader
+from shared_cache import SharedCache
+from providers import Provider, ProviderRegistry
+from breaker import CircuitBreaker, CircuitOpen
+from config import ConfigFile, parse_config
+from storage import Storage
+from alerts import AlertEngine, Rule, Alert, alert_text, ABSOLUTE, RELATIVE, \
+    ROLLING
 
 
 def test_time_conversion():
     """
-    This tests to see if the time extraction and conversion from HH:MM to
-    seconds is working correctly
+    This tests to see if a date and time in the d/m/y T hh:mm format of the
+    alarm form is read correctly
     """
-    assert hhmm_to_seconds("20/10/2020 T 15:25") == 55500
+    assert parse_when("20/10/2020 T 15:25", zone('UTC')) == datetime.datetime(
+        2020, 10, 20, 15, 25, tzinfo=datetime.timezone.utc).timestamp()
 
 
 def test_queue_exists():
@@ -48,3 +83,801 @@ def covid_test_api():
     covid.json file, then the API is working well.
     """
     assert get_national_covid_json()['data'][0] != {}
+
+
+def test_snapshot_swap():
+    """
+    This checks that updating the briefing snapshot bumps the version and
+    leaves a snapshot that was already handed out unchanged.
+    """
+    store = SnapshotStore()
+    before = store.current()
+    after = store.update(news=['Headline'])
+    assert after.version == before.version + 1
+    assert after.news == ('Headline',)
+    assert before.news == ()
+    assert store.current() is after
+
+
+def test_refresh_all_is_concurrent(monkeypatch):
+    """
+    This points the providers at a stub server where every response takes
+    0.3 seconds, and checks that a full refresh takes about as long as one
+    provider rather than all three added together.
+    """
+    with StubProviders(delay=0.3) as slow:
+        monkeypatch.setattr(dataget, 'WEATHER_URL', slow.weather_url)
+        monkeypatch.setattr(dataget, 'NEWS_URL', slow.news_url)
+        monkeypatch.setattr(dataget, 'COVID_URL', slow.covid_url)
+        started = time.perf_counter()
+        results = dataget.refresh_all()
+        elapsed = time.perf_counter() - started
+    assert set(results) == {'weather', 'news', 'covid'}
+    assert results['weather'][2] == 'Clouds'
+    assert len(results['covid']['data']) == 4
+    assert elapsed < 0.8
+
+
+def test_lazy_startup_readiness():
+    """
+    This checks that the app serves a page while it warms up in the
+    background, and that /ready reports 200 once the warm up has finished,
+    along with the time from the import to the first response.
+    """
+    client = app.test_client()
+    assert client.get('/index').status_code == 200
+    assert readiness.wait(10)
+    response = client.get('/ready')
+    assert response.status_code == 200
+    assert response.get_json()['state'] == 'ready'
+    assert response.get_json()['import_to_first_response_ms'] > 0
+
+
+def test_alarm_engine_persists_and_cancels(tmp_path):
+    """
+    This checks that alarms are saved to the database and reloaded in fire
+    time order, and that an alarm cancelled by its id is gone for good.
+    """
+    path = str(tmp_path / 'alarms.db')
+    engine = AlarmEngine(path, on_fire=print)
+    late = engine.add(time.time() + 7200, 'Late', {'announcement': 'b'})
+    early = engine.add(time.time() + 3600, 'Early', {'announcement': 'a'})
+    third = engine.add(time.time() + 5400, 'Middle', {'announcement': 'c'})
+    assert engine.cancel(third.alarm_id)
+    assert not engine.cancel(third.alarm_id)
+    engine.stop()
+    reloaded = AlarmEngine(path, on_fire=print)
+    assert [alarm.alarm_id for alarm in reloaded.upcoming()] == \
+        [early.alarm_id, late.alarm_id]
+    assert reloaded.upcoming()[0].payload == {'announcement': 'a'}
+    reloaded.stop()
+
+
+def test_alarm_engine_fires_when_due(tmp_path):
+    """
+    This checks that the dispatcher thread fires a due alarm by itself,
+    without any request, and removes it from the store.
+    """
+    fired = []
+    engine = AlarmEngine(str(tmp_path / 'alarms.db'), on_fire=fired.append)
+    engine.start()
+    engine.add(time.time() + 0.05, 'Soon')
+    deadline = time.time() + 5
+    while not fired and time.time() < deadline:
+        time.sleep(0.01)
+    engine.stop()
+    assert [alarm.label for alarm in fired] == ['Soon']
+    assert engine.empty()
+
+
+def test_speech_worker_queue():
+    """
+    This checks that covid alerts are spoken before alarms that were queued
+    earlier, that a duplicate waiting announcement is merged, and that the
+    queue is bounded.
+    """
+    backend = NullBackend()
+    worker = SpeechWorker(backend, maxsize=3)
+    assert worker.announce(['Wake up', ('Feels like: 4C', 'Clouds')], ALARM)
+    assert not worker.announce('Wake up. Feels like: 4C. Clouds', ALARM)
+    assert worker.announce('Cases are rising', COVID_ALERT)
+    assert worker.announce('Second alarm', ALARM)
+    assert not worker.announce('One too many', ALARM)
+    assert worker.metrics()['depth'] == 3
+    worker.start()
+    assert worker.wait_idle(5)
+    worker.stop(5)
+    assert backend.spoken == ['Cases are rising',
+                              'Wake up. Feels like: 4C. Clouds',
+                              'Second alarm']
+    metrics = worker.metrics()
+    assert (metrics['merged'], metrics['dropped'], metrics['spoken']) == \
+        (1, 1, 3)
+
+
+def test_prerendered_briefing_is_played(tmp_path):
+    """
+    This checks that a pre-rendered briefing is played from the audio cache
+    rather than synthesized, and that the least recently used clip is
+    evicted when the cache is full.
+    """
+    backend = NullBackend()
+    cache = AudioCache(str(tmp_path), max_entries=2)
+    worker = SpeechWorker(backend, cache=cache)
+    worker.start()
+    assert worker.prerender([('Feels like: 4C', 'Clouds'), 'Headline']) == 2
+    assert worker.wait_idle(5)
+    worker.announce(['Feels like: 4C', 'Clouds'])
+    assert worker.wait_idle(5)
+    assert backend.spoken == []
+    assert backend.played == [cache.path_for('Feels like: 4C. Clouds')]
+    worker.prerender(['Another headline'])
+    assert worker.wait_idle(5)
+    worker.stop(5)
+    assert 'Headline' not in cache
+    assert 'Feels like: 4C. Clouds' in cache
+
+
+def test_prerenders_make_room_for_announcements(tmp_path):
+    """
+    This checks that an alarm and a covid alert are still queued when the
+    queue is full of pre-renders, which are dropped for them, and that a
+    pre-render pass stops at its limit.
+    """
+    backend = NullBackend()
+    worker = SpeechWorker(backend, maxsize=4,
+                          cache=AudioCache(str(tmp_path), max_entries=50))
+    assert worker.prerender(['Clip ' + str(index) for index in range(40)],
+                            limit=6) == 4
+    assert worker.metrics()['dropped'] == 2
+    assert worker.announce('Wake up', ALARM)
+    assert worker.announce('Cases are rising', COVID_ALERT)
+    assert worker.metrics()['depth'] == 4
+    assert worker.metrics()['dropped'] == 2
+    worker.start()
+    assert worker.wait_idle(5)
+    worker.stop(5)
+    assert backend.spoken == ['Cases are rising', 'Wake up']
+    assert worker.metrics()['rendered'] == 2
+    assert 'Clip 0' in worker.cache and 'Clip 3' not in worker.cache
+
+
+def test_notification_builder_diffs_and_dismisses(tmp_path):
+    """
+    This checks that the notifications file is only rewritten when the
+    articles change, that a retired article is removed, and that a
+    dismissed notification is hidden until its dismissal runs out.
+    """
+    path = tmp_path / 'notifications.json'
+    builder = NotificationBuilder(str(path), str(tmp_path / 'dismissed.json'))
+    articles = NEWS_FIXTURE['articles']
+    store = CovidStore(':memory:')
+    store.ingest('nation/England', COVID_FIXTURE['data'])
+    summary = store.summary('nation/England')
+    assert builder.update(articles, summary)
+    saved = path.stat().st_mtime_ns
+    assert not builder.update(articles, summary)
+    assert path.stat().st_mtime_ns == saved
+    assert builder.dismiss(articles[0]['url'], now=1000)
+    titles = [entry['title'] for entry in builder.visible(now=1001)]
+    assert titles == ['Coronavirus Data Update', articles[1]['title']]
+    assert len(builder.visible(now=1000 + 3600)) == 3
+    assert builder.update(articles[1:])
+    reloaded = NotificationBuilder(str(path), str(tmp_path / 'dismissed.json'))
+    assert [entry['key'] for entry in reloaded.visible()] == \
+        ['covid', articles[1]['url']]
+
+
+def test_provider_conditional_requests(monkeypatch, tmp_path):
+    """
+    This checks that a second refresh sends the saved ETag, gets 304 and
+    returns UNCHANGED without rewriting news.json, and that a response with
+    a max-age is reused without any request until it expires.
+    """
+    monkeypatch.setattr(dataget, 'http_cache',
+                        dataget.ResponseCache(str(tmp_path / 'cache')))
+    monkeypatch.setattr(dataget, 'shared', SharedFetcher(0))
+    with StubProviders() as fresh:
+        monkeypatch.setattr(dataget, 'NEWS_URL', fresh.news_url)
+        assert dataget.news()['articles'] == NEWS_FIXTURE['articles']
+        saved = os.stat('news.json').st_mtime_ns
+        assert dataget.news() is dataget.UNCHANGED
+        assert os.stat('news.json').st_mtime_ns == saved
+        assert fresh.hits['/v2/top-headlines'] == 2
+    with StubProviders(max_age=60) as cached:
+        monkeypatch.setattr(dataget, 'WEATHER_URL', cached.weather_url)
+        assert dataget.weather()[2] == 'Clouds'
+        assert dataget.weather() is dataget.UNCHANGED
+        assert cached.hits['/data/2.5/weather'] == 1
+
+
+def test_tenants_share_upstream_queries(monkeypatch, tmp_path):
+    """
+    This checks that profiles fall back to the top level config, and that
+    two users in the same city cause a single weather request while each
+    gets their own briefing.
+    """
+    monkeypatch.setattr(dataget, 'shared', SharedFetcher(60))
+    config = dict(dataget.load_config(), users=[
+        {'name': 'ann', 'weather_city_name': 'Leeds'},
+        {'name': 'bob', 'weather_city_name': 'Leeds', 'news_sources': 'x'},
+        {'name': '../evil'}])
+    profiles = load_profiles(config)
+    assert sorted(profiles) == ['ann', 'bob']
+    assert profiles['ann'].news_sources == 'bbc-news'
+    assert profiles['ann'].covid_area_name == config['covid_area_name']
+    monkeypatch.setattr('storage.STATE_DIR', str(tmp_path))
+    with StubProviders() as stub:
+        monkeypatch.setattr(dataget, 'WEATHER_URL', stub.weather_url)
+        monkeypatch.setattr(dataget, 'NEWS_URL', stub.news_url)
+        monkeypatch.setattr(dataget, 'COVID_URL', stub.covid_url)
+        briefings = TenantBriefings(profiles, CovidStore(':memory:'))
+        assert briefings.refresh(config) == 4
+        assert stub.hits['/data/2.5/weather'] == 1
+        assert stub.hits['/v2/top-headlines'] == 2
+    for name in ('ann', 'bob'):
+        snap = briefings.get(name).store.current()
+        assert snap.weather[2] == 'Clouds'
+        assert snap.notifications
+    assert (tmp_path / 'notifications-ann.json').exists()
+
+
+def test_metrics_route():
+    """
+    This checks that histograms are written with cumulative buckets, that
+    a timed call that raises is counted as an error, and that /index and
+    the provider fetches show up on the /metrics route.
+    """
+    registry = Registry(buckets=(0.1, 1.0))
+    registry.observe('op_seconds', 0.05, kind='a')
+    registry.observe('op_seconds', 0.5, kind='a')
+    try:
+        with registry.timed('op_seconds', kind='b'):
+            raise ValueError
+    except ValueError:
+        pass
+    text = registry.render()
+    assert 'op_seconds_bucket{kind="a",le="0.1"} 1' in text
+    assert 'op_seconds_bucket{kind="a",le="+Inf"} 2' in text
+    assert 'op_errors_total{kind="b"} 1.0' in text
+    client = app.test_client()
+    assert client.get('/index').status_code == 200
+    body = client.get('/metrics').get_data(as_text=True)
+    assert '# TYPE event_schedule_seconds histogram' in body
+    assert 'http_responses_total{route="/index",status="200"}' in body
+    assert 'provider_fetch_seconds_count{provider="weather"}' in body
+
+
+def test_benchmark_helpers(tmp_path):
+    """
+    This checks the nearest rank percentiles used by the benchmark, and
+    runs its alarm creation and page render benchmarks at a small size.
+    """
+    assert bench.percentile([0.3, 0.1, 0.2, 0.4], 0.5) == 0.2
+    assert bench.percentile(list(range(1, 101)), 0.99) == 99
+    assert bench.summary([0.001, 0.003])['mean_ms'] == 2.0
+    results = bench.alarm_creation(str(tmp_path), sizes=(0, 20), batch=5)
+    assert [result['pending'] for result in results] == [0, 20]
+    assert results[1]['add']['count'] == 5
+    render = bench.index_render(website, samples=5)
+    assert render['cached']['count'] == render['cached_request']['count'] == 5
+    assert render['gzip_bytes'] < render['bytes']
+
+
+def test_event_push_channel():
+    """
+    This checks that notification changes become added and removed events,
+    that weather, which is not on the page, publishes nothing, that each
+    page only gets the events of its own user, that a page which fell behind
+    the kept history is told to reload, that /events streams an event as a
+    server-sent event, that a page with an id from another process gets a
+    snapshot to catch up from, and that the page reloads without the alarm
+    or dismissal in its address.
+    """
+    old = ({'key': 'a', 'title': 'A', 'content': '1'},
+           {'key': 'b', 'title': 'B', 'content': '2'})
+    new = ({'key': 'c', 'title': 'C', 'content': '3'},
+           {'key': 'b', 'title': 'B', 'content': '2'})
+    assert notification_changes(old, new) == [
+        ('notification_removed', {'key': 'a'}),
+        ('notification_added', {'key': 'c', 'title': 'C', 'content': '3',
+                                'before': 'b'})]
+    snap = SnapshotStore().current()
+    assert snapshot_changes(snap, snap._replace(weather=('4C', 'Rain'))) == []
+    bus = EventBus(history=3)
+    bus.publish('ann', 'alarm_added', {'id': '1'})
+    bus.publish(None, 'alarm_added', {'id': '2'})
+    assert [event.data['id'] for event in bus.since(0, 'ann')] == ['1']
+    assert [event.data['id'] for event in bus.since(0, None)] == ['2']
+    assert bus.wait(2, None, 0.01) == []
+    for _ in range(3):
+        bus.publish(None, 'alarm_fired', {'id': '3'})
+    assert bus.since(1, None)[0].kind == 'reload'
+    assert bus.parse(events.token(1)) is None
+    assert bus.parse(bus.token(4)) == 4
+    after = events.last_id
+    events.publish(None, 'alarm_fired', {'id': 'x'})
+    response = app.test_client().get('/events?after=' + events.token(after))
+    assert response.mimetype == 'text/event-stream'
+    first = next(iter(response.response)).decode('utf-8')
+    response.close()
+    assert first.startswith('id: ' + events.token(after + 1)
+                            + '\nevent: alarm_fired')
+    response = app.test_client().get('/events?after=' + bus.token(after))
+    first = next(iter(response.response)).decode('utf-8')
+    response.close()
+    assert first.startswith('id: ' + events.token(events.last_id)
+                            + '\nevent: snapshot\n')
+    assert 'notifications' in json.loads(first.split('data: ', 1)[1])
+    page = app.test_client().get('/index').data.decode('utf-8')
+    assert 'location.reload' not in page and 'location.assign(home)' in page
+
+
+def test_json_api_etags_and_idempotent_writes():
+    """
+    This checks that creating an alarm twice with the same id makes one
+    alarm, that a time out of range is refused, that an unchanged list
+    answers 304 to its ETag, that cancelling can be repeated, that the
+    alarms of another user can not be read or cancelled, and that
+    notifications can be listed and dismissed.
+    """
+    client = app.test_client()
+    body = {'label': 'Kiosk', 'fire_at': time.time() + 3600}
+    first = client.put('/api/alarms/kiosk-1', json=body)
+    assert first.status_code == 201
+    again = client.put('/api/alarms/kiosk-1', json=dict(body, label='Other'))
+    assert again.status_code == 200
+    assert again.get_json()['title'] == 'Kiosk'
+    assert client.post('/api/alarms', json={'label': 'x'}).status_code == 400
+    for bad in (1e300, float('nan'), -1):
+        assert client.post('/api/alarms', json={
+            'label': 'x', 'fire_at': bad}).status_code == 400
+    listing = client.get('/api/alarms')
+    assert [alarm['id'] for alarm in listing.get_json()['alarms']
+            if alarm['id'] == 'kiosk-1'] == ['kiosk-1']
+    unchanged = client.get('/api/alarms', headers={
+        'If-None-Match': listing.headers['ETag']})
+    assert unchanged.status_code == 304
+    API_BODIES.clear()  # As if another process answered
+    assert client.get('/api/alarms', headers={
+        'If-None-Match': listing.headers['ETag']}).status_code == 304
+    assert client.delete('/api/alarms/kiosk-1').status_code == 204
+    assert client.delete('/api/alarms/kiosk-1').status_code == 204
+    assert client.get('/api/alarms/kiosk-1').get_json()['status'] \
+        == 'cancelled'
+    assert client.put('/api/alarms/kiosk-1', json=body).status_code == 200
+    assert client.get('/api/alarms', headers={
+        'If-None-Match': listing.headers['ETag']}).status_code == 200
+    assert client.delete('/api/alarms/missing').status_code == 404
+    notes = client.get('/api/notifications')
+    key = notes.get_json()['notifications'][0]['key']
+    assert client.get('/api/notifications', headers={
+        'If-None-Match': notes.headers['ETag']}).status_code == 304
+    assert client.delete('/api/notifications/' + key).status_code == 204
+    assert key not in [entry['key'] for entry in client.get(
+        '/api/notifications').get_json()['notifications']]
+    assert client.get('/api/alarms?user=nobody').status_code == 404
+    other = schedule_alarm('ann', time.time() + 3600, 'Not yours')[0]
+    assert client.get('/api/alarms/' + other.alarm_id).status_code == 404
+    assert client.delete('/api/alarms/' + other.alarm_id).status_code == 404
+    client.get('/index?alarm_item=' + other.alarm_id)
+    assert alarm_engine.get(other.alarm_id)[1] == 'pending'
+    client.get('/index?user=ann&alarm_item=' + other.alarm_id)
+    assert alarm_engine.get(other.alarm_id)[1] == 'pending'
+    assert cancel_alarm(other.alarm_id) is not None
+    mine = schedule_alarm(None, time.time() + 3600, 'Yours')[0]
+    client.get('/index?alarm_item=' + mine.alarm_id)
+    assert alarm_engine.get(mine.alarm_id)[1] == 'cancelled'
+
+
+def test_covid_store_trends():
+    """
+    This checks that only new or revised values are written, that nulls
+    fall back to the latest number, and that the rolling average and the
+    growth on the window before are worked out per metric.
+    """
+    store = CovidStore(':memory:')
+    rows = [{'date': '2020-12-0' + str(day), 'newCasesByPublishDate': day,
+             'newDeathsByDeathDate': None if day == 6 else 10 * day}
+            for day in range(6, 0, -1)]
+    assert store.ingest('nation/England', rows) == 11
+    assert store.ingest('nation/England', rows) == 0
+    assert store.ingest('nation/England', [dict(rows[0], date='2020-12-07',
+                                                newCasesByPublishDate=9)]) == 1
+    assert store.latest('nation/England') == {
+        'newCasesByPublishDate': 9, 'newDeathsByDeathDate': 50}
+    trend = store.trends('nation/England', 'newCasesByPublishDate', window=2)
+    assert [row['average'] for row in trend][-2:] == [5.5, 7.5]
+    assert trend[-1]['growth'] == 7.5 / 4.5 - 1
+    assert trend[0]['growth'] is None
+    summary = store.summary('nation/England', window=2)
+    assert summary['newDeathsByDeathDate']['date'] == '2020-12-05'
+    assert store.summary('nowhere') == {}
+
+
+def test_covid_store_trends_need_a_full_window():
+    """
+    This checks that the first days of a history, with fewer values than
+    the window, have no average or growth, so a partial window is never
+    compared with a full one.
+    """
+    store = CovidStore(':memory:')
+    store.ingest('nation/England', [
+        {'date': '2020-12-' + str(day).zfill(2),
+         'newCasesByPublishDate': 10 if day == 1 else 100}
+        for day in range(1, 16)])
+    trend = store.trends('nation/England', 'newCasesByPublishDate')
+    assert [row['average'] for row in trend[:6]] == [None] * 6
+    assert trend[6]['average'] == (10 + 6 * 100) / 7
+    assert [row['growth'] for row in trend[:13]] == [None] * 13
+    assert trend[13]['growth'] == 100 / ((10 + 6 * 100) / 7) - 1
+    assert trend[14]['growth'] == 0
+
+
+def test_streaming_json_reader(tmp_path):
+    """
+    This checks that the streaming reader gives the same items as json.load
+    however the file is split into chunks, that it can pick out fields and
+    stop after the first few items, and that other keys are skipped.
+    """
+    path = tmp_path / 'covid.json'
+    document = {'length': 12345, 'meta': {'pages': [1, 2]},
+                'data': COVID_FIXTURE['data'], 'lastUpdate': None}
+    path.write_text(json.dumps(document))
+    for chunk_size in (1, 3, 16, 65536):
+        assert list(iter_items(str(path), 'data', chunk_size=chunk_size)) \
+            == COVID_FIXTURE['data']
+    assert first_items(str(path), 'data', 2, fields=('date',)) == [
+        {'date': '2020-12-03'}, {'date': '2020-12-02'}]
+    assert list(iter_items(str(path), 'missing')) == []
+
+
+def test_recurrence_rules(tmp_path):
+    """
+    This checks that alarm times are read with and without a date and time
+    zone, that repeat rules find the right next day, also across a change
+    of the clocks, that a rule which never goes off is refused, and that a
+    repeating alarm stays in the engine at its next time after it goes off.
+    """
+    london = zone('Europe/London')
+    now = datetime.datetime(2024, 3, 29, 12, 0, tzinfo=london).timestamp()
+    assert parse_when('2024-03-29T07:30', london) == now - 4.5 * 3600
+    assert parse_when('29/03/2024 T 07:30', london) == now - 4.5 * 3600
+    assert parse_when('07:30', london, now) == now + 19.5 * 3600
+    with pytest.raises(ValueError):
+        parse_when('tomorrow-ish', london)
+    with pytest.raises(ValueError):
+        make_rule('61 * * * *', now)
+    with pytest.raises(ValueError):
+        first_fire(make_rule('0 0 30 2 *', now), now, london, now)
+    assert app.test_client().post('/api/alarms', json={
+        'label': 'Never', 'fire_at': now, 'repeat': '0 0 30 2 *'}) \
+        .status_code == 400
+    rule = make_rule('weekdays', parse_when('2024-03-29T07:30', london),
+                     london)
+    assert rule == '30 7 * * 1-5'
+    monday = first_fire(rule, now, london, now)
+    assert wall_time(monday, london) == datetime.datetime(2024, 4, 1, 7, 30)
+    assert monday - now == (2 * 24 + 19.5 - 1) * 3600  # The clocks went on.
+    assert wall_time(next_fire(rule, monday, 'Europe/London', now), london) \
+        == datetime.datetime(2024, 4, 2, 7, 30)
+    either = Cron('0 9 13 * fri')  # The 13th or any Friday.
+    assert wall_time(either.next_after(now, london), london) \
+        == datetime.datetime(2024, 4, 5, 9, 0)
+    fired = []
+    engine = AlarmEngine(str(tmp_path / 'alarms.db'), on_fire=fired.append)
+    engine.start()
+    engine.add(time.time() + 0.05, 'Every minute', {'repeat': '* * * * *'})
+    deadline = time.time() + 5
+    while not fired and time.time() < deadline:
+        time.sleep(0.01)
+    engine.stop()
+    assert [alarm.label for alarm in fired] == ['Every minute']
+    assert len(engine) == 1
+    assert engine.upcoming()[0].fire_at > time.time()
+
+
+def test_bulk_alarm_import():
+    """
+    This checks that an import adds every alarm in one go, that repeating
+    it adds nothing, and that one bad alarm stops the whole import.
+    """
+    client = app.test_client()
+    alarms = [{'id': 'bulk-' + str(index), 'label': 'Bulk ' + str(index),
+               'at': '2099-01-0' + str(index + 1) + 'T07:00',
+               'repeat': 'daily' if index else None} for index in range(3)]
+    first = client.post('/api/alarms/import', json={'alarms': alarms})
+    assert first.status_code == 201
+    assert first.get_json()['added'] == 3
+    assert first.get_json()['alarms'][1]['repeat'] == '0 7 * * *'
+    again = client.post('/api/alarms/import', json={'alarms': alarms})
+    assert again.get_json() == {'added': 0, 'skipped': 3, 'alarms': []}
+    bad = client.post('/api/alarms/import', json={'alarms': [
+        {'id': 'bulk-new', 'label': 'Fine', 'at': '2099-01-01T07:00'},
+        {'label': 'Broken', 'at': '2099-01-01T07:00', 'repeat': 'hourly'}]})
+    assert bad.status_code == 400
+    assert bad.get_json()['error'].startswith('alarms[1]')
+    assert client.get('/api/alarms/bulk-new').status_code == 404
+    for index in range(3):
+        client.delete('/api/alarms/bulk-' + str(index))
+
+
+def test_processes_share_leader_cache_and_alarms(tmp_path):
+    """
+    This checks that only one process can lead, that snapshot fields one
+    process shares reach the others but not itself, and that alarms one
+    process adds or cancels are picked up by another sharing the database.
+    """
+    first = Leader(str(tmp_path / 'leader.lock'))
+    second = Leader(str(tmp_path / 'leader.lock'))
+    assert first.try_acquire() and not second.try_acquire()
+    first.release()
+    assert second.try_acquire()
+    second.release()
+    writer = SharedCache(str(tmp_path / 'shared.db'))
+    reader = SharedCache(str(tmp_path / 'shared.db'))
+    writer.publish('', {'news': ['Headline'], 'weather': ['Rain']})
+    writer.publish('alice', {'news': ['Other']})
+    writer.publish('', {'news': ['Newer']})
+    assert reader.changes() == {'': {'news': ['Newer'], 'weather': ['Rain']},
+                                'alice': {'news': ['Other']}}
+    assert reader.changes() == {} and writer.changes() == {}
+    path = str(tmp_path / 'alarms.db')
+    synced = []
+    leading = AlarmEngine(path, on_fire=print)
+    serving = AlarmEngine(path, on_fire=print,
+                          on_sync=lambda added, removed: synced.append(
+                              ([a.label for a in added],
+                               [a.label for a in removed])))
+    alarm = leading.add(time.time() + 60, 'Shared')
+    assert serving.get(alarm.alarm_id)[1] == 'pending'
+    assert serving.sync() and not serving.sync()
+    assert [a.label for a in serving.upcoming()] == ['Shared']
+    assert serving.cancel(alarm.alarm_id) == alarm
+    assert leading.sync() and leading.empty()
+    assert leading.cancel(alarm.alarm_id) is None
+    later = leading.add(time.time() + 60, 'Later')
+    serving.sync()
+    assert synced == [(['Shared'], []), (['Later'], [])]
+    unsynced = leading.add(time.time() + 60, 'Unsynced')
+    assert serving.cancel(unsynced.alarm_id) == unsynced
+    assert serving.get(unsynced.alarm_id)[1] == 'cancelled'
+    assert leading.sync()
+    assert [a.label for a in leading.upcoming()] == [later.label]
+
+
+def test_provider_registry_refreshes_adaptively():
+    """
+    This checks that providers are only refreshed when stale and wanted,
+    sooner before an alarm that announces them, never more often than
+    their rate limit, and with a doubling backoff after failures.
+    """
+    registry = ProviderRegistry([
+        Provider('weather', None, ttl=1800, min_interval=60, alarm_ttl=600),
+        Provider('covid', None, ttl=3600, min_interval=600, always=True)])
+    assert registry.due(False, now=0) == ['covid']
+    assert registry.due(True, now=0) == ['weather', 'covid']
+    for name in registry:
+        registry.record(name, True, now=0)
+    assert registry.due(True, now=1000) == []
+    assert registry.due(False, {'weather': 1500}, now=1000) == ['weather']
+    assert registry.due(False, {'weather': 5000}, now=1000) == []
+    assert registry.due(True, now=1800) == ['weather']
+    registry.configure({'weather': {'ttl': 3000, 'fetch': print}})
+    assert registry['weather'].ttl == 3000 and registry['weather'].fetch is None
+    registry.record('covid', False, now=3600)
+    registry.record('covid', False, now=3620)
+    assert registry.due(False, now=3700) == []  # 120 seconds after 2 fails.
+    assert registry.due(False, now=4220) == ['covid']  # The rate limit.
+    assert registry.metrics(now=4220)['covid'] == {'age': 4220, 'failures': 2}
+
+
+def test_alarm_briefing_assembled_when_it_goes_off():
+    """
+    This checks that an alarm announces the weather as it is when the alarm
+    goes off rather than when it was set, and that alarms saved with their
+    announcement still announce it.
+    """
+    alarm = schedule_alarm(None, time.time() + 3600, 'Wake',
+                           briefings=('weather',))[0]
+    assert alarm.payload['briefings'] == ['weather']
+    old_weather = briefing.current().weather
+    briefing.update(weather=('Feels like: 30C', 'Sun'))
+    try:
+        assert announcement_for(alarm) == ('Feels like: 30C', 'Sun')
+    finally:
+        briefing.update(weather=old_weather)
+        cancel_alarm(alarm.alarm_id)
+    saved = alarm._replace(payload={'announcement': 'Saved earlier'})
+    assert announcement_for(saved) == 'Saved earlier'
+
+
+def test_circuit_breaker_against_faulty_provider(monkeypatch):
+    """
+    This checks against a stub that injects faults that the weather breaker
+    opens after failures and stops calling the provider, lets a probe
+    through once it is half open and closes when it succeeds, that a slow
+    provider times out, that an error sent with status 200 is not saved,
+    and that the page says how old data is once it is past its ttl.
+    """
+    breaker = CircuitBreaker('weather', threshold=2, reset_seconds=0.2)
+    monkeypatch.setattr(dataget, 'session', requests.Session())
+    monkeypatch.setattr(dataget, 'shared', SharedFetcher(0))
+    monkeypatch.setitem(dataget.BREAKERS, 'weather', breaker)
+    monkeypatch.setitem(dataget.TIMEOUTS, 'weather', 0.2)
+    with StubProviders() as faulty:
+        monkeypatch.setattr(dataget, 'WEATHER_URL', faulty.weather_url)
+        faulty.fail(faulty.weather_url, 503)
+        for _ in range(2):
+            with pytest.raises(requests.HTTPError):
+                dataget.fetch_weather('Exeter', '')
+        hits = faulty.hits['/data/2.5/weather']
+        with pytest.raises(CircuitOpen):
+            dataget.fetch_weather('Exeter', '')
+        assert faulty.hits['/data/2.5/weather'] == hits
+        faulty.heal()
+        time.sleep(0.25)
+        assert dataget.fetch_weather('Exeter', '')['name'] == 'Exeter'
+        assert breaker.state == 'closed'
+        faulty.server.hang_seconds = 1
+        faulty.fail(faulty.weather_url, HANG)
+        started = time.time()
+        with pytest.raises(requests.Timeout):
+            dataget.fetch_weather('Exeter', '')
+        assert time.time() - started < 1
+        faulty.fail(faulty.weather_url, BAD_PAYLOAD)
+        saved = open('weather.json').read() if os.path.exists(
+            'weather.json') else None
+        with pytest.raises(ValueError):
+            dataget.weather({'weather_city_name': 'Exeter',
+                             'weather_api_key': ''})
+        assert (open('weather.json').read() if os.path.exists(
+            'weather.json') else None) == saved
+    snap = SnapshotStore().update(fetched=[('weather', 0), ('news', 9000)])
+    assert stale_notes(snap, now=9000) == ['The weather is from 2 hours ago']
+
+
+def test_config_reloads_when_the_file_changes(tmp_path):
+    """
+    This checks that config.json is checked when it is loaded, that it is
+    reloaded when it changes and the subscribers are told, that a file that
+    no longer checks keeps the previous config, and that provider settings
+    left out of a reloaded config go back to their defaults.
+    """
+    path = tmp_path / 'config.json'
+    data = dict(dataget.load_config(), providers={'news': {'ttl': 60}})
+    path.write_text(json.dumps(data))
+    config_file = ConfigFile(str(path))
+    changes = []
+    config_file.subscribe(lambda old, new: changes.append((old, new)))
+    assert config_file.current().providers == {'news': {'ttl': 60}}
+    assert not config_file.reload()
+    path.write_text(json.dumps(dict(data, user_threshold_number=0.5)))
+    assert config_file.reload()
+    assert config_file.current().user_threshold_number == 0.5
+    assert changes[0][0].user_threshold_number == data['user_threshold_number']
+    path.write_text(json.dumps(dict(data, user_threshold_number='high')))
+    assert not config_file.reload()
+    assert config_file.current().user_threshold_number == 0.5
+    assert len(changes) == 1
+    with pytest.raises(ValueError, match='time_zone'):
+        parse_config(dict(data, time_zone='Mars/Olympus'))
+    with pytest.raises(ValueError, match='tts_backend'):
+        parse_config(dict(data, tts_backend='pyttsx'))
+    registry = ProviderRegistry([Provider('news', print, 3600)])
+    registry.configure(config_file.current().providers)
+    assert registry['news'].ttl == 60
+    registry.configure({})
+    assert registry['news'].ttl == 3600
+
+
+def test_index_page_served_from_render_cache():
+    """
+    This checks that the /index page is gzipped for browsers that accept it
+    and served from the page cache while nothing changes, and that adding
+    an alarm renders a new page with only the new card rendered.
+    """
+    import gzip
+    import app as app_module
+    client = app.test_client()
+    zipped = client.get('/index', headers={'Accept-Encoding': 'gzip'})
+    assert zipped.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in zipped.headers['Vary']
+    plain = client.get('/index')
+    assert gzip.decompress(zipped.data) == plain.data
+    hits = app_module.PAGES.hits
+    assert client.get('/index').data == plain.data
+    assert app_module.PAGES.hits == hits + 1
+    cards = len(app_module.FRAGMENTS)
+    alarm = schedule_alarm(None, time.time() + 86400, 'Cached card')[0]
+    try:
+        assert b'Cached card' in client.get('/index').data
+        assert len(app_module.FRAGMENTS) == cards + 1
+    finally:
+        cancel_alarm(alarm.alarm_id)
+
+
+def test_storage_writes_are_atomic_and_batched(tmp_path):
+    """
+    This checks that readers of a state file only ever see a whole version
+    of it while threads write it, that every write gets the next generation,
+    that writers share directory syncs, that a file is only parsed again
+    once it changed, and that a write that fails leaves the file alone.
+    """
+    import threading
+    storage = Storage()
+    path = str(tmp_path / 'notifications.json')
+    storage.write(path, [])
+    seen = []
+    done = threading.Event()
+
+    def read():
+        while not done.is_set():
+            seen.append(len(storage.read(path)))
+
+    def write(size):
+        for _ in range(20):
+            storage.write(path, [{'key': str(i)} for i in range(size)])
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    writers = [threading.Thread(target=write, args=(size,))
+               for size in (10, 200, 3000)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+    done.set()
+    reader.join()
+    assert set(seen) <= {0, 10, 200, 3000}
+    assert storage.generation(path) == 61
+    assert storage.syncs <= storage.writes == 61
+    assert storage.read(path) is storage.read(path)
+    with pytest.raises(TypeError):
+        storage.write(path, {'not json': object()})
+    assert storage.generation(path) == 61
+    assert os.listdir(str(tmp_path)) == ['notifications.json']
+
+
+def test_alert_rules_evaluated_on_ingest(tmp_path):
+    """
+    This checks that alert rules are checked as covid data is stored, only
+    for the metric they watch, that absolute, rolling and relative rules go
+    off at their thresholds, that a rule which went off stays quiet until
+    the value falls below its clear level, and waits out its cooldown, and
+    that growth from zero does not break the check.
+    """
+    store = CovidStore(str(tmp_path / 'covid.db'))
+    alerts = []
+    engine = AlertEngine(store, alerts.append, [
+        Rule('high', 'nation/England', 'newCases', ABSOLUTE, 100, clear=50,
+             cooldown=0),
+        Rule('average', 'nation/England', 'newCases', ROLLING, 60,
+             window=2),
+        Rule('growth', 'nation/England', 'newCases', RELATIVE, 0.5,
+             window=1),
+        Rule('deaths', 'nation/England', 'newDeaths', ABSOLUTE, 1)])
+    store.subscribe(engine.evaluate)
+    assert [rule.name for rule in engine.rules(
+        'nation/England', 'newCases')] == ['high', 'average', 'growth']
+
+    def day(date, cases):
+        store.ingest('nation/England', [{'date': date, 'newCases': cases}])
+        names = [alert.rule.name for alert in alerts]
+        alerts.clear()
+        return names
+
+    assert day('2021-01-01', 0) == []
+    assert day('2021-01-02', 120) == ['high', 'average']
+    assert day('2021-01-03', 40) == []
+    assert day('2021-01-04', 100) == ['high', 'growth']
+    assert day('2021-01-05', 120) == []
+    assert day('2021-01-06', 80) == []
+    assert day('2021-01-07', 200) == []
+    later = engine.evaluate('nation/England', now=time.time() + 86401)
+    assert [alert.rule.name for alert in later] == ['growth']
+    assert alert_text(Alert(Rule('cases', 'nation/England',
+                                 'newCasesByPublishDate', RELATIVE, 0.25),
+                            0.3, '2021-01-07')) == \
+        'COVID Alert, the seven day average of cases has increased by 30 ' \
+        'percent on the week before.'